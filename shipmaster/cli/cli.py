@@ -4,15 +4,22 @@ import os
 import sys
 
 from shipmaster.core.plugins import Platform, PluginManager
-from shipmaster.core.builder import Builder
-from shipmaster.core.config import BuildConfig
+from .daemon import Daemon, SOCKET_PATH, forward
 
 logger = logging.getLogger('shipmaster')
 
 
-def run_command(args):
-    config = BuildConfig.from_workspace(os.getcwd())
+def run_command(args, config):
+    from shipmaster.core.builder import Builder, MissingParentImage
+    if config is None:
+        sys.exit("No .shipmaster.yaml found in {}".format(os.getcwd()))
     builder = Builder(config, args, commit_info={})
+    try:
+        failure = builder.run(args.stage)
+    except MissingParentImage as exc:
+        sys.exit(str(exc))
+    if failure:
+        sys.exit(str(failure))
 
 
 def run_parser(parsers):
@@ -27,6 +34,17 @@ def run_parser(parsers):
     return p
 
 
+def daemon_command(args, config):
+    Daemon(args.socket, execute).serve()
+
+
+def daemon_parser(parsers):
+    p = parsers.add_parser("daemon", help="Keep shipmaster loaded in the background to run other commands faster.")
+    p.add_argument("--socket", help="Unix socket to listen on.", default=SOCKET_PATH)
+    p.set_defaults(command=daemon_command)
+    return p
+
+
 def argument_parser():
 
     parser = argparse.ArgumentParser(
@@ -37,7 +55,8 @@ def argument_parser():
     subparsers.required = True
 
     commands = {
-        'run': run_parser(subparsers)
+        'run': run_parser(subparsers),
+        'daemon': daemon_parser(subparsers),
     }
 
     for plugin in PluginManager.plugin_classes:
@@ -50,13 +69,23 @@ def parse_args(args):
     return argument_parser().parse_args(args)
 
 
-def main():
-    PluginManager.load(Platform.cli)
+def execute(argv):
+    from shipmaster.core.config import BuildConfig
     parser = argument_parser()
-    args = parser.parse_args()
-    logging.basicConfig(level=logging.INFO)
+    args = parser.parse_args(argv)
     if hasattr(args, 'command'):
         config = BuildConfig.from_workspace(os.getcwd())
         args.command(args, config)
     else:
         parser.print_help()
+
+
+def main():
+    argv = sys.argv[1:]
+    if 'SHIPMASTER_NO_DAEMON' not in os.environ:
+        exit_code = forward(argv)
+        if exit_code is not None:
+            sys.exit(exit_code)
+    PluginManager.load(Platform.cli)
+    logging.basicConfig(level=logging.INFO)
+    execute(argv)
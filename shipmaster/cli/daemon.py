@@ -0,0 +1,211 @@
+import io
+import os
+import sys
+import json
+import ctypes
+import socket
+import logging
+import threading
+import traceback
+import socketserver
+from contextlib import contextmanager
+
+from shipmaster.core.config import CACHE_DIR
+
+logger = logging.getLogger('shipmaster')
+
+SOCKET_PATH = os.environ.get('SHIPMASTER_SOCKET', os.path.join(CACHE_DIR, 'daemon.sock'))
+
+# commands which never make sense to forward to the daemon
+LOCAL_COMMANDS = ('daemon', 'watch')
+
+
+def forward(argv, path=SOCKET_PATH, output=None):
+    """
+    Runs the command in the daemon, if one is listening on `path`, streaming
+    its output to `output` or stdout. Returns the exit code or `None` when
+    there is no daemon. Interrupting the client disconnects it, which
+    cancels the command in the daemon.
+    """
+    output = output or sys.stdout
+    if not argv or argv[0] in LOCAL_COMMANDS or not os.path.exists(path):
+        return None
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+    except OSError:
+        client.close()
+        return None
+    with client, client.makefile('rwb') as stream:
+        request = {'argv': argv, 'cwd': os.getcwd(), 'environ': dict(os.environ)}
+        stream.write(json.dumps(request).encode()+b'\n')
+        stream.flush()
+        try:
+            for line in stream:
+                message = json.loads(line.decode())
+                if 'output' in message:
+                    output.write(message['output'])
+                    output.flush()
+                elif 'exit' in message:
+                    return message['exit']
+        except KeyboardInterrupt:
+            return 130
+    return 1  # daemon went away in the middle of the command
+
+
+class Output(io.TextIOBase):
+    """ File-like object streaming everything written to it back to the client. """
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def send(self, **message):
+        self.stream.write(json.dumps(message).encode()+b'\n')
+        self.stream.flush()
+
+    def write(self, text):
+        if text:
+            self.send(output=text)
+        return len(text)
+
+
+class DisconnectWatcher(threading.Thread):
+    """
+    Interrupts the thread running a command, with a `KeyboardInterrupt`,
+    once its client disconnects. Clients send nothing after their request,
+    so reading from the connection only returns when it is closed.
+
+    The interrupt is only raised within `interruptible()`, so that the
+    daemon's own state is never left half restored. A disconnect before
+    that interrupts the command as soon as it starts.
+    """
+
+    def __init__(self, rfile, thread_id):
+        super().__init__(name='disconnect-watcher', daemon=True)
+        self.rfile = rfile
+        self.thread_id = thread_id
+        self.lock = threading.Lock()
+        self.armed = False
+        self.disconnected = False
+        self.interrupted = False
+
+    def run(self):
+        try:
+            self.rfile.read(1)
+        except (OSError, ValueError):
+            pass
+        with self.lock:
+            self.disconnected = True
+            if self.armed:
+                self._interrupt()
+
+    @contextmanager
+    def interruptible(self):
+        with self.lock:
+            self.armed = True
+            if self.disconnected:
+                self._interrupt()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.armed = False
+                if self.interrupted:
+                    # not raised yet if the command finished in the meantime
+                    self._set_exception(None)
+
+    def _interrupt(self):
+        if not self.interrupted:
+            self.interrupted = True
+            self._set_exception(KeyboardInterrupt)
+
+    def _set_exception(self, exc):
+        ctypes.pythonapi.PyThreadState_SetAsyncExc(
+            ctypes.c_ulong(self.thread_id), ctypes.py_object(exc) if exc else None
+        )
+
+
+@contextmanager
+def _uninterruptible():
+    yield
+
+
+class CommandHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        request = json.loads(self.rfile.readline().decode())
+        output = Output(self.wfile)
+        watcher = DisconnectWatcher(self.rfile, threading.get_ident())
+        watcher.start()
+        try:
+            exit_code = self.server.run(request, output, watcher.interruptible)
+            output.send(exit=exit_code)
+        except (BrokenPipeError, KeyboardInterrupt):
+            logger.info('Client disconnected, command cancelled.')
+
+
+class Daemon(socketserver.UnixStreamServer):
+    """
+    Runs CLI commands for `shipmaster.cli.main()` in a long lived process,
+    so that imports, plugins, parsed configs and the Docker client's
+    connection pool are all kept warm between invocations.
+
+    Commands run one at a time since they change the working directory,
+    environment and standard output of the whole process. A command is
+    cancelled when its client disconnects, so that it doesn't hold up
+    the commands after it.
+    """
+
+    def __init__(self, path, execute):
+        if os.path.exists(path):
+            os.remove(path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        super().__init__(path, CommandHandler)
+        os.chmod(path, 0o600)
+        self.path = path
+        self.execute = execute
+
+    def run(self, request, output, interruptible=None):
+        """
+        Runs the command of `request` with its output going to `output`.
+        The command, and only the command, runs within `interruptible()`.
+        """
+        cwd, environ = os.getcwd(), dict(os.environ)
+        stdout, stderr = sys.stdout, sys.stderr
+        root = logging.getLogger()
+        handlers = root.handlers
+        root.handlers = [logging.StreamHandler(output)]
+        sys.stdout = sys.stderr = output
+        os.environ.clear()
+        os.environ.update(request['environ'])
+        try:
+            os.chdir(request['cwd'])
+            with (interruptible or _uninterruptible)():
+                self.execute(request['argv'])
+            return 0
+        except SystemExit as exc:
+            if isinstance(exc.code, str):
+                output.write(exc.code+'\n')
+                return 1
+            return exc.code or 0
+        except BrokenPipeError:
+            raise
+        except Exception:
+            traceback.print_exc(file=output)
+            return 1
+        finally:
+            os.chdir(cwd)
+            os.environ.clear()
+            os.environ.update(environ)
+            sys.stdout, sys.stderr = stdout, stderr
+            root.handlers = handlers
+
+    def serve(self):
+        logger.info('Shipmaster daemon listening on {}'.format(self.path))
+        try:
+            self.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.server_close()
+            os.remove(self.path)
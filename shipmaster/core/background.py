@@ -0,0 +1,97 @@
+import time
+import atexit
+import logging
+import threading
+from weakref import WeakSet
+from collections import OrderedDict
+
+logger = logging.getLogger('shipmaster')
+
+
+class BackgroundSender:
+    """
+    Delivers queued items from a daemon thread, so that callers never wait
+    on a remote service.
+
+    Items are kept in `pending` by key, each with the time it is due at.
+    Subclasses queue items with `queue()` and implement `send()`, which may
+    return a time to retry the item at. A retry is dropped when a newer item
+    was queued under the same key in the meantime.
+    """
+
+    TIMEOUT = 10  # seconds to wait for a request, and for the queue to drain on exit
+
+    def __init__(self, name):
+        self.name = name
+        self.pending = OrderedDict()  # key -> [due_at, item]
+        self.sending = None
+        self.paused_until = 0  # nothing is sent before this time
+        self.condition = threading.Condition()
+        self.thread = None
+        _senders.add(self)
+
+    def queue(self, key, item, due_at=0):
+        """ Queues `item`, replacing any pending item with the same key. Call with `condition` held. """
+        self.pending.pop(key, None)
+        self.pending[key] = [due_at, item]
+        self.wake()
+
+    def wake(self):
+        """ Starts the thread, or tells it the queue changed. Call with `condition` held. """
+        if self.thread is None or not self.thread.is_alive():
+            # started lazily so that forked worker processes get their own thread
+            self.thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self.thread.start()
+        self.condition.notify()
+
+    def flush(self, timeout=None):
+        """ Waits for queued items to be sent, returns `False` if `timeout` expired first. """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while self.pending or self.sending is not None:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+    def send(self, key, item):
+        """ Delivers `item`, returns the time to retry it at or `None` when done with it. """
+        raise NotImplementedError
+
+    def _next(self):
+        """ Blocks until an item is due, then takes it off the queue. """
+        with self.condition:
+            while True:
+                now = time.time()
+                due = [key for key, (due_at, _) in self.pending.items() if due_at <= now]
+                if due and self.paused_until <= now:
+                    self.sending = due[0]
+                    return due[0], self.pending.pop(due[0])[1]
+                if self.pending:
+                    self.condition.wait(max(min(due_at for due_at, _ in self.pending.values()), self.paused_until) - now)
+                else:
+                    self.condition.wait()
+
+    def _run(self):
+        while True:
+            key, item = self._next()
+            try:
+                retry_at = self.send(key, item)
+            except Exception:
+                logger.exception('{} failed to send:'.format(self.name))
+                retry_at = None
+            with self.condition:
+                if retry_at is not None and key not in self.pending:
+                    self.pending[key] = [retry_at, item]
+                self.sending = None
+                self.condition.notify_all()
+
+
+_senders = WeakSet()
+
+
+@atexit.register
+def _flush_on_exit():
+    for sender in list(_senders):
+        sender.flush(timeout=sender.TIMEOUT)
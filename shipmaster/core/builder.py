@@ -1,27 +1,59 @@
 import os
+import json
 import time
 import struct
+import hashlib
+import logging
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from docker import DockerClient
 from docker import constants as docker_constants
-from compose.service import Service, VolumeSpec
+from compose.service import Service
 from compose.service import Container
 from compose.project import Project as ComposeProject
 from requests.packages.urllib3.exceptions import ReadTimeoutError
 from .config import BuildConfig, ImageConfig
-from .script import Archive, Script, SCRIPT_PATH, APP_PATH
+from .script import Archive, Script, SCRIPT_PATH, APP_PATH, context_digest
 from .plugins import Event, PluginManager
+from .timings import TimingStore
+
+logger = logging.getLogger('shipmaster')
+
+
+_DOCKER_CLIENT = None
+
+
+def docker_client():
+    """ Process wide Docker client, so that its connection pool is shared by all builders. """
+    global _DOCKER_CLIENT
+    if _DOCKER_CLIENT is None:
+        _DOCKER_CLIENT = DockerClient('unix://var/run/docker.sock')
+    return _DOCKER_CLIENT
+
+
+class MissingParentImage(Exception):
+    pass
+
+
+class ImageBuildFailed(Exception):
+    pass
+
+
+class ImageRunFailed(Exception):
+    pass
 
 
 class Builder:
 
-    def __init__(self, build_config: BuildConfig, args=None, build_num='0', job_num='0', commit_info=None):
+    def __init__(self, build_config: BuildConfig, args=None, build_num='0', job_num='0', commit_info=None, client=None):
         self.config = build_config
         self.build_num = build_num
         self.commit_info = commit_info
         self.job_num = job_num
-        self.client = DockerClient('unix://var/run/docker.sock')
+        self.client = client or docker_client()
         self.args = args
+        self.editable = getattr(args, 'editable', False)
+        self.timings = TimingStore(build_config.name)
         self.images = self._stage_to_image_builders_mapping()
         self.plugins = PluginManager(self)
 
@@ -29,8 +61,11 @@ class Builder:
         ordered = OrderedDict()
         for stage_name in self.config.stages:
             stage = ordered[stage_name] = OrderedDict()
-            for image_name, image_config in self.config.image_configs.items():
-                if image_config.stage == stage_name:
+            for image_name in self.config.graph.images(stage_name):
+                image_config = self.config.image_configs[image_name]
+                if image_config.matrix:
+                    stage[image_name] = MatrixBuilder(self, image_config)
+                else:
                     stage[image_name] = ImageBuilder(self, image_config)
         return ordered
 
@@ -40,6 +75,72 @@ class Builder:
             for image_builder in image_builders.values():
                 yield image_builder
 
+    def image_builder(self, name):
+        for image_builders in self.images.values():
+            if name in image_builders:
+                return image_builders[name]
+
+    def plan(self, stage, run_all=False, rerun=False, rerun_all=False, rebuild=()):
+        """
+        Works out what needs to be executed to run `stage`, as a list
+        of `(image_builder, modes)` in execution order.
+
+        Parent stages are only built, and only those images in them that
+        `stage` is built from. Images that already exist with a matching
+        cache key are reused unless `rerun` (for `stage`) or `rerun_all`
+        (for `stage` and all of its parents) is set, or they are listed in
+        `rebuild`. Missing parent images are only built with `run_all`,
+        otherwise `MissingParentImage` is raised.
+        """
+        if stage not in self.images:
+            raise ValueError(
+                "Stage '{}' is not one of the available stages: {}"
+                .format(stage, ', '.join(self.images))
+            )
+
+        graph = self.config.graph
+        parents = set()
+        for image_name in graph.images(stage):
+            parents.update(graph.ancestors(image_name))
+
+        plan = []
+        for stage_name, image_builders in self.images.items():
+            if stage_name == stage:
+                for image_name, image_builder in image_builders.items():
+                    modes = list(ImageBuilder.MODES)
+                    if not (rerun or rerun_all or image_name in rebuild) and image_builder.exists():
+                        logger.info('Reusing existing {}.'.format(image_builder.image_name))
+                        modes.remove('build')
+                    plan.append((image_builder, modes))
+                break
+            for image_name, image_builder in image_builders.items():
+                if image_name not in parents:
+                    continue
+                if rerun_all or image_name in rebuild:
+                    plan.append((image_builder, ['build']))
+                elif not image_builder.exists():
+                    if not run_all:
+                        raise MissingParentImage(
+                            "Image '{}' from stage '{}' needs to be built first, use --run-all to build it."
+                            .format(image_name, stage_name)
+                        )
+                    plan.append((image_builder, ['build']))
+        return plan
+
+    def run(self, stage, rebuild=()):
+        """ Executes `stage`, taking the --run-all, --rerun and --rerun-all arguments into account. """
+        plan = self.plan(
+            stage,
+            run_all=getattr(self.args, 'run_all', False),
+            rerun=getattr(self.args, 'rerun', False),
+            rerun_all=getattr(self.args, 'rerun_all', False),
+            rebuild=rebuild,
+        )
+        for image_builder, modes in plan:
+            image_builder.execute(modes)
+            if image_builder.exception:
+                return image_builder.exception
+
     @property
     def test_tag(self):
         return "{}b{}t".format(self.build_num, self.job_num)
@@ -51,6 +152,9 @@ class Builder:
 
 class ImageBuilder:
 
+    # `start` (deploying with docker-compose) is only available on the server
+    MODES = ('build', 'run')
+
     def __init__(self, builder: Builder, image_config: ImageConfig):
         self.builder = builder
         self.client = builder.client
@@ -62,11 +166,64 @@ class ImageBuilder:
         }
 
         self.volumes = image_config.volumes.copy()
+        if builder.editable:
+            # sources are used in place instead of being uploaded,
+            # note that bind mounts are not part of committed images
+            self.volumes.append('{}:{}'.format(builder.config.workspace, APP_PATH))
 
         self.script = None
         self.archive = None
+        self._cache_key = None
 
         self.exception = None
+        self.build_time = None
+
+    @property
+    def image_name(self):
+        """ Local images are named `<project>/<image>`, images without a build step are their parent image. """
+        if not self.config.build:
+            return self.from_image_name
+        return '{}/{}'.format(self.builder.config.name, self.config.name).lower()
+
+    @property
+    def from_image_name(self):
+        parent = self.builder.image_builder(self.config.from_image)
+        if parent:
+            return parent.image_name
+        return self.config.from_image
+
+    @property
+    def cache_key(self):
+        """
+        Hash of everything that goes into building this image, including
+        the contents of its context and the key of the parent image, so that
+        any change up the `from` chain invalidates all of the images built
+        from it. Editable images are built without their context, only its
+        paths count. Computed once per build, the workspace doesn't change
+        meanwhile.
+        """
+        if self._cache_key is None:
+            parent = self.builder.image_builder(self.config.from_image)
+            key = {
+                'from': parent.cache_key if parent else self.config.from_image,
+                'environment': self.environment,
+                'build': self.config.build,
+                'context': self.config.context,
+                'volumes': self.config.volumes,
+                'editable': self.builder.editable,
+            }
+            if not self.builder.editable:
+                key['files'] = context_digest(self.builder.config.workspace, self.config.context)
+            self._cache_key = hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+        return self._cache_key
+
+    def exists(self):
+        if not self.config.build:
+            parent = self.builder.image_builder(self.config.from_image)
+            return parent.exists() if parent else True
+        return bool(self.client.images.list(
+            self.image_name, filters={'label': 'shipmaster-key='+self.cache_key}
+        ))
 
     def ensure_from_image(self):
         image = self.config.from_image
@@ -81,9 +238,7 @@ class ImageBuilder:
         if not self.client.images.list(image):
             self.client.images.pull(image, stream=False)
 
-    def start_and_commit(self, container, cmd, e):
-        client = self.client
-
+    def start_and_wait(self, container, e):
         self.notify(e.before().action('archive_upload'))
         container.put_archive('/', self.archive.getfile())
         self.notify(e.after().action('archive_upload'))
@@ -95,28 +250,34 @@ class ImageBuilder:
             self.notify(output, line.decode().rstrip())
         self.notify(e.after().action('container_start'))
 
-        #result = client.wait(container)
-        result = 1
+        result = container.wait()
+        if isinstance(result, dict):
+            result = result['StatusCode']
+        return result
+
+    def remove(self, container, e):
+        self.notify(e.before().action('container_remove'))
+        container.remove()
+        self.notify(e.after().action('container_remove'))
+
+    def start_and_commit(self, container, cmd, e):
+        result = self.start_and_wait(container, e)
         if result == 0:
             # Only tag image if container was built successfully.
             repository, tag = self.image_name, None
             if ':' in repository:
                 repository, tag = repository.split(':')
-            conf = client.create_container_config(self.image_name, cmd, working_dir=APP_PATH)
+            conf = {'Cmd': cmd, 'WorkingDir': str(APP_PATH), 'Labels': container.labels}
             self.notify(e.before().action('container_commit'))
-            client.commit(container, repository=repository, tag=tag, conf=conf)
+            container.commit(repository=repository, tag=tag, conf=conf)
             self.notify(e.after().action('container_commit'))
-
-        self.notify(e.before().action('container_remove'))
-        container.remove()
-        self.notify(e.after().action('container_remove'))
-
+        self.remove(container, e)
         return result
 
-    def create(self, script, labels=None):
+    def create(self, script, labels=None, image=None, command=None):
         return self.client.containers.create(
-            self.config.from_image, command=['/bin/sh', '-c', str(script.path)],
-            volumes=[v.split(':')[1] for v in self.volumes],
+            image or self.from_image_name, command=['/bin/sh', '-c', command or str(script.path)],
+            volumes=self.volumes,
             environment=self.environment,
             labels=labels or {}
         )
@@ -125,14 +286,22 @@ class ImageBuilder:
         self.builder.plugins.notify(event, self, extra)
 
     def execute(self, modes=None):
-        for mode in (modes or ['build', 'run', 'start']):
+        self.exception = None
+        self.build_time = None
+        for mode in (modes or self.MODES):
             if not getattr(self.config, mode):
                 continue
             step = getattr(self, mode)
             e = Event.mode(mode)
             self.notify(e.before())
+            started = time.time()
             try:
                 step(e)
+                if mode == 'build':
+                    self.build_time = time.time() - started
+                    # matrix cells are not graph nodes, their group records the timing
+                    if self.config.name in self.builder.config.image_configs:
+                        self.builder.timings.record(self.config.name, self.build_time)
                 self.notify(e.after())
             except Exception as exc:
                 self.exception = exc
@@ -151,8 +320,9 @@ class ImageBuilder:
         self.archive = Archive(self.builder.config.workspace)
         self.notify(e.before().action('archive'))
         self.archive.add_script(self.script)
-        for file in self.config.context:
-            self.archive.add_project_file(file)
+        if not self.builder.editable:
+            for file in self.config.context:
+                self.archive.add_project_file(file)
         self.notify(e.after().action('archive'))
 
         build_command = self.builder.plugins.contribute('build_command', self, self.config.build)
@@ -163,47 +333,39 @@ class ImageBuilder:
         if self.builder.commit_info:
             labels = {'git-'+k: v for k, v in self.builder.commit_info.items()}
             labels['shipmaster-build'] = self.builder.build_num
+        labels['shipmaster-image'] = self.config.name
+        labels['shipmaster-key'] = self.cache_key
 
-        return self.start_and_commit(self.create(self.script, labels), ['/bin/sh', '-c', build_command], e)
+        result = self.start_and_commit(self.create(self.script, labels), ['/bin/sh', '-c', build_command], e)
+        if result != 0:
+            raise ImageBuildFailed("Building '{}' exited with status {}.".format(self.config.name, result))
+        return result
 
     def run(self, e):
+        """ Runs the `run` commands in a throwaway container of the built image. """
+        if not self.config.build:
+            # the image is its parent, which may not have been pulled yet
+            self.ensure_from_image()
+
         self.script = Script('run.sh')
         self.notify(e.before().action('script'))
-        self.script.write_all(self.config.build)
+        self.script.write_all(self.config.run)
         self.notify(e.after().action('script'))
-        #, compose: ComposeProject, reports=None
-        logger.info('Running tests in {}...'.format(self.image_name))
-        service = compose.get_service('test')  # type: Service
-        compose.up(service.get_dependency_names())
-        try:
-            return self._run_test_container(service, reports)
-        finally:
-            # Stop and delete containers but don't remove any images
-            compose.down(None, include_volumes=True)
-            # Finally remove just the test image
-            service.remove_image(service.image_name)
-
-    def _run_test_container(self, service, reports):
-
-        if reports:
-            self.volumes.append(
-                "{}:{}".format(reports, os.path.join(APP_PATH, 'reports'))
-            )
 
-        container = service.create_container(
-            one_off=True,
-            volumes=map(VolumeSpec.parse, self.volumes),
-            environment=self.environment,
-        )
-
-        service.start_container(container)
-        for line in container.logs(stream=True):
-            logger.info(line.decode().rstrip())
+        # the image already contains the project files, only the script is uploaded
+        self.archive = Archive(self.builder.config.workspace)
+        self.notify(e.before().action('archive'))
+        self.archive.add_script(self.script)
+        self.notify(e.after().action('archive'))
 
-        result = service.client.wait(container.id)
+        run_command = self.builder.plugins.contribute('run_command', self, str(self.script.path))
+        container = self.create(self.script, image=self.image_name, command=run_command)
+        try:
+            result = self.start_and_wait(container, e)
+        finally:
+            self.remove(container, e)
         if result != 0:
-            logger.error("Test run failed.")
-
+            raise ImageRunFailed("Running '{}' exited with status {}.".format(self.config.name, result))
         return result
 
     def start(self, e):
@@ -266,6 +428,74 @@ class ImageBuilder:
         return read_container_log_for_seconds(container, 10)
 
 
+class MatrixFailed(Exception):
+
+    def __init__(self, failures):
+        super().__init__(
+            "Matrix cells failed: {}".format(', '.join(sorted(failures)))
+        )
+        self.failures = failures
+
+
+class MatrixBuilder:
+    """
+    Builds every cell of an image's `matrix` with its own `ImageBuilder`,
+    at most `parallel` at a time (CPU count by default). Cells report
+    their own events, the group as a whole is reported with the `matrix`
+    events and fails with `MatrixFailed` if any of the cells fail.
+    """
+
+    def __init__(self, builder: Builder, image_config: ImageConfig):
+        self.builder = builder
+        self.config = image_config
+        self.cells = [ImageBuilder(builder, cell) for cell in image_config.cells()]
+        self.exception = None
+
+    @property
+    def max_workers(self):
+        return max(1, min(len(self.cells), self.config.parallel or os.cpu_count() or 1))
+
+    @property
+    def image_name(self):
+        return '{}/{}'.format(self.builder.config.name, self.config.name).lower()
+
+    def exists(self):
+        return all(cell.exists() for cell in self.cells)
+
+    @property
+    def failures(self):
+        return OrderedDict(
+            (cell.config.name, cell.exception)
+            for cell in self.cells if cell.exception
+        )
+
+    def notify(self, event, extra=None):
+        self.builder.plugins.notify(event, self, extra)
+
+    def execute(self, modes=None):
+        self.exception = None
+        e = Event.mode('matrix')
+        self.notify(e.before())
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = [(cell, pool.submit(cell.execute, modes)) for cell in self.cells]
+        for cell, future in futures:
+            try:
+                future.result()
+            except Exception as exc:
+                # raised outside of the cell's steps, by a plugin for instance
+                cell.exception = cell.exception or exc
+        if self.failures:
+            self.exception = MatrixFailed(self.failures)
+            self.notify(e.failed())
+        else:
+            build_times = [cell.build_time for cell in self.cells if cell.build_time is not None]
+            if build_times:
+                # cells build side by side, so the slowest one is what the pipeline waits for
+                self.builder.timings.record(self.config.name, max(build_times))
+            self.notify(e.after())
+        self.notify(e.cleanup())
+
+
 def read_container_log_for_seconds(container, secs):
 
     client = container.client
@@ -1,11 +1,114 @@
 import os
-from collections import namedtuple
+import json
+import hashlib
+from itertools import product
+from types import MappingProxyType
+from tempfile import NamedTemporaryFile
+from collections import namedtuple, OrderedDict
 from ruamel import yaml
+from .script import is_excluded
+
+CACHE_DIR = os.environ.get(
+    'SHIPMASTER_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'shipmaster')
+)
+
+# Configs are only ever read, so round-trip fidelity isn't needed and
+# the libyaml based loader can be used whenever it's available.
+SafeLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+class ConfigCache:
+    """
+    Parsed and validated `.shipmaster.yaml` contents keyed by a hash of the
+    raw file. Entries are kept as JSON, both in memory and on disk, so that a
+    cache hit only costs a digest and a `json.loads()` instead of a YAML parse.
+    """
+
+    MAX_ENTRIES = 128
+    # part of every digest, bump it whenever `compile()` or `BuildConfig.check()`
+    # change so that entries validated by older rules are not used anymore
+    FORMAT = b'3'
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.memory = OrderedDict()
+
+    @classmethod
+    def digest(cls, src: bytes):
+        return hashlib.sha1(cls.FORMAT+b'\0'+src).hexdigest()
+
+    def _disk_path(self, digest):
+        return os.path.join(self.directory, 'config', digest+'.json')
+
+    def _read_disk(self, digest):
+        if not self.directory:
+            return None
+        try:
+            with open(self._disk_path(digest), 'r') as file:
+                return file.read()
+        except OSError:
+            return None
+
+    def _write_disk(self, digest, serialized):
+        if not self.directory:
+            return
+        path = self._disk_path(digest)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with NamedTemporaryFile('w', dir=os.path.dirname(path), delete=False) as file:
+                file.write(serialized)
+            os.replace(file.name, path)
+        except OSError:
+            # cache is an optimization, an unwritable cache dir is not an error
+            pass
+
+    def _remember(self, digest, serialized):
+        self.memory[digest] = serialized
+        self.memory.move_to_end(digest)
+        while len(self.memory) > self.MAX_ENTRIES:
+            self.memory.popitem(last=False)
+
+    @staticmethod
+    def compile(src):
+        """
+        Parse and validate, returning the serialized form of the config.
+        Any problem with the config is raised as a `ValueError`.
+        """
+        try:
+            serialized = json.dumps(yaml.load(src, Loader=SafeLoader) or {}, default=str)
+            BuildConfig.from_kwargs(None, **json.loads(serialized)).check()
+        except yaml.YAMLError as exc:
+            raise ValueError("Invalid YAML: {}".format(exc)) from exc
+        except KeyError as exc:
+            raise ValueError("Missing required setting: {}".format(exc)) from exc
+        except (TypeError, AttributeError) as exc:
+            raise ValueError("Invalid configuration: {}".format(exc)) from exc
+        return serialized
+
+    def load(self, src):
+        """ Returns a fresh kwargs dict for `BuildConfig.from_kwargs()`. """
+        if isinstance(src, str):
+            src = src.encode('utf-8')
+        digest = self.digest(src)
+        serialized = self.memory.get(digest)
+        if serialized is None:
+            serialized = self._read_disk(digest)
+            if serialized is None:
+                serialized = self.compile(src)
+                self._write_disk(digest, serialized)
+            self._remember(digest, serialized)
+        return json.loads(serialized)
+
+    def clear(self):
+        self.memory.clear()
+
+
+config_cache = ConfigCache(CACHE_DIR)
 
 
 class BuildConfig(namedtuple(
         '_BuildConfig',
-        'version name workspace environment branches stages image_configs plugin_configs')):
+        'version name workspace environment branches stages image_configs plugin_configs graph')):
 
     @classmethod
     def from_kwargs(cls, workspace, **kwargs):
@@ -27,36 +130,135 @@ class BuildConfig(namedtuple(
         # all key/values still left in the configuration are plugins
         attrs['plugin_configs'] = kwargs
 
+        attrs['graph'] = ImageGraph(attrs['stages'], attrs['image_configs'])
+
         return cls(**attrs)
 
     @classmethod
     def from_workspace(cls, path):
         filename = os.path.join(path, '.shipmaster.yaml')
-        if not os.path.exists(filename):
+        try:
+            with open(filename, 'rb') as file:
+                src = file.read()
+        except FileNotFoundError:
             return None
-        with open(filename, 'r') as file:
-            return cls.from_kwargs(path, **yaml.load(file, yaml.RoundTripLoader))
+        return cls.from_kwargs(path, **config_cache.load(src))
 
     @classmethod
     def from_string(cls, src):
-        return cls.from_kwargs(None, **yaml.safe_load(src, yaml.RoundTripLoader))
+        return cls.from_kwargs(None, **config_cache.load(src))
 
     def check(self):
-        for image in self.images.values():
+        for image in self.image_configs.values():
             if image.stage and image.stage not in self.stages:
                 raise ValueError(
                     "Stage '{}' for image '{}' is not one of the available stages: {}"
                     .format(image.stage, image.name, ', '.join(self.stages))
                 )
+            if not image.from_image:
+                raise ValueError(
+                    "Image '{}' is missing the 'from' image it should be built from."
+                    .format(image.name)
+                )
+
+        if self.graph.cycle:
+            raise ValueError(
+                "Images form a 'from' cycle: {}".format(', '.join(self.graph.cycle))
+            )
+
+        for image in self.image_configs.values():
+            parent = self.graph.parent(image.name)
+            if parent and self.stages.index(self.image_configs[parent].stage) > self.stages.index(image.stage):
+                raise ValueError(
+                    "Image '{}' in stage '{}' is built from '{}' which is in the later stage '{}'."
+                    .format(image.name, image.stage, parent, self.image_configs[parent].stage)
+                )
+            if parent and self.image_configs[parent].matrix:
+                raise ValueError(
+                    "Image '{}' can't be built from '{}' because it has a build matrix."
+                    .format(image.name, parent)
+                )
+            if not isinstance(image.matrix, dict):
+                raise ValueError(
+                    "Matrix of image '{}' must be a mapping of: {}"
+                    .format(image.name, ', '.join(ImageConfig.MATRIX_AXES))
+                )
+            unknown = set(image.matrix) - set(ImageConfig.MATRIX_AXES)
+            if unknown:
+                raise ValueError(
+                    "Image '{}' has unknown matrix keys: {}; supported keys are: {}"
+                    .format(image.name, ', '.join(sorted(unknown)), ', '.join(ImageConfig.MATRIX_AXES))
+                )
+            from_images = image.matrix.get('from') or []
+            if isinstance(from_images, str):
+                from_images = [from_images]
+            if not isinstance(from_images, list) or not all(isinstance(name, str) for name in from_images):
+                raise ValueError(
+                    "Matrix 'from' of image '{}' must be an image name or a list of them."
+                    .format(image.name)
+                )
+            environments = image.matrix.get('environment') or []
+            if not isinstance(environments, list) or not all(isinstance(env, dict) for env in environments):
+                raise ValueError(
+                    "Matrix 'environment' of image '{}' must be a list of variable mappings."
+                    .format(image.name)
+                )
+            for from_image in from_images:
+                if from_image in self.image_configs:
+                    raise ValueError(
+                        "Matrix of image '{}' can only vary external base images, '{}' is built by shipmaster."
+                        .format(image.name, from_image)
+                    )
+
+    def triggers(self, branch, pull_request=None):
+        """
+        Whether a push to `branch`, or `pull_request` when given, should be
+        built. Triggers are configured in the `build` section:
+
+            build:
+              branches: [master, develop]
+              pull_requests: true
+
+        Top level `branches` and `pull_requests` keys are read as well, the
+        `build` section takes precedence.
+        """
+        section = self.plugin_configs.get('build') or {}
+        if pull_request is not None:
+            return bool(section.get('pull_requests', self.plugin_configs.get('pull_requests', False)))
+        return branch in section.get('branches', self.branches)
+
+    def images_affected_by(self, paths, exclude=()):
+        """
+        Names of the images, in build order, that have to be rebuilt when the
+        workspace relative `paths` change: the images with any of the paths in
+        their `context` and all of their dependents. Paths matching one of the
+        `.dockerignore` style `exclude` patterns are not part of any context.
+        """
+        changed = set()
+        for path in paths:
+            path = os.path.normpath(path)
+            if is_excluded(path, exclude):
+                continue
+            for image in self.image_configs.values():
+                if image.name in changed:
+                    continue
+                for context in image.context:
+                    context = os.path.normpath(context)
+                    if context == '.' or path == context or path.startswith(context+os.sep):
+                        changed.update(self.graph.affected(image.name))
+                        break
+        return tuple(name for name in self.graph.order if name in changed)
 
     def dump(self):
-        for image in self.images:
+        for image in self.image_configs.values():
             print(image)
 
 
 class ImageConfig(namedtuple(
         '_ImageConfig',
-        'name stage from_image environment volumes context build run start plugin_configs')):
+        'name stage from_image environment volumes context build run start matrix parallel plugin_configs')):
+
+    MATRIX_AXES = ('from', 'environment')
 
     @classmethod
     def from_kwargs(cls, name, **kwargs):
@@ -64,8 +266,10 @@ class ImageConfig(namedtuple(
         attrs = {
             'name': name,
             'stage': kwargs.pop('stage', name),
-            'from_image': kwargs.pop('from'),
+            'from_image': kwargs.pop('from', None),
             'environment': kwargs.pop('environment', {}),
+            'matrix': kwargs.pop('matrix', {}),
+            'parallel': kwargs.pop('parallel', None),
         }
 
         for command in ['volumes', 'context', 'build', 'run', 'start']:
@@ -78,3 +282,103 @@ class ImageConfig(namedtuple(
         attrs['plugin_configs'] = kwargs
 
         return cls(**attrs)
+
+    def cells(self):
+        """
+        Expands the `matrix` into one image config per combination of its
+        `from` images and `environment` variable sets, named `<image>-<n>`.
+        """
+        if not self.matrix:
+            return [self]
+        from_images = self.matrix.get('from') or [self.from_image]
+        if isinstance(from_images, str):
+            from_images = [from_images]
+        environments = self.matrix.get('environment') or [{}]
+        return [
+            self._replace(
+                name='{}-{}'.format(self.name, number),
+                from_image=from_image,
+                environment={**self.environment, **environment},
+                matrix={}
+            )
+            for number, (from_image, environment)
+            in enumerate(product(from_images, environments), start=1)
+        ]
+
+
+class ImageGraph:
+    """
+    Immutable index of how the images of a `BuildConfig` depend on each other
+    through their `from` images, computed once when the config is loaded.
+
+    Only images built by shipmaster are nodes, external base images are not.
+    Images that are part of a `from` cycle are left out of `order` and listed
+    in `cycle` instead, `BuildConfig.check()` reports them.
+    """
+
+    def __init__(self, stages, image_configs):
+        stage_images = OrderedDict((stage, []) for stage in stages)
+        parents = {}
+        children = OrderedDict((name, []) for name in image_configs)
+        for name, image in image_configs.items():
+            stage_images.setdefault(image.stage, []).append(name)
+            parent = image.from_image if image.from_image in image_configs else None
+            parents[name] = parent
+            if parent:
+                children[parent].append(name)
+
+        # every image has at most one parent, so walking down from
+        # the root images yields a topological order
+        order = [name for name in image_configs if parents[name] is None]
+        for name in order:
+            order.extend(children[name])
+
+        # each image affects itself and everything built on top of it
+        affected = {}
+        for name in reversed(order):
+            below = [name]
+            for child in children[name]:
+                below.extend(affected[child])
+            affected[name] = below
+        position = {name: i for i, name in enumerate(order)}
+
+        ancestors = {}
+        for name in order:
+            parent = parents[name]
+            ancestors[name] = ancestors[parent] + (parent,) if parent else ()
+
+        self.order = tuple(order)
+        self.cycle = tuple(name for name in image_configs if name not in position)
+        self.stages = MappingProxyType(OrderedDict(
+            (stage, tuple(names)) for stage, names in stage_images.items()
+        ))
+        self._parents = MappingProxyType(parents)
+        self._children = MappingProxyType({name: tuple(names) for name, names in children.items()})
+        self._ancestors = MappingProxyType(ancestors)
+        self._affected = MappingProxyType({
+            name: tuple(sorted(names, key=position.get)) for name, names in affected.items()
+        })
+
+    def images(self, stage):
+        """ Names of the images built in `stage`. """
+        return self.stages.get(stage, ())
+
+    def parent(self, image):
+        """ Name of the image `image` is built from, `None` for external images. """
+        return self._parents.get(image)
+
+    def children(self, image):
+        """ Images built directly from `image`. """
+        return self._children.get(image, ())
+
+    def ancestors(self, image):
+        """ Parent chain of `image`, root first. """
+        return self._ancestors.get(image, ())
+
+    def affected(self, image):
+        """ What must rebuild if `image` changes: itself and all of its dependents, in build order. """
+        return self._affected.get(image, ())
+
+    def dependents(self, image):
+        """ All images transitively built from `image`, in build order. """
+        return self.affected(image)[1:]
@@ -5,7 +5,7 @@ from pathlib import Path
 
 class Event:
     phases = ["before", "after", "failed", "cleanup"]
-    modes = ["build", "run", "start"]
+    modes = ["build", "run", "start", "matrix"]
     actions = [
         "script", "archive", "archive_upload",
         "container_start", "container_commit", "container_remove",
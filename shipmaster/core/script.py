@@ -1,5 +1,6 @@
 import os
 import io
+import hashlib
 import logging
 from pathlib import PurePath
 from fnmatch import fnmatch
@@ -12,6 +13,58 @@ SCRIPT_PATH = PurePath('/shipmaster/scripts/')
 APP_PATH = PurePath('/app')
 
 
+def read_dockerignore(workspace):
+    """ Exclude patterns from the `.dockerignore` file of `workspace`, if there is one. """
+    exclude_patterns = os.path.join(workspace, '.dockerignore')
+    if os.path.exists(exclude_patterns):
+        with open(exclude_patterns, 'r') as patterns:
+            return parse_dockerignore(patterns.read())
+    return []
+
+
+def parse_dockerignore(src):
+    """ Exclude patterns from the contents of a `.dockerignore` file. """
+    return [pattern.strip() for pattern in src.splitlines() if pattern.strip()]
+
+
+def is_excluded(relative, exclude):
+    """ Whether the workspace `relative` path matches any of the `exclude` patterns. """
+    for pattern in exclude:
+        if fnmatch(relative, pattern):
+            return True
+    return False
+
+
+def context_digest(workspace, paths):
+    """
+    Hash of the names and contents of the files `Archive.add_project_file()`
+    uploads for the workspace relative `paths`, `.dockerignore` exclusions
+    left out the same way.
+    """
+    exclude = read_dockerignore(workspace)
+    digest = hashlib.sha1()
+
+    def add(path):
+        relative = os.path.relpath(path, workspace)
+        if is_excluded(relative, exclude):
+            return
+        digest.update(relative.encode()+b'\0')
+        if os.path.islink(path):
+            digest.update(b'link:'+os.readlink(path).encode()+b'\0')
+        elif os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                add(os.path.join(path, name))
+        elif os.path.isfile(path):
+            digest.update(b'file:%d\0' % os.stat(path).st_mode)
+            with open(path, 'rb') as file:
+                for chunk in iter(lambda: file.read(64 * 1024), b''):
+                    digest.update(chunk)
+
+    for path in sorted(paths):
+        add(os.path.normpath(os.path.join(workspace, path)))
+    return digest.hexdigest()
+
+
 class Script:
     def __init__(self, name, set_dash_x=True):
         self.path = SCRIPT_PATH / name
@@ -68,13 +121,7 @@ class Archive:
         self.archive = TarFile.open(mode='w', fileobj=self.archive_file)
         self._closed = False
 
-        self.exclude = []
-        exclude_patterns = os.path.join(workspace, '.dockerignore')
-        if os.path.exists(exclude_patterns):
-            with open(exclude_patterns, 'r') as patterns:
-                for pattern in patterns.readlines():
-                    if pattern:
-                        self.exclude.append(pattern.strip())
+        self.exclude = read_dockerignore(workspace)
 
     def add_script(self, script: Script):
         assert not self._closed
@@ -87,10 +134,9 @@ class Archive:
     def _filter_git(self, info):
         abspath = os.path.join('/', info.name)
         relative = os.path.relpath(abspath, APP_PATH)
-        for pattern in self.exclude:
-            if fnmatch(relative, pattern):
-                logger.debug('excluding '+relative)
-                return None
+        if is_excluded(relative, self.exclude):
+            logger.debug('excluding '+relative)
+            return None
         return info
 
     def add_project_file(self, path):
@@ -0,0 +1,58 @@
+import os
+import json
+import threading
+from tempfile import NamedTemporaryFile
+from .config import CACHE_DIR
+
+
+class TimingStore:
+    """
+    Most recent build durations, in seconds, of each image of a project.
+    Kept as a small JSON file per project in the shipmaster cache directory.
+    """
+
+    HISTORY = 10
+
+    def __init__(self, project, directory=CACHE_DIR):
+        self.path = os.path.join(directory, 'timings', project+'.json') if directory else None
+        self.lock = threading.Lock()
+
+    def load(self):
+        if not self.path:
+            return {}
+        try:
+            with open(self.path, 'r') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def record(self, image, seconds):
+        if not self.path:
+            return
+        with self.lock:
+            timings = self.load()
+            history = timings.setdefault(image, [])
+            history.append(round(seconds, 3))
+            del history[:-self.HISTORY]
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                with NamedTemporaryFile('w', dir=os.path.dirname(self.path), delete=False) as file:
+                    json.dump(timings, file)
+                os.replace(file.name, self.path)
+            except OSError:
+                pass
+
+
+def critical_path(graph, durations):
+    """
+    Longest chain of `from` dependencies weighted by `durations`, returned
+    as `(images, seconds)`. Images without a known duration count as zero.
+    """
+    finish = {}
+    for image in graph.order:
+        parent = graph.parent(image)
+        finish[image] = durations.get(image, 0) + (finish[parent] if parent else 0)
+    if not finish:
+        return (), 0
+    last = max(graph.order, key=lambda image: finish[image])
+    return graph.ancestors(last) + (last,), finish[last]
@@ -1,4 +1,6 @@
+import json
 from shipmaster.core.plugins import Plugin, Platform
+from shipmaster.core.timings import TimingStore, critical_path
 
 
 class GraphPlugin(Plugin):
@@ -10,19 +12,91 @@ class GraphPlugin(Plugin):
     @classmethod
     def contribute_to_argparse(cls, parser, commands):
         graph = parser.add_parser('graph', help="Show the graph.")
+        graph.add_argument(
+            '--format', choices=['text', 'dot', 'json'], default='text',
+            help="Draw the graph as text or export it as DOT or JSON."
+        )
         graph.set_defaults(command=print_graph)
 
 
+def format_seconds(seconds):
+    if seconds >= 59.95:  # would be shown as 60.0s
+        return "{}m{:02d}s".format(*divmod(int(round(seconds)), 60))
+    return "{:.1f}s".format(seconds)
+
+
+def graph_data(config):
+    """ Images with their recent build durations and the critical path through the `from` graph. """
+    timings = TimingStore(config.name).load()
+    averages = {image: sum(history) / len(history) for image, history in timings.items() if history}
+    path, seconds = critical_path(config.graph, averages)
+    return {
+        'name': config.name,
+        'stages': {stage: list(config.graph.images(stage)) for stage in config.stages},
+        'images': {
+            image: {
+                'stage': config.image_configs[image].stage,
+                'from': config.image_configs[image].from_image,
+                'durations': timings.get(image, []),
+                'average': averages.get(image),
+                'critical': image in path,
+            } for image in config.graph.order
+        },
+        'critical_path': list(path),
+        'critical_seconds': seconds,
+    }
+
+
 def print_graph(args, config):
+    data = graph_data(config)
+    output_format = getattr(args, 'format', 'text')
+    if output_format == 'json':
+        print(json.dumps(data, indent=2))
+    elif output_format == 'dot':
+        print(format_dot(data))
+    else:
+        print_columns(data, config)
+
+
+def format_dot(data):
+    lines = ['digraph "{}" {{'.format(data['name']), '  rankdir=LR;', '  node [shape=box];']
+    for stage, images in data['stages'].items():
+        lines.append('  subgraph "cluster_{}" {{'.format(stage))
+        lines.append('    label="{}";'.format(stage))
+        for name in images:
+            image = data['images'].get(name)
+            if image is None:
+                continue
+            label = name
+            if image['average'] is not None:
+                label += '\\n' + format_seconds(image['average'])
+            style = ' color=red penwidth=2' if image['critical'] else ''
+            lines.append('    "{}" [label="{}"{}];'.format(name, label, style))
+        lines.append('  }')
+    for name, image in data['images'].items():
+        if image['from'] in data['images']:
+            style = ''
+            if image['critical'] and data['images'][image['from']]['critical']:
+                style = ' [color=red penwidth=2]'
+            lines.append('  "{}" -> "{}"{};'.format(image['from'], name, style))
+    lines.append('}')
+    return '\n'.join(lines)
+
+
+def print_columns(data, config):
     columns = []
     max_rows = 0
     for stage in config.stages:
         rows = []
         max_width = len(stage)
-        for image in config.image_configs.values():
-            if image.stage == stage:
-                rows.append(image.name)
-                max_width = max(max_width, len(image.name))
+        for image in config.graph.images(stage):
+            info = data['images'].get(image, {})
+            if info.get('average') is not None:
+                image += ' ' + format_seconds(info['average'])
+            if info.get('critical'):
+                image += ' *'
+            rows.append(image)
+            max_width = max(max_width, len(image))
         max_rows = max(max_rows, len(rows))
         columns.append((stage, max_width, rows))
 
@@ -56,4 +130,9 @@ def print_graph(args, config):
             else:
                 row += draw_column(i, " ", " "*(width+6))
         print(row)
+
+    if data['critical_seconds']:
+        print("* critical path: {} ({})".format(
+            ' -> '.join(data['critical_path']), format_seconds(data['critical_seconds'])
+        ))
     print()
@@ -12,6 +12,14 @@ class LogPlugin(Plugin):
     def before_build(self, b):
         logger.info('BUILDING {} FROM {}'.format(b.config.name, b.config.from_image))
 
+    def before_matrix(self, m):
+        logger.info('BUILDING {} MATRIX OF {} CELLS, {} AT A TIME'.format(
+            m.config.name, len(m.cells), m.max_workers
+        ))
+
+    def failed_matrix(self, m):
+        logger.error(str(m.exception))
+
     def before_archive_upload(self, b):
         logger.info('Uploading...')
 
@@ -1,16 +1,123 @@
-from shipmaster.core.plugins import Plugin
+import time
+import logging
+import threading
+
+import requests
+
+from shipmaster.core.background import BackgroundSender
+from shipmaster.core.plugins import Plugin, Platform
+
+logger = logging.getLogger('shipmaster')
 
 
 class SlackPlugin(Plugin):
-    pass
+    """
+    Server side Slack notifications, configured in the `slack` section of `.shipmaster.yaml`:
+
+        slack:
+          api: https://hooks.slack.com/services/...
+          events: [build.failure, deployment.success]
+          window: 5
+
+    Notifications for the same webhook arriving within `window` seconds of
+    each other are posted as a single digest message.
+    """
+
+    @classmethod
+    def should_load(cls, platform):
+        return platform == Platform.server
 
 
 class SlackConf:
+
+    WINDOW = 5  # seconds
+
     def __init__(self, conf, slack):
         self.conf = conf
         self.api = slack.get('api')
         self.events = slack.get('events', [])
+        self.window = float(slack.get('window', self.WINDOW))
+
+    @classmethod
+    def from_build_config(cls, config):
+        return cls(config, config.plugin_configs.get('slack', {}) if config else {})
 
     @property
     def is_enabled(self):
         return self.api is not None
+
+    def wants(self, event):
+        # if no filters then send for all events, otherwise only for allowed events
+        return self.is_enabled and (not self.events or event in self.events)
+
+
+class SlackNotifier(BackgroundSender):
+    """
+    Posts notifications from a background thread over one pooled HTTP session.
+
+    The first notification for a webhook opens a batch which stays open for
+    the configured window, anything else for that webhook arriving in the
+    meantime (many test jobs finishing together) joins the same message.
+    Failed posts are retried with backoff, together with whatever was
+    queued for the webhook in the meantime.
+    """
+
+    RETRIES = 3
+    BACKOFF = 1  # seconds, doubled after every failed attempt
+
+    def __init__(self):
+        super().__init__('slack')
+        self.session = requests.Session()
+
+    def notify(self, conf: SlackConf, source, message):
+        """ Queues a message and returns immediately. """
+        with self.condition:
+            if conf.api in self.pending:
+                self.pending[conf.api][1][0].append((source, message))
+            else:
+                self.queue(conf.api, [[(source, message)], 0], due_at=time.time() + conf.window)
+
+    def flush(self, timeout=None):
+        """ Sends open batches right away and waits for them, returns `False` on timeout. """
+        with self.condition:
+            for batch in self.pending.values():
+                batch[0] = 0
+            self.condition.notify()
+        return super().flush(timeout)
+
+    @staticmethod
+    def format(notifications):
+        if len(notifications) == 1:
+            return notifications[0][1]
+        lines = ["{} updates:".format(len(notifications))]
+        lines.extend("• {}: {}".format(source, message) for source, message in notifications)
+        return "\n".join(lines)
+
+    def send(self, api, batch):
+        notifications, attempts = batch
+        try:
+            self.session.post(api, json={'text': self.format(notifications)}, timeout=self.TIMEOUT).raise_for_status()
+        except requests.RequestException as exc:
+            batch[1] = attempts = attempts + 1
+            if attempts >= self.RETRIES:
+                logger.error('Failed to post {} Slack notification(s): {}'.format(len(notifications), exc))
+                return
+            with self.condition:
+                if api in self.pending:
+                    # a newer batch opened meanwhile, it takes these along
+                    self.pending[api][1][0][:0] = notifications
+                    return
+            return time.time() + self.BACKOFF * 2 ** (attempts - 1)
+
+
+_notifier = None
+_notifier_lock = threading.Lock()
+
+
+def get_notifier():
+    """ One notifier per process, created on first use. """
+    global _notifier
+    with _notifier_lock:
+        if _notifier is None:
+            _notifier = SlackNotifier()
+        return _notifier
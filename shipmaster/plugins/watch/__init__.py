@@ -0,0 +1 @@
+plugin_class = "shipmaster.plugins.watch.watch.WatchPlugin"
\ No newline at end of file
@@ -0,0 +1,235 @@
+import os
+import sys
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+from shipmaster.core.plugins import Plugin, Platform
+from shipmaster.core.builder import Builder, MissingParentImage
+from shipmaster.core.config import BuildConfig
+from shipmaster.core.script import read_dockerignore, is_excluded
+
+logger = logging.getLogger('shipmaster')
+
+CONFIG_FILES = ('.shipmaster.yaml', '.dockerignore')
+
+
+class WatchPlugin(Plugin):
+
+    @classmethod
+    def should_load(cls, platform):
+        return platform == Platform.cli
+
+    @classmethod
+    def contribute_to_argparse(cls, parser, commands):
+        watch = parser.add_parser('watch', help="Rebuild a stage whenever its sources change.")
+        watch.add_argument('stage', help="Stage to build.")
+        watch.add_argument(
+            '--debounce', type=float, default=0.5,
+            help="Seconds without changes to wait for before rebuilding."
+        )
+        watch.set_defaults(command=watch_command, run_all=True)
+
+
+class Inotify:
+    """ Minimal ctypes binding of the Linux inotify API. """
+
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.directories = {}
+
+    def watch(self, directory):
+        wd = self._add_watch(self.fd, os.fsencode(directory), self.MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), directory)
+        self.directories[wd] = directory
+
+    def read(self, timeout):
+        """ Paths changed within `timeout` seconds, waits indefinitely if `timeout` is `None`. """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        paths = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = data[offset:offset+length].rstrip(b'\0')
+            offset += length
+            if wd in self.directories:
+                paths.append(os.path.join(self.directories[wd], os.fsdecode(name)))
+        return paths
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Poller:
+    """ Fallback for platforms without inotify, compares modification times of directory entries. """
+
+    INTERVAL = 1.0
+
+    def __init__(self):
+        self.snapshot = {}
+
+    @staticmethod
+    def _scan(directory):
+        try:
+            return {entry.path: entry.stat().st_mtime_ns for entry in os.scandir(directory)}
+        except OSError:
+            return {}
+
+    def watch(self, directory):
+        self.snapshot[directory] = self._scan(directory)
+
+    def read(self, timeout):
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            time.sleep(self.INTERVAL if deadline is None else max(0, min(self.INTERVAL, deadline - time.time())))
+            paths = []
+            for directory, before in self.snapshot.items():
+                after = self.snapshot[directory] = self._scan(directory)
+                paths.extend(path for path in before.keys() | after.keys() if before.get(path) != after.get(path))
+            if paths or (deadline is not None and time.time() >= deadline):
+                return paths
+
+    def close(self):
+        pass
+
+
+class Watcher:
+    """
+    Watches the `context` of every image in a config, skipping `.dockerignore`
+    matches, and collects bursts of changes into one set of workspace paths.
+    """
+
+    def __init__(self, config: BuildConfig, debounce):
+        self.workspace = config.workspace
+        self.debounce = debounce
+        try:
+            self.backend = Inotify()
+        except (OSError, AttributeError):
+            logger.info('inotify is not available, polling for changes instead.')
+            self.backend = Poller()
+        self.watched = set()
+        self.exclude = []
+        self.update(config)
+
+    def update(self, config: BuildConfig):
+        self.exclude = read_dockerignore(self.workspace)
+        self._watch(self.workspace, recursive=False)
+        for image in config.image_configs.values():
+            for context in image.context:
+                path = os.path.normpath(os.path.join(self.workspace, context))
+                if os.path.isdir(path):
+                    self._watch(path, recursive=True)
+                elif os.path.isdir(os.path.dirname(path)):
+                    self._watch(os.path.dirname(path), recursive=False)
+
+    def _relative(self, path):
+        return os.path.relpath(path, self.workspace)
+
+    def _ignored(self, path):
+        relative = self._relative(path)
+        return relative.split(os.sep)[0] == '.git' or is_excluded(relative, self.exclude)
+
+    def _watch(self, directory, recursive):
+        for root, dirs, files in os.walk(directory):
+            if root not in self.watched and (root == self.workspace or not self._ignored(root)):
+                self.backend.watch(root)
+                self.watched.add(root)
+            if not recursive:
+                break
+            dirs[:] = [d for d in dirs if not self._ignored(os.path.join(root, d))]
+
+    def _read(self, timeout):
+        changed = set()
+        for path in self.backend.read(timeout):
+            if os.path.isdir(path) and not self._ignored(path):
+                self._watch(path, recursive=True)
+            if not self._ignored(path):
+                changed.add(self._relative(path))
+        return changed
+
+    def wait(self):
+        """ Blocks until something changes, returns once no changes came in for `debounce` seconds. """
+        changed = set()
+        while not changed:
+            changed = self._read(None)
+        while True:
+            more = self._read(self.debounce)
+            if not more:
+                return changed
+            changed.update(more)
+
+    def close(self):
+        self.backend.close()
+
+
+def watch_command(args, config):
+    if config is None:
+        sys.exit("No .shipmaster.yaml found in {}".format(os.getcwd()))
+
+    # the builder, and with it the docker client, is kept for as long
+    # as the config stays the same, only the affected images are rebuilt
+    builder = Builder(config, args, commit_info={})
+    watcher = Watcher(config, args.debounce)
+    rebuild = ()
+    try:
+        while True:
+            try:
+                failure = builder.run(args.stage, rebuild)
+            except (MissingParentImage, ValueError) as exc:
+                failure = exc
+            if failure:
+                logger.error(str(failure))
+            logger.info('Watching for changes...')
+
+            rebuild = None
+            while rebuild is None:
+                changed = watcher.wait()
+                if any(path in CONFIG_FILES for path in changed):
+                    # half edited configs are normal here, keep watching until they are fixed
+                    try:
+                        reloaded = BuildConfig.from_workspace(config.workspace)
+                    except ValueError as exc:
+                        logger.error('Invalid .shipmaster.yaml, waiting for changes: {}'.format(exc))
+                        continue
+                    if reloaded is None:
+                        logger.error('.shipmaster.yaml is missing, waiting for changes.')
+                        continue
+                    config = reloaded
+                    builder = Builder(config, args, commit_info={}, client=builder.client)
+                    watcher.update(config)
+                    # cache keys take care of images whose config changed
+                    rebuild = config.images_affected_by(changed, watcher.exclude)
+                else:
+                    rebuild = config.images_affected_by(changed, watcher.exclude) or None
+                    if rebuild is None:
+                        logger.info('Changes did not affect any image: {}'.format(', '.join(sorted(changed))))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
@@ -1,4 +1,6 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
+from celery.signals import task_prerun, task_postrun, task_revoked, worker_ready, worker_shutdown
 
 
 class ShipmasterConfig(AppConfig):
@@ -9,3 +11,13 @@ class ShipmasterConfig(AppConfig):
         # Do django monkeypatches
         from .hacks import monkeypatch_django
         monkeypatch_django()
+
+        from .index import enable_sqlite_wal
+        connection_created.connect(enable_sqlite_wal)
+
+        from . import scheduler
+        task_prerun.connect(scheduler.task_started, weak=False)
+        task_postrun.connect(scheduler.task_finished, weak=False)
+        task_revoked.connect(scheduler.task_finished, weak=False)
+        worker_ready.connect(scheduler.worker_ready, weak=False)
+        worker_shutdown.connect(scheduler.worker_shutdown, weak=False)
@@ -1,7 +1,20 @@
 import os
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'shipmaster.server.settings')
 from celery import Celery
+from celery.signals import celeryd_after_setup
 from django.conf import settings
+from kombu import Queue
 app = Celery('shipmaster.server')
 app.config_from_object(settings)
 app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
+
+
+def host_queue(host):
+    """ Queue consumed only by the workers of `host`, see `scheduler.dispatch()`. """
+    name = 'host.{}'.format(host)
+    return Queue(name, routing_key=name, queue_arguments={'x-max-priority': 10})
+
+
+@celeryd_after_setup.connect
+def consume_host_queue(sender, instance, **kwargs):
+    instance.app.amqp.queues.select_add(host_queue(settings.SHIPMASTER_HOST))
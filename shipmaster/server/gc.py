@@ -0,0 +1,260 @@
+import os
+import time
+import shutil
+import logging
+from datetime import timedelta
+from collections import namedtuple
+
+from django.conf import settings
+from django.utils import timezone
+from docker.errors import APIError
+
+from .index import BuildRecord, JobRecord
+from .scheduler import prune as prune_scheduled_tasks
+from .models import Build, BaseJob
+
+logger = logging.getLogger('shipmaster')
+
+# webhooks are not redelivered after this long, see Repository.claim_commit()
+COMMIT_MARKER_DAYS = 7
+
+
+class RetentionPolicy(namedtuple('_RetentionPolicy', 'keep_last keep_days keep_deployed')):
+    """
+    Which builds of a repository survive garbage collection, a build is
+    kept when any of these applies:
+
+        keep_last: it is one of the N most recent builds
+        keep_days: it changed state within the last N days
+        keep_deployed: it is the most recent successful deployment to a destination
+
+    Defaults come from the `SHIPMASTER_RETENTION` setting and can be
+    overridden per repository with a `retention` section in its `config.yaml`.
+    """
+
+    @classmethod
+    def for_repository(cls, repo):
+        policy = dict(settings.SHIPMASTER_RETENTION)
+        policy.update(repo.dict.get('retention', {}))
+        return cls(**policy)
+
+
+class Report(namedtuple('_Report', 'repo kept protected removed freed usage')):
+    """
+    Outcome of collecting one repository, sizes are in bytes. `protected`
+    are the kept builds which are running, newest, deployed or whose images
+    are reused by a kept skipped build.
+    """
+
+
+def disk_usage(path):
+    """ Bytes allocated on disk below `path`, hard links are only counted once. """
+    seen = set()
+    total = 0
+    stack = [path]
+    while stack:
+        try:
+            entries = list(os.scandir(stack.pop()))
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                stat = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            if (stat.st_dev, stat.st_ino) in seen:
+                continue
+            seen.add((stat.st_dev, stat.st_ino))
+            total += stat.st_blocks * 512
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+    return total
+
+
+def last_activity(build):
+    """ Time of the build's most recent state transition. """
+    if build.journal.events:
+        return build.journal.events[-1][0]
+    return os.stat(build.path.absolute).st_mtime
+
+
+def protected_builds(repo):
+    """ Builds which must never be collected: the newest one and those still running. """
+    protected = set(BuildRecord.objects.filter(
+        repo=repo.name, result__in=[Build.QUEUED, Build.CLONING, Build.BUILDING]
+    ).values_list('number', flat=True))
+    protected.update(JobRecord.objects.filter(
+        repo=repo.name, result__in=[BaseJob.QUEUED, BaseJob.RUNNING]
+    ).values_list('build', flat=True))
+    newest = repo.query_builds().values_list('number', flat=True).first()
+    if newest is not None:
+        protected.add(newest)
+    return protected
+
+
+def reused_builds(repo, numbers):
+    """ Builds whose images still apply to the skipped builds among `numbers`. """
+    reused = set()
+    for number in BuildRecord.objects.filter(
+            repo=repo.name, number__in=numbers, result=Build.SKIPPED
+    ).values_list('number', flat=True):
+        try:
+            skipped = Build.load(repo, str(number)).skipped
+        except OSError:
+            continue
+        if skipped:
+            reused.add(int(skipped['previous']))
+    return reused
+
+
+def deployed_builds(repo):
+    """ The build most recently deployed successfully to each destination. """
+    deployed = {}
+    for record in JobRecord.objects.filter(
+            repo=repo.name, job_type='deployment', result=BaseJob.SUCCEEDED
+    ).order_by('-build', '-number'):
+        deployed.setdefault(record.destination, record.build)
+    return set(deployed.values())
+
+
+def collect_repository(repo, policy=None, now=None, dry_run=False):
+    """
+    Removes the builds of `repo` not retained by `policy`, workspace, logs,
+    reports and index records included. Returns a `Report` and the
+    `(commit hash, build number)` keys of the removed builds' images.
+    """
+    policy = policy or RetentionPolicy.for_repository(repo)
+    now = now or time.time()
+    numbers = list(repo.query_builds().values_list('number', flat=True))
+
+    protected = protected_builds(repo)
+    if policy.keep_deployed:
+        protected |= deployed_builds(repo)
+    keep = protected | set(numbers[:policy.keep_last])
+    if policy.keep_days:
+        keep.update(
+            number for number in numbers
+            if number not in keep and now - last_activity(Build(repo, str(number))) < policy.keep_days * 86400
+        )
+    # skipped builds rely on the images of the build they point at
+    reused = reused_builds(repo, keep)
+    protected |= reused
+    keep |= reused
+
+    kept, removed, image_keys, freed = [], [], set(), 0
+    for number in numbers:
+        if number in keep:
+            kept.append(number)
+            continue
+        build = Build(repo, str(number))
+        commit = yaml_commit(build)
+        size = disk_usage(build.path.absolute)
+        if not dry_run:
+            shutil.rmtree(build.path.absolute, ignore_errors=True)
+            BuildRecord.objects.filter(repo=repo.name, number=number).delete()
+            JobRecord.objects.filter(repo=repo.name, build=number).delete()
+        removed.append(number)
+        freed += size
+        if commit:
+            image_keys.add((commit, str(number)))
+
+    if not dry_run:
+        prune_commit_markers(repo, now - COMMIT_MARKER_DAYS * 86400)
+
+    usage = disk_usage(repo.path.absolute)
+    if not dry_run:
+        repo.dict['disk_usage'] = usage
+        repo.save()
+    return Report(repo.name, kept, protected, removed, freed, usage), image_keys
+
+
+def prune_commit_markers(repo, before):
+    try:
+        entries = list(os.scandir(repo.path.commits))
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        try:
+            if entry.stat().st_mtime < before:
+                os.remove(entry.path)
+        except OSError:
+            continue
+
+
+def yaml_commit(build):
+    try:
+        return Build.load(build.repo, build.number).dict.get('commit', {}).get('hash')
+    except OSError:
+        return None
+
+
+def image_key(image):
+    labels = image.labels or {}
+    return labels.get('git-hash'), labels.get('shipmaster-build')
+
+
+def collect_images(client, removed_keys, protected_keys=(), budget=None, dry_run=False):
+    """
+    Removes images labeled by shipmaster builds, least recently used first:
+    every image of a removed build and, while the images take up more than
+    `budget` bytes, the images of any other build not in `protected_keys`.
+    An image was last used when it, or the most recent container started
+    from it, was created. Returns the number of bytes freed.
+    """
+    images = client.images.list(filters={'label': 'shipmaster-build'})
+    last_used = {image.id: image.attrs['Created'][:19] for image in images}
+    for container in client.containers.list(all=True):
+        image_id = container.attrs.get('Image')
+        if image_id in last_used:
+            last_used[image_id] = max(last_used[image_id], container.attrs['Created'][:19])
+
+    total = sum(image.attrs.get('Size', 0) for image in images)
+    freed = 0
+    candidates = sorted(
+        (image for image in images if image_key(image) not in protected_keys),
+        key=lambda image: (image_key(image) not in removed_keys, last_used[image.id])
+    )
+    # parents can only be removed once their children are gone, retry those
+    progress = True
+    while candidates and progress:
+        progress, skipped = False, []
+        for image in candidates:
+            if image_key(image) not in removed_keys and (budget is None or total - freed <= budget):
+                break
+            try:
+                if not dry_run:
+                    client.images.remove(image.id)
+            except APIError as exc:
+                logger.debug('Could not remove image {}: {}'.format(image.short_id, exc))
+                skipped.append(image)
+                continue
+            freed += image.attrs.get('Size', 0)
+            progress = True
+        candidates = skipped
+    return freed
+
+
+def collect_garbage(shipmaster, client=None, dry_run=False):
+    """ Applies the retention policy of every repository, then collects their images. """
+    reports, removed_keys, protected_keys = [], set(), set()
+    if not dry_run:
+        prune_scheduled_tasks(timezone.now() - timedelta(days=1))
+    for repo in shipmaster.repositories:
+        if repo.is_infrastructure:
+            continue
+        report, keys = collect_repository(repo, dry_run=dry_run)
+        reports.append(report)
+        removed_keys |= keys
+        for number in report.protected:
+            commit = yaml_commit(Build(repo, str(number)))
+            if commit:
+                protected_keys.add((commit, str(number)))
+        logger.info('{}: kept {} builds, removed {} ({} bytes), using {} bytes'.format(
+            repo.name, len(report.kept), len(report.removed), report.freed, report.usage))
+    images_freed = 0
+    if client is not None:
+        images_freed = collect_images(
+            client, removed_keys, protected_keys,
+            budget=settings.SHIPMASTER_IMAGE_BUDGET, dry_run=dry_run
+        )
+    return reports, images_freed
@@ -8,8 +8,7 @@ from django.conf import settings
 from django.contrib.auth import login
 from django.core.exceptions import PermissionDenied
 
-from shipmaster.base.config import ProjectConf
-from .models import Repository, Build
+from .tasks import intake_event
 from .user import User
 
 
@@ -94,36 +93,39 @@ class GitHubEventView(WebHookView):
 
     def pull_request(self, payload, request):
         if payload['action'] in ['opened', 'synchronize']:
-            base = payload['pull_request']['base']
-            branch = base['ref'].split('/')[-1]
-            sha = base['sha']
-            number = payload['number']
-            self.maybe_build(
-                request, payload['repository']['full_name'],
-                branch, sha, number
+            pull_request = payload['pull_request']
+            intake_event.delay(
+                payload['repository']['name'],
+                pull_request['base']['ref'].split('/')[-1],
+                pull_request['base']['sha'],
+                pull_request['head']['sha'],
+                payload['number']
             )
         return {'status': 'received'}
 
     def push(self, payload, request):
-        branch = payload['ref'].split('/')[-1]
-        sha = payload['after']
-        self.maybe_build(
-            request, payload['repository']['full_name'],
-            branch, sha
-        )
+        if not payload.get('deleted'):
+            intake_event.delay(
+                payload['repository']['name'],
+                payload['ref'].split('/')[-1],
+                payload['after'],
+                payload['after'],
+                changed=self.changed_paths(payload),
+                before=payload['before']
+            )
         return {'status': 'received'}
 
-    @staticmethod
-    def maybe_build(request, full_name, branch, sha, pull=None):
-        account_name, repo_name = full_name.split('/')
-
-        repo = Repository.load(request.shipmaster, repo_name)
-        github = repo.get_github()
-
-        yaml_contents = github.file_contents('.shipmaster.yaml', sha)
-        if yaml_contents:
-            yaml_src = yaml_contents.decoded.decode('utf-8')
-            conf = ProjectConf.from_string(yaml_src)
-            if (pull is not None and conf.build.pull_requests) or\
-               (pull is None and branch in conf.build.branches):
-                Build.create(repo, branch, sha, pull, automated=True).build()
+    # GitHub lists at most this many commits in a push payload
+    PUSH_COMMITS_LIMIT = 20
+
+    @classmethod
+    def changed_paths(cls, payload):
+        """ Paths touched by a push, `None` when the payload may not list all of them. """
+        commits = payload.get('commits')
+        if not commits or len(commits) >= cls.PUSH_COMMITS_LIMIT or payload.get('forced') or payload.get('created'):
+            return None
+        changed = set()
+        for commit in commits:
+            for key in ('added', 'modified', 'removed'):
+                changed.update(commit.get(key, []))
+        return sorted(changed)
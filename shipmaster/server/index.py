@@ -0,0 +1,63 @@
+from django.db import models
+from django.utils.translation import ugettext_lazy as _
+
+
+class BuildRecord(models.Model):
+    """
+    Database index of `Build` metadata, kept in sync whenever a build is saved.
+    The `build.yaml` files remain the source of truth, `manage.py reindex`
+    rebuilds the index from them.
+    """
+    repo = models.CharField(_('repository'), max_length=255)
+    number = models.PositiveIntegerField(_('number'))
+    branch = models.CharField(_('branch'), max_length=255, blank=True)
+    sha = models.CharField(_('sha'), max_length=40, blank=True)
+    pull_request = models.PositiveIntegerField(_('pull request'), null=True, blank=True)
+    automated = models.BooleanField(_('automated'), default=False)
+    result = models.CharField(_('result'), max_length=20, blank=True)
+
+    class Meta:
+        verbose_name = _('build record')
+        verbose_name_plural = _('build records')
+        unique_together = [('repo', 'number')]
+        index_together = [('repo', 'result'), ('repo', 'branch')]
+        ordering = ['-number']
+
+    @property
+    def result_display(self):
+        return self.result.capitalize()
+
+
+class JobRecord(models.Model):
+    """ Database index of `Test` and `Deployment` metadata, see `BuildRecord`. """
+    repo = models.CharField(_('repository'), max_length=255)
+    build = models.PositiveIntegerField(_('build'))
+    job_type = models.CharField(_('job type'), max_length=20)
+    number = models.PositiveIntegerField(_('number'))
+    result = models.CharField(_('result'), max_length=20, blank=True)
+    destination = models.CharField(_('destination'), max_length=255, blank=True)
+    coverage = models.CharField(_('coverage'), max_length=20, blank=True)
+
+    class Meta:
+        verbose_name = _('job record')
+        verbose_name_plural = _('job records')
+        unique_together = [('repo', 'build', 'job_type', 'number')]
+        index_together = [('repo', 'job_type', 'result')]
+        ordering = ['-number']
+
+    @property
+    def result_display(self):
+        return self.result.capitalize()
+
+    @property
+    def coverage_display(self):
+        if self.coverage:
+            return "{}% covered".format(self.coverage)
+        return ""
+
+
+def enable_sqlite_wal(sender, connection, **kwargs):
+    """ Lets web and worker processes read the index while another process writes to it. """
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode=WAL;')
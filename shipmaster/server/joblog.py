@@ -0,0 +1,192 @@
+import os
+import time
+import logging
+import selectors
+import threading
+import subprocess
+from itertools import groupby
+from logging import FileHandler
+from contextlib import contextmanager
+from django.conf import settings
+
+
+logger = logging.getLogger('shipmaster')
+
+RUN_CHUNK_SIZE = 64 * 1024
+RUN_FLUSH_INTERVAL = 0.5  # seconds
+RUN_FLUSH_LINES = 1000
+
+
+class JobLogHandler(logging.Handler):
+    """
+    Root handler sending every record to the log file of the job running in
+    the current thread, records logged outside of `job_log()` are dropped.
+    Eventlet and gevent patch `threading.local`, so green threads work too.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.local = threading.local()
+
+    def emit(self, record):
+        handler = getattr(self.local, 'handler', None)
+        if handler is not None:
+            handler.handle(record)
+
+    def write(self, lines, level=logging.INFO):
+        """ Appends already formatted `lines` to the current job's log in one write. """
+        handler = getattr(self.local, 'handler', None)
+        if handler is None:
+            for line in lines:
+                logger.log(level, line)
+            return
+        if level < handler.level:
+            return
+        handler.acquire()
+        try:
+            handler.stream.write(''.join(line+'\n' for line in lines))
+            handler.flush()
+        finally:
+            handler.release()
+
+
+_JOB_LOG_HANDLER = JobLogHandler()
+
+
+def _install_handler():
+    root = logging.getLogger()
+    if _JOB_LOG_HANDLER not in root.handlers:
+        root.setLevel(logging.INFO)
+        logging.getLogger('github3').setLevel(logging.WARNING)
+        logging.getLogger('requests').setLevel(logging.WARNING)
+        root.addHandler(_JOB_LOG_HANDLER)
+
+
+LOG_FORMAT = logging.Formatter('%(asctime)s %(message)s', '%H:%M:%S')
+
+
+@contextmanager
+def job_log(path, mode='a', cancelled=None):
+    """
+    Writes everything logged by the current thread to the file at `path`.
+    Commands started with `run()` meanwhile are killed once `cancelled()` is true.
+    """
+    _install_handler()
+    handler = FileHandler(path, mode)
+    handler.setFormatter(LOG_FORMAT)
+    local = _JOB_LOG_HANDLER.local
+    previous = getattr(local, 'handler', None), getattr(local, 'cancelled', None)
+    local.handler, local.cancelled = handler, cancelled
+    try:
+        yield
+    finally:
+        local.handler, local.cancelled = previous
+        handler.close()
+
+
+class OutputReader:
+    """
+    Reassembles lines from the chunks read off a pipe. Carriage return
+    separated progress updates (git, pip) only keep their final state.
+    """
+
+    MAX_LINE = 64 * 1024
+
+    def __init__(self):
+        self.buffer = b''
+
+    def feed(self, chunk):
+        self.buffer += chunk
+        *lines, self.buffer = self.buffer.split(b'\n')
+        if len(self.buffer) > self.MAX_LINE:
+            lines.append(self.buffer)
+            self.buffer = b''
+        return [self._decode(line) for line in lines]
+
+    def close(self):
+        lines = [self._decode(self.buffer)] if self.buffer else []
+        self.buffer = b''
+        return lines
+
+    @staticmethod
+    def _decode(line):
+        line = line.rstrip(b'\r')
+        return line[line.rfind(b'\r')+1:].decode('utf-8', 'replace')
+
+
+def run(command, cwd=None, env=None, timeout=None):
+    """
+    Runs `command`, streaming its stdout and stderr into the job log in
+    timestamped batches, stderr at the WARNING level. The command is killed when it runs longer than
+    `timeout` seconds (`SHIPMASTER_COMMAND_TIMEOUT` by default) or when
+    the job is cancelled, see `job_log()`. Returns the exit status.
+    """
+    logger.info("+ {}".format(' '.join(command)))
+
+    timeout = timeout or settings.SHIPMASTER_COMMAND_TIMEOUT
+    cancelled = getattr(_JOB_LOG_HANDLER.local, 'cancelled', None)
+    deadline = time.monotonic() + timeout
+
+    env = {**os.environ, **(env or {})}
+    child = subprocess.Popen(
+        command, stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        cwd=cwd, env=env
+    )
+
+    readers, levels = {}, {child.stdout: logging.INFO, child.stderr: logging.WARNING}
+    with selectors.DefaultSelector() as selector:
+        for pipe in (child.stdout, child.stderr):
+            os.set_blocking(pipe.fileno(), False)
+            selector.register(pipe, selectors.EVENT_READ)
+            readers[pipe] = OutputReader()
+
+        lines, checked = [], time.monotonic()
+        while selector.get_map():
+            for key, _ in selector.select(RUN_FLUSH_INTERVAL):
+                chunk = os.read(key.fd, RUN_CHUNK_SIZE)
+                if chunk:
+                    new = readers[key.fileobj].feed(chunk)
+                else:
+                    selector.unregister(key.fileobj)
+                    new = readers[key.fileobj].close()
+                stamp, level = time.strftime('%H:%M:%S '), levels[key.fileobj]
+                lines.extend((level, stamp+line) for line in new)
+
+            now = time.monotonic()
+            if len(lines) >= RUN_FLUSH_LINES or (lines and now - checked >= RUN_FLUSH_INTERVAL):
+                _write(lines)
+                lines = []
+            if now - checked >= RUN_FLUSH_INTERVAL:
+                checked = now
+                if _should_kill(child, command, deadline, timeout, cancelled):
+                    break
+
+        _write(lines)
+
+    child.stdout.close()
+    child.stderr.close()
+    # the pipes can close before the command exits
+    while True:
+        try:
+            return child.wait(RUN_FLUSH_INTERVAL)
+        except subprocess.TimeoutExpired:
+            _should_kill(child, command, deadline, timeout, cancelled)
+
+
+def _write(lines):
+    """ Writes `(level, line)` pairs, consecutive lines of the same level at once. """
+    for level, batch in groupby(lines, key=lambda line: line[0]):
+        _JOB_LOG_HANDLER.write([line for _, line in batch], level)
+
+
+def _should_kill(child, command, deadline, timeout, cancelled):
+    reason = None
+    if time.monotonic() > deadline:
+        reason = "Timed out after {} seconds".format(timeout)
+    elif cancelled is not None and cancelled():
+        reason = "Cancelled"
+    if reason:
+        logger.error("{}, killing: {}".format(reason, ' '.join(command)))
+        child.kill()
+    return reason is not None
@@ -0,0 +1,26 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from humanfriendly import format_size
+from shipmaster.core.builder import docker_client
+from shipmaster.server.gc import collect_garbage
+from shipmaster.server.models import Shipmaster
+
+
+class Command(BaseCommand):
+    help = "Removes builds and images no longer retained by the repositories' retention policies."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Only report what would be removed.")
+        parser.add_argument('--skip-images', action='store_true', help="Leave Docker images alone.")
+
+    def handle(self, *args, **options):
+        shipmaster = Shipmaster.from_path(settings.SHIPMASTER_DATA)
+        client = None if options['skip_images'] else docker_client()
+        reports, images_freed = collect_garbage(shipmaster, client, dry_run=options['dry_run'])
+        for report in reports:
+            self.stdout.write("{}: kept {} builds, removed {} freeing {}, using {}".format(
+                report.repo, len(report.kept), len(report.removed),
+                format_size(report.freed), format_size(report.usage)
+            ))
+        if client is not None:
+            self.stdout.write("Images: freed {}".format(format_size(images_freed)))
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from humanfriendly import format_timespan
+from shipmaster.server import scheduler
+
+
+def timespan(delta):
+    return format_timespan(delta.total_seconds()) if delta is not None else '-'
+
+
+class Command(BaseCommand):
+    help = "Shows the depth and wait times of the build, test and deployment queues."
+
+    def handle(self, *args, **options):
+        self.stdout.write("{:<14}{:>9}{:>9}{:>22}{:>22}".format(
+            'queue', 'waiting', 'running', 'oldest wait', 'average wait (1h)'))
+        for queue, row in sorted(scheduler.stats().items()):
+            self.stdout.write("{:<14}{:>9}{:>9}{:>22}{:>22}".format(
+                queue, row['waiting'], row['running'],
+                timespan(row['oldest_wait']), timespan(row['average_wait'])
+            ))
+        hosts = scheduler.load_by_host()
+        if hosts:
+            self.stdout.write("")
+            self.stdout.write("Tasks per host:")
+            for host, (online, count) in sorted(hosts.items()):
+                self.stdout.write("  {}: {}{}".format(host, count, '' if online else ' (offline)'))
+        waiting = scheduler.waiting_by_repository()
+        if waiting:
+            self.stdout.write("")
+            self.stdout.write("Waiting per repository:")
+            for repo, count in sorted(waiting.items()):
+                self.stdout.write("  {}: {}".format(repo, count))
@@ -0,0 +1,13 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from shipmaster.server.models import Shipmaster
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the database index of builds, tests and deployments from their YAML files."
+
+    def handle(self, *args, **options):
+        shipmaster = Shipmaster.from_path(settings.SHIPMASTER_DATA)
+        for repo in shipmaster.repositories:
+            repo.reindex()
+            self.stdout.write("Indexed {}: {} builds".format(repo.name, repo.query_builds().count()))
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('server', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BuildRecord',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('repo', models.CharField(max_length=255, verbose_name='repository')),
+                ('number', models.PositiveIntegerField(verbose_name='number')),
+                ('branch', models.CharField(blank=True, max_length=255, verbose_name='branch')),
+                ('sha', models.CharField(blank=True, max_length=40, verbose_name='sha')),
+                ('pull_request', models.PositiveIntegerField(blank=True, null=True, verbose_name='pull request')),
+                ('automated', models.BooleanField(default=False, verbose_name='automated')),
+                ('result', models.CharField(blank=True, max_length=20, verbose_name='result')),
+            ],
+            options={
+                'verbose_name': 'build record',
+                'verbose_name_plural': 'build records',
+                'ordering': ['-number'],
+            },
+        ),
+        migrations.CreateModel(
+            name='JobRecord',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('repo', models.CharField(max_length=255, verbose_name='repository')),
+                ('build', models.PositiveIntegerField(verbose_name='build')),
+                ('job_type', models.CharField(max_length=20, verbose_name='job type')),
+                ('number', models.PositiveIntegerField(verbose_name='number')),
+                ('result', models.CharField(blank=True, max_length=20, verbose_name='result')),
+                ('destination', models.CharField(blank=True, max_length=255, verbose_name='destination')),
+                ('coverage', models.CharField(blank=True, max_length=20, verbose_name='coverage')),
+            ],
+            options={
+                'verbose_name': 'job record',
+                'verbose_name_plural': 'job records',
+                'ordering': ['-number'],
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='buildrecord',
+            unique_together=set([('repo', 'number')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='buildrecord',
+            index_together=set([('repo', 'result'), ('repo', 'branch')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='jobrecord',
+            unique_together=set([('repo', 'build', 'job_type', 'number')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='jobrecord',
+            index_together=set([('repo', 'job_type', 'result')]),
+        ),
+    ]
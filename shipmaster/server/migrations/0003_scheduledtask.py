@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('server', '0002_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScheduledTask',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('task_id', models.CharField(max_length=36, unique=True, verbose_name='task id')),
+                ('task', models.CharField(max_length=255, verbose_name='task')),
+                ('path', models.CharField(max_length=1024, verbose_name='path')),
+                ('repo', models.CharField(max_length=255, verbose_name='repository')),
+                ('priority', models.PositiveSmallIntegerField(verbose_name='priority')),
+                ('queued_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='queued at')),
+                ('dispatched_at', models.DateTimeField(blank=True, null=True, verbose_name='dispatched at')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='finished at')),
+            ],
+            options={
+                'verbose_name': 'scheduled task',
+                'verbose_name_plural': 'scheduled tasks',
+                'ordering': ['queued_at'],
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='scheduledtask',
+            index_together=set([('dispatched_at', 'finished_at'), ('repo', 'dispatched_at')]),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('server', '0003_scheduledtask'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scheduledtask',
+            name='affinity',
+            field=models.CharField(blank=True, max_length=255, verbose_name='preferred host'),
+        ),
+        migrations.AddField(
+            model_name='scheduledtask',
+            name='host',
+            field=models.CharField(blank=True, max_length=255, verbose_name='host'),
+        ),
+        migrations.CreateModel(
+            name='HostAffinity',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('repo', models.CharField(max_length=255, unique=True, verbose_name='repository')),
+                ('host', models.CharField(max_length=255, verbose_name='host')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='updated at')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='WorkerHost',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True, verbose_name='name')),
+                ('online', models.BooleanField(default=False, verbose_name='online')),
+                ('seen_at', models.DateTimeField(auto_now=True, verbose_name='seen at')),
+            ],
+        ),
+    ]
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+
+from django.conf import settings
+from django.db import migrations
+from ruamel import yaml
+
+
+def load(path):
+    """ Contents of a model's YAML file, `None` while it wasn't saved yet. """
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as file:
+        return yaml.load(file) or {}
+
+
+def numbers(path):
+    """ Numbered subdirectories of `path`, builds or jobs. """
+    if not os.path.isdir(path):
+        return []
+    return [name for name in os.listdir(path) if name.isdigit()]
+
+
+def backfill_index(apps, schema_editor):
+    """
+    Indexes the builds, tests and deployments created before the index
+    existed. Views read them only from the index, so without this their
+    history would be missing until `manage.py reindex` is run by hand.
+
+    Reads the YAML files directly, as the models may have changed since
+    this migration was written, `manage.py reindex` does the same using them.
+    """
+    BuildRecord = apps.get_model('server', 'BuildRecord')
+    JobRecord = apps.get_model('server', 'JobRecord')
+    repos_dir = os.path.join(settings.SHIPMASTER_DATA, 'repos')
+    if not os.path.isdir(repos_dir):
+        return  # new installation, nothing to index
+    for repo in os.listdir(repos_dir):
+        builds = os.path.join(repos_dir, repo, 'builds')
+        for number in numbers(builds):
+            build = load(os.path.join(builds, number, 'build.yaml'))
+            if build is None:
+                continue
+            BuildRecord.objects.update_or_create(repo=repo, number=int(number), defaults={
+                'branch': build.get('branch', ''),
+                'sha': build.get('sha') or '',
+                'pull_request': build.get('pull_request'),
+                'automated': build.get('automated', False),
+                'result': build.get('result', ''),
+            })
+            for job_type, directory in (('test', 'tests'), ('deployment', 'deployments')):
+                jobs = os.path.join(builds, number, directory)
+                for job_number in numbers(jobs):
+                    job = load(os.path.join(jobs, job_number, job_type+'.yaml'))
+                    if job is None:
+                        continue
+                    JobRecord.objects.update_or_create(
+                        repo=repo, build=int(number), job_type=job_type, number=int(job_number), defaults={
+                            'result': job.get('result', ''),
+                            'coverage': job.get('coverage', ''),
+                            'destination': job.get('destination', ''),
+                        }
+                    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('server', '0004_host_affinity'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_index, migrations.RunPython.noop),
+    ]
@@ -2,13 +2,13 @@ import os
 import re
 import json
 import time
+import uuid
 import shutil
-import requests
+import logging
 import subprocess
 
 from urllib.parse import urljoin
-from collections import OrderedDict
-from ruamel import yaml
+from collections import OrderedDict, namedtuple
 
 from github3 import GitHub
 from compose.cli.command import get_project as get_compose
@@ -17,8 +17,34 @@ from django.conf import settings
 
 from shipmaster.base.builder import Project
 from shipmaster.base.config import ProjectConf
+from shipmaster.core.config import BuildConfig
+from shipmaster.plugins.slack.slack import SlackConf, get_notifier
 
 from .user import User
+from .index import BuildRecord, JobRecord
+from .status import get_status_updater
+from .storage import Journal, yaml_cache, claim_next_number, claim_commit
+from . import scheduler
+
+
+logger = logging.getLogger('shipmaster')
+
+
+PAGE_SIZE = 25
+
+
+class Page(namedtuple('_Page', 'items next')):
+    """ One page of index records, `next` is the cursor of the following (older) page or `None`. """
+
+    @classmethod
+    def latest(cls, queryset, before=None, limit=PAGE_SIZE):
+        """ The newest `limit` records of `queryset` numbered below the `before` cursor. """
+        if before:
+            queryset = queryset.filter(number__lt=before)
+        records = list(queryset.order_by('-number')[:limit+1])
+        if len(records) > limit:
+            return cls(records[:limit], records[limit-1].number)
+        return cls(records, None)
 
 
 class YamlPath:
@@ -40,8 +66,7 @@ class YamlModel:
     @classmethod
     def load(cls, *args):
         model = cls(*args)
-        with open(model.path.yaml, 'r') as file:
-            model.dict = yaml.load(file)
+        model.dict = yaml_cache.load(model.path.yaml)
         return model
 
     @classmethod
@@ -51,8 +76,11 @@ class YamlModel:
         return cls.load(parent, os.path.basename(path))
 
     def save(self):
-        with open(self.path.yaml, 'w') as file:
-            file.write(yaml.dump(self.dict))
+        yaml_cache.save(self.path.yaml, self.dict)
+        self.index()
+
+    def index(self):
+        """ Updates the database index entry of this model, if it has one. """
 
 
 class ShipmasterPath(YamlPath):
@@ -81,12 +109,6 @@ class ShipmasterPath(YamlPath):
         return os.path.join(self.ssh_dir, 'ssh_config')
 
 
-class GitHubStatusUpdater:
-
-    def __init__(self, oauth):
-        self.oauth = oauth
-
-
 class Shipmaster(YamlModel):
 
     def __init__(self, data_path, **kwargs):
@@ -115,6 +137,9 @@ class Shipmaster(YamlModel):
     def get_github(self):
         return GitHub(token=self.token)
 
+    def get_status_updater(self):
+        return get_status_updater(self.token)
+
     @property
     def token(self):
         """ Shipmaster's integration with GitHub is a bit complicated
@@ -169,6 +194,18 @@ class RepositoryPath(YamlPath):
     def builds(self):
         return os.path.join(self.absolute, 'builds')
 
+    @property
+    def mirror(self):
+        return os.path.join(self.absolute, 'mirror.git')
+
+    @property
+    def commits(self):
+        return os.path.join(self.absolute, 'commits')
+
+    @property
+    def mirror_lock(self):
+        return os.path.join(self.absolute, 'mirror.lock')
+
     @property
     def public_key(self):
         return self.private_key+'.pub'
@@ -209,8 +246,8 @@ class Repository(YamlModel):
         self._parse_git()
         return self
 
-    def increment_build_number(self):
-        return increment_number_file(self.path.last_build_number)
+    def claim_build_number(self):
+        return claim_next_number(self.path.last_build_number, self.path.builds)
 
     @property
     def git(self):
@@ -220,6 +257,18 @@ class Repository(YamlModel):
     def git(self, git):
         self.dict['git'] = git
 
+    @property
+    def sparse_checkout(self):
+        """
+        Optional, when enabled builds use a blobless mirror and only check out
+        the image contexts, config and compose files of `.shipmaster.yaml`.
+        """
+        return self.dict.get('sparse_checkout', False)
+
+    @sparse_checkout.setter
+    def sparse_checkout(self, sparse_checkout):
+        self.dict['sparse_checkout'] = sparse_checkout
+
     @property
     def git_project_host(self):
         return "{}.{}".format(self.name, self.git_host)
@@ -262,14 +311,58 @@ class Repository(YamlModel):
 
         return repo
 
-    @property
-    def builds(self):
-        for build in os.listdir(self.path.builds):
-            yield Build.load(self, build)
+    def claim_commit(self, sha, branch, pull_request=None):
+        """ Marks `sha` as built for this repository, see `storage.claim_commit()`. """
+        return claim_commit(self.path.commits, sha, branch, pull_request)
+
+    @staticmethod
+    def release_commit(claim):
+        os.remove(claim)
+
+    def cancel_queued_builds(self, branch, pull_request=None):
+        """ Cancels automated builds of `branch` (or of the pull request) still waiting for a worker. """
+        records = self.query_builds(result=Build.QUEUED, automated=True)
+        if pull_request:
+            records = records.filter(pull_request=pull_request)
+        else:
+            records = records.filter(branch=branch, pull_request__isnull=True)
+        for record in records:
+            build = Build.load(self, str(record.number))
+            # the index can lag behind, a build which started cloning keeps running
+            if build.result == Build.QUEUED:
+                build.cancel()
+
+    def query_builds(self, **filters):
+        """ Indexed builds of this repository, newest first, as a `BuildRecord` queryset. """
+        return BuildRecord.objects.filter(repo=self.name, **filters)
 
     @property
-    def sorted_builds(self):
-        return sorted(self.builds, key=lambda build: int(build.number), reverse=True)
+    def builds(self):
+        for record in self.query_builds():
+            yield Build.load(self, str(record.number))
+
+    def latest_builds(self, before=None, limit=PAGE_SIZE):
+        return Page.latest(self.query_builds(), before, limit)
+
+    def reindex(self):
+        """ Rebuilds the index of this repository's builds and jobs from their YAML files. """
+        BuildRecord.objects.filter(repo=self.name).delete()
+        JobRecord.objects.filter(repo=self.name).delete()
+        if not os.path.exists(self.path.builds):
+            return
+        for number in os.listdir(self.path.builds):
+            build = Build(self, number)
+            # numbers are claimed by creating their directory, the YAML file follows
+            if not os.path.exists(build.path.yaml):
+                continue
+            build = Build.load(self, number)
+            build.index()
+            for job_class, jobs in ((Test, build.path.tests), (Deployment, build.path.deployments)):
+                if not os.path.exists(jobs):
+                    continue
+                for job_number in os.listdir(jobs):
+                    if os.path.exists(job_class(build, job_number).path.yaml):
+                        job_class.load(build, job_number).index()
 
     def __eq__(self, other):
         assert isinstance(other, Repository)
@@ -365,6 +458,10 @@ class BuildPath(YamlPath):
     def absolute(self):
         return os.path.join(self.repo.path.builds, self.number)
 
+    @property
+    def journal(self):
+        return os.path.join(self.absolute, 'build.journal')
+
     @property
     def clone_begin(self):
         return os.path.join(self.absolute, 'clone.begin')
@@ -454,6 +551,10 @@ class Build(YamlModel):
         matrix is executed it should only have to do the minimum amount of work to satisfy the matrix
         constraints.
 
+        For the simpler cases an image can instead declare a `matrix:` of base images and/or
+        environment variable sets in `.shipmaster.yaml`; each combination is then built as its
+        own image, concurrently, and reported as a single grouped result.
+
     """
 
     parent_class = Repository
@@ -463,6 +564,8 @@ class Build(YamlModel):
     BUILDING = 'pending'
     SUCCEEDED = 'success'
     FAILED = 'failure'
+    CANCELLED = 'cancelled'
+    SKIPPED = 'skipped'
     GITHUB_STATES = {
         BUILDING: "building...",
         SUCCEEDED: "container built",
@@ -476,21 +579,26 @@ class Build(YamlModel):
         self.shipmaster = repo.shipmaster  # type: Shipmaster
         self.number = number
         self.path = BuildPath(repo, number)
+        self.journal = Journal(self.path.journal, legacy={
+            'clone.begin': self.path.clone_begin,
+            'clone.end': self.path.clone_end,
+            'build.begin': self.path.build_begin,
+            'build.end': self.path.build_end,
+        })
 
     @classmethod
     def create(cls, repo, branch, sha=None, pull_request=None, automated=False, **kwargs):
-        build = cls(repo, repo.increment_build_number(), branch=branch, sha=sha, pull_request=pull_request, automated=automated, **kwargs)
-        os.mkdir(build.path.absolute)
+        build = cls(repo, repo.claim_build_number(), branch=branch, sha=sha, pull_request=pull_request, automated=automated, **kwargs)
         os.mkdir(build.path.tests)
         os.mkdir(build.path.deployments)
         build.save()
         return build
 
-    def increment_test_number(self):
-        return increment_number_file(self.path.last_test_number)
+    def claim_test_number(self):
+        return claim_next_number(self.path.last_test_number, self.path.tests)
 
-    def increment_deployment_number(self):
-        return increment_number_file(self.path.last_deployment_number)
+    def claim_deployment_number(self):
+        return claim_next_number(self.path.last_deployment_number, self.path.deployments)
 
     @property
     def url(self):
@@ -512,27 +620,22 @@ class Build(YamlModel):
     def result(self, result):
         self.dict['result'] = result
         self.save()
+        self.journal.record('result.'+result)
 
-        try:
-            if result in self.GITHUB_STATES:
-                if self.pull_request:
-                    sha = self.pull_request_parent_sha
-                else:
-                    sha = self.commit_info['hash']
-                repo = self.repo.get_github()
-                repo.create_status(
-                    sha, result, target_url=self.url,
-                    description=self.GITHUB_STATES[result],
-                    context='shipmaster/build',
-                )
-        except:
-            pass
+        if result in self.GITHUB_STATES:
+            self.publish_status(result, self.GITHUB_STATES[result], 'shipmaster/build', self.url)
 
-        try:
-            if result in self.SLACK_MESSAGES:
-                self.slack('build.{}'.format(result), self.SLACK_MESSAGES[result])
-        except:
-            pass
+        if result in self.SLACK_MESSAGES:
+            self.slack('build.{}'.format(result), self.SLACK_MESSAGES[result])
+
+    @property
+    def host(self):
+        """ Worker host which built the images, they are only cached there. """
+        return self.dict.get('host')
+
+    @host.setter
+    def host(self, host):
+        self.dict['host'] = host
 
     @property
     def branch(self):
@@ -583,35 +686,105 @@ class Build(YamlModel):
         )
 
     def build(self):
+        # the task id is saved up front, so the build can be cancelled while queued
+        self.dict['task_id'] = str(uuid.uuid4())
         self.result = self.QUEUED
-        from .tasks import build_app
-        build_app.delay(self.path.absolute)
+        scheduler.submit('shipmaster.server.tasks.build_app', self.repo.name, self.path.absolute, self.dict['task_id'])
+        return self
+
+    @property
+    def skipped(self):
+        """
+        Optional immutable field, set when the pushed changes did not affect
+        any image: `{'reason': ..., 'previous': <number of the build whose images still apply>}`.
+        """
+        return self.dict.get('skipped')
+
+    def skip(self, reason, previous):
+        """ Records why the build was not needed instead of queueing it. """
+        self.dict['skipped'] = {'reason': reason, 'previous': str(previous)}
+        self.result = self.SKIPPED
+        self.publish_status(self.SUCCEEDED, 'skipped, {}'.format(reason), 'shipmaster/build', self.url)
         return self
 
+    @property
+    def is_cancelled(self):
+        return self.result == self.CANCELLED
+
+    @property
+    def can_cancel(self):
+        return self.result in (self.QUEUED, self.CLONING, self.BUILDING)
+
+    def cancel(self):
+        """
+        Revokes the queued build task. Once a worker picked it up the
+        cancellation is recorded instead, `joblog.run()` then kills the
+        running command and the build ends up cancelled. Builds are
+        cancelled from their page, queued ones also when superseded.
+        """
+        if self.result in (self.CLONING, self.BUILDING):
+            self.journal.record('cancel')
+            return
+        if self.result != self.QUEUED:
+            return
+        task_id = self.dict.get('task_id')
+        if task_id and not scheduler.cancel(task_id):
+            from .celery import app
+            app.control.revoke(task_id)
+        self.result = self.CANCELLED
+
+    def cancel_requested(self):
+        # re-read, the request comes from another process
+        return Journal(self.path.journal).has('cancel')
+
     def slack(self, event, message):
-        conf = self.get_conf()
-        if message and conf.slack.is_enabled:
-            # if no filters then send for all events, otherwise only for allowed events
-            if not conf.slack.events or event in conf.slack.events:
-                requests.post(conf.slack.api, json.dumps({'text': message}))
+        """
+        Queues a Slack notification, delivered in batches by the slack plugin's
+        notifier. Never raises, notifications must not fail state transitions.
+        """
+        if not message:
+            return
+        try:
+            conf = SlackConf.from_build_config(BuildConfig.from_workspace(self.path.workspace))
+            if conf.wants(event):
+                get_notifier().notify(conf, '{} #{}'.format(self.repo.name, self.number), message)
+        except ValueError as exc:
+            logger.warning('Not sending Slack notification for {}: {}'.format(event, exc))
+        except Exception:
+            logger.exception('Not sending Slack notification for {}:'.format(event))
+
+    def index(self):
+        BuildRecord.objects.update_or_create(
+            repo=self.repo.name, number=int(self.number), defaults={
+                'branch': self.branch,
+                'sha': self.sha or '',
+                'pull_request': self.pull_request,
+                'automated': self.automated,
+                'result': self.result,
+            }
+        )
+
+    def query_jobs(self, job_type, **filters):
+        """ Indexed jobs of this build, newest first, as a `JobRecord` queryset. """
+        return JobRecord.objects.filter(
+            repo=self.repo.name, build=int(self.number), job_type=job_type, **filters
+        )
 
     @property
     def tests(self):
-        for test in os.listdir(self.path.tests):
-            yield Test.load(self, test)
+        for record in self.query_jobs(TestPath.job_type):
+            yield Test.load(self, str(record.number))
 
-    @property
-    def sorted_tests(self):
-        return sorted(self.tests, key=lambda item: int(item.number), reverse=True)
+    def latest_tests(self, before=None, limit=PAGE_SIZE):
+        return Page.latest(self.query_jobs(TestPath.job_type), before, limit)
 
     @property
     def deployments(self):
-        for deployment in os.listdir(self.path.deployments):
-            yield Deployment.load(self, deployment)
+        for record in self.query_jobs(DeploymentPath.job_type):
+            yield Deployment.load(self, str(record.number))
 
-    @property
-    def sorted_deployments(self):
-        return sorted(self.deployments, key=lambda item: int(item.number), reverse=True)
+    def latest_deployments(self, before=None, limit=PAGE_SIZE):
+        return Page.latest(self.query_jobs(DeploymentPath.job_type), before, limit)
 
     # Timers & Progress
 
@@ -627,65 +800,103 @@ class Build(YamlModel):
         return self.result == self.FAILED
 
     def failed(self):
-        self.result = self.FAILED
+        self.result = self.CANCELLED if self.cancel_requested() else self.FAILED
+
+    COMMIT_FIELDS = ('hash', 'short-hash', 'author', 'email', 'parents', 'subject')
+
+    def capture_commit(self, sha='HEAD', cwd=None):
+        """
+        Reads the metadata of `sha` with a single `git log` and persists it
+        in `build.yaml`, called once the commit to build is resolved in the
+        repository's mirror.
+        """
+        result = subprocess.run(
+            ["git", "log", "-n", "1", "--format=%H%x00%h%x00%an%x00%ae%x00%P%x00%s", sha],
+            cwd=cwd or self.repo.path.mirror, stdout=subprocess.PIPE, check=True
+        )
+        commit = dict(zip(self.COMMIT_FIELDS, result.stdout.decode().strip().split('\0')))
+        commit['parents'] = commit['parents'].split()
+        self.dict['commit'] = commit
+        self.save()
+        return commit
+
+    @property
+    def commit(self):
+        """
+        Optional immutable field, set by `capture_commit()` once the commit to
+        build is known. `None` when that never happened.
+        """
+        if 'commit' not in self.dict and self.result == self.SUCCEEDED and os.path.exists(self.path.workspace):
+            # builds from before commit metadata was persisted, their checkout is complete
+            return self.capture_commit(cwd=self.path.workspace)
+        return self.dict.get('commit')
 
     @property
     def commit_info(self):
-        details_cmnd = ["git", "log", '--format={"hash": "%H", "short-hash": "%h", "author": "%an", "email": "%ae"}', "-n", "1"]
-        result = subprocess.run(details_cmnd, cwd=self.path.workspace, stdout=subprocess.PIPE)
-        json_result = result.stdout.decode().strip()
-        info = json.loads(json_result)
-        subject_cmnd = ["git", "log", '--format=%s', "-n", "1"]
-        result = subprocess.run(subject_cmnd, cwd=self.path.workspace, stdout=subprocess.PIPE)
-        info['subject'] = result.stdout.decode().strip()
+        info = {key: value for key, value in (self.commit or {}).items() if key != 'parents'}
         info['branch'] = self.branch
         return info
 
     @property
     def pull_request_parent_sha(self):
         assert self.pull_request
-        details_cmnd = ['git', 'log', '--format=%P', '-n', '1']
-        result = subprocess.run(details_cmnd, cwd=self.path.workspace, stdout=subprocess.PIPE)
-        # this returns two hashes, one for each parent of our pull request
-        hashes = result.stdout.decode().strip().split(' ')
-        for hash in hashes:
+        # merge commit has two parents, one for each side of our pull request
+        for hash in self.commit['parents']:
             # self.sha is the base HEAD, we want the other one, the pull request HEAD
             if hash != self.sha:
                 return hash
 
+    def publish_status(self, state, description, context, target_url):
+        """ Queues a GitHub commit status for this build's commit, see `GitHubStatusUpdater`. """
+        try:
+            commit = self.commit
+        except (OSError, subprocess.CalledProcessError):
+            commit = None
+        if commit:
+            sha = self.pull_request_parent_sha if self.pull_request else commit['hash']
+        elif self.sha and not self.pull_request:
+            sha = self.sha  # the pushed commit, it could not be resolved
+        else:
+            logger.warning('No commit to publish {} status for, build {} was not resolved.'.format(context, self.number))
+            return
+        self.shipmaster.get_status_updater().publish(
+            self.repo.git_account, self.repo.git_repo, sha,
+            state, target_url, description, context
+        )
+
     # Repository Cloning
 
     @property
     def has_cloning_started(self):
-        return os.path.exists(self.path.clone_begin)
+        return self.journal.has('clone.begin')
 
     @property
     def has_cloning_finished(self):
-        return os.path.exists(self.path.clone_end)
+        return self.journal.has('clone.end')
 
     def cloning_started(self):
         assert not self.has_cloning_started
-        record_time(self.path.clone_begin)
+        self.journal.record('clone.begin')
         self.result = self.CLONING
 
     def cloning_finished(self):
         assert not self.has_cloning_finished
-        record_time(self.path.clone_end)
+        self.journal.record('clone.end')
 
     # App Build
 
     @property
     def has_build_started(self):
-        return os.path.exists(self.path.build_begin)
+        return self.journal.has('build.begin')
 
     @property
     def has_build_finished(self):
-        return os.path.exists(self.path.build_end)
+        return self.journal.has('build.end')
 
     @property
     def elapsed_time(self):
         assert self.has_build_finished
-        return get_elapsed_time(self.path.build_begin, self.path.build_end)
+        return self.journal.elapsed('build.begin', 'build.end')
 
     @property
     def log(self):
@@ -695,12 +906,12 @@ class Build(YamlModel):
 
     def build_started(self):
         assert not self.has_build_started
-        record_time(self.path.build_begin)
+        self.journal.record('build.begin')
         self.result = self.BUILDING
 
     def build_finished(self):
         assert not self.has_build_finished
-        record_time(self.path.build_end)
+        self.journal.record('build.end')
 
 
 class BaseJobPath(YamlPath):
@@ -723,6 +934,10 @@ class BaseJobPath(YamlPath):
     def log(self):
         return os.path.join(self.absolute, self.job_type+'.log')
 
+    @property
+    def journal(self):
+        return os.path.join(self.absolute, self.job_type+'.journal')
+
     @property
     def begin(self):
         return os.path.join(self.absolute, self.job_type+'.begin')
@@ -749,10 +964,30 @@ class BaseJob(YamlModel):
         self.repo = build.repo  # type: Repository
         self.shipmaster = build.repo.shipmaster  # type: Shipmaster
         self.number = str(number)
+        self._journal = None
+
+    @property
+    def journal(self):
+        if self._journal is None:
+            self._journal = Journal(self.path.journal, legacy={
+                'begin': self.path.begin,
+                'end': self.path.end,
+            })
+        return self._journal
 
     def get_project(self):
         return self.build.get_project(job_num=self.number)
 
+    def index(self):
+        JobRecord.objects.update_or_create(
+            repo=self.repo.name, build=int(self.build.number),
+            job_type=self.path.job_type, number=int(self.number),
+            defaults=self.index_fields()
+        )
+
+    def index_fields(self):
+        return {'result': self.result}
+
     @property
     def url(self):
         raise NotImplemented
@@ -769,29 +1004,17 @@ class BaseJob(YamlModel):
     def result(self, result):
         self.dict['result'] = result
         self.save()
+        self.journal.record('result.'+result)
 
-        try:
-            if result in self.GITHUB_STATES:
-                if self.build.pull_request:
-                    sha = self.build.pull_request_parent_sha
-                else:
-                    sha = self.build.commit_info['hash']
-                repo = self.repo.get_github()
-                description = self.GITHUB_STATES[result].format(o=self)
-                repo.create_status(
-                    sha, result, target_url=self.url,
-                    description=description,
-                    context='shipmaster/{}'.format(self.path.job_type),
-                )
-        except:
-            pass
+        if result in self.GITHUB_STATES:
+            self.build.publish_status(
+                result, self.GITHUB_STATES[result].format(o=self),
+                'shipmaster/{}'.format(self.path.job_type), self.url
+            )
 
-        try:
-            if result in self.SLACK_MESSAGES:
-                message = self.SLACK_MESSAGES[result].format(o=self)
-                self.build.slack('{}.{}'.format(self.path.job_type, result), message)
-        except:
-            pass
+        if result in self.SLACK_MESSAGES:
+            message = self.SLACK_MESSAGES[result].format(o=self)
+            self.build.slack('{}.{}'.format(self.path.job_type, result), message)
 
     @property
     def is_successful(self):
@@ -809,25 +1032,25 @@ class BaseJob(YamlModel):
 
     @property
     def has_started(self):
-        return os.path.exists(self.path.begin)
+        return self.journal.has('begin')
 
     @property
     def has_finished(self):
-        return os.path.exists(self.path.end)
+        return self.journal.has('end')
 
     def started(self):
         assert not self.has_started
-        record_time(self.path.begin)
+        self.journal.record('begin')
         self.result = self.RUNNING
 
     def finished(self):
         assert not self.has_finished
-        record_time(self.path.end)
+        self.journal.record('end')
 
     @property
     def elapsed_time(self):
         assert self.has_finished
-        return get_elapsed_time(self.path.begin, self.path.end)
+        return self.journal.elapsed('begin', 'end')
 
     @property
     def log(self):
@@ -925,18 +1148,20 @@ class Test(BaseJob):
     def coverage(self, coverage):
         self.dict['coverage'] = coverage
 
+    def index_fields(self):
+        return {'result': self.result, 'coverage': self.coverage}
+
     @classmethod
     def create(cls, build):
-        job = cls(build, build.increment_test_number())
-        os.mkdir(job.path.absolute)
+        job = cls(build, build.claim_test_number())
         os.mkdir(job.path.reports)
         job.save()
         return job
 
     def test(self):
         self.result = self.QUEUED
-        from .tasks import test_app
-        test_app.delay(self.path.absolute)
+        scheduler.submit('shipmaster.server.tasks.test_app', self.repo.name, self.path.absolute, str(uuid.uuid4()),
+                         host=self.build.host, pin=True)
         return self
 
     def succeeded(self):
@@ -966,8 +1191,7 @@ class Deployment(BaseJob):
 
     @classmethod
     def create(cls, build, destination):
-        job = cls(build, build.increment_deployment_number())
-        os.mkdir(job.path.absolute)
+        job = cls(build, build.claim_deployment_number())
         job.destination = destination
         job.save()
         return job
@@ -987,33 +1211,16 @@ class Deployment(BaseJob):
     def destination(self, destination):
         self.dict['destination'] = destination
 
+    def index_fields(self):
+        return {'result': self.result, 'destination': self.destination}
+
     def deploy(self):
         self.result = self.QUEUED
-        from .tasks import deploy_app
-        deploy_app.delay(self.path.absolute)
+        scheduler.submit('shipmaster.server.tasks.deploy_app', self.repo.name, self.path.absolute, str(uuid.uuid4()),
+                         host=self.build.host, pin=True)
         return self
 
 
 def record_time(path):
     with open(path, 'w') as stamp:
         stamp.write(str(time.time()))
-
-
-def get_elapsed_time(start_path, end_path):
-    with open(start_path, 'r') as start_file:
-        start = float(start_file.read())
-    with open(end_path, 'r') as end_file:
-        end = float(end_file.read())
-    return end - start
-
-
-def increment_number_file(path):
-    number = 1
-    if os.path.exists(path):
-        with open(path, 'r') as file:
-            number = int(file.read().strip())
-            number += 1
-    number = str(number)
-    with open(path, 'w') as file:
-        file.write(number)
-    return number
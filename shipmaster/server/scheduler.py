@@ -0,0 +1,295 @@
+import os
+import fcntl
+import logging
+import threading
+from functools import partial
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import models, connection, transaction
+from django.db.models import Q, Count, Min, Max
+from django.utils import timezone
+from django.utils.translation import ugettext_lazy as _
+
+logger = logging.getLogger('shipmaster')
+
+
+class ScheduledTask(models.Model):
+    """
+    A build, test or deployment task waiting for, or holding, one of its
+    repository's execution slots. Tasks are only sent to Celery once
+    `dispatch()` hands them a slot.
+    """
+    task_id = models.CharField(_('task id'), max_length=36, unique=True)
+    task = models.CharField(_('task'), max_length=255)
+    path = models.CharField(_('path'), max_length=1024)
+    repo = models.CharField(_('repository'), max_length=255)
+    priority = models.PositiveSmallIntegerField(_('priority'))
+    queued_at = models.DateTimeField(_('queued at'), default=timezone.now)
+    dispatched_at = models.DateTimeField(_('dispatched at'), null=True, blank=True)
+    finished_at = models.DateTimeField(_('finished at'), null=True, blank=True)
+    affinity = models.CharField(_('preferred host'), max_length=255, blank=True)
+    pinned = models.BooleanField(_('pinned to preferred host'), default=False)
+    host = models.CharField(_('host'), max_length=255, blank=True)
+
+    class Meta:
+        verbose_name = _('scheduled task')
+        verbose_name_plural = _('scheduled tasks')
+        index_together = [('dispatched_at', 'finished_at'), ('repo', 'dispatched_at')]
+        ordering = ['queued_at']
+
+    @property
+    def queue(self):
+        return settings.CELERY_ROUTES[self.task]['queue']
+
+    @property
+    def wait_time(self):
+        return (self.dispatched_at or timezone.now()) - self.queued_at
+
+
+class HostAffinity(models.Model):
+    """ The worker host which most recently built a repository, and so has its image layers cached. """
+    repo = models.CharField(_('repository'), max_length=255, unique=True)
+    host = models.CharField(_('host'), max_length=255)
+    updated_at = models.DateTimeField(_('updated at'), auto_now=True)
+
+
+class WorkerHost(models.Model):
+    """
+    Hosts with a running worker, only these are sent tasks through their own
+    queue. A worker refreshes `seen_at` every `SHIPMASTER_HEARTBEAT_INTERVAL`
+    seconds, see `alive_hosts()`.
+    """
+    name = models.CharField(_('name'), max_length=255, unique=True)
+    online = models.BooleanField(_('online'), default=False)
+    seen_at = models.DateTimeField(_('seen at'), auto_now=True)
+
+
+@contextmanager
+def dispatch_lock():
+    """
+    Serializes dispatching across web and worker processes. On a database
+    server shared by several hosts the rows of the waiting tasks are
+    locked, SQLite can't lock rows and only serves a single host, so a
+    lock file next to it is used instead.
+    """
+    if connection.vendor == 'sqlite':
+        with open(os.path.join(settings.SHIPMASTER_DATA, 'scheduler.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+    else:
+        with transaction.atomic():
+            list(ScheduledTask.objects.select_for_update()
+                 .filter(dispatched_at__isnull=True).order_by('pk').values_list('pk', flat=True))
+            yield
+
+
+def submit(task, repo, path, task_id, host=None, pin=False):
+    """
+    Queues `task(path)` for `repo` and dispatches whatever can run now.
+    The task prefers to run on `host`, by default the host which last
+    built `repo`. A task with `pin` waits while that host is offline or
+    busy, for at most `SHIPMASTER_PIN_TIMEOUT` seconds, see `dispatch()`.
+    """
+    if host is None:
+        host = HostAffinity.objects.filter(repo=repo).values_list('host', flat=True).first()
+    ScheduledTask.objects.create(
+        task_id=task_id, task=task, path=path, repo=repo, affinity=host or '', pinned=pin and bool(host),
+        priority=settings.SHIPMASTER_TASK_PRIORITY[task]
+    )
+    dispatch()
+
+
+def cancel(task_id):
+    """ Drops a task still waiting for a slot, returns `False` if it was already dispatched. """
+    deleted, _ = ScheduledTask.objects.filter(task_id=task_id, dispatched_at__isnull=True).delete()
+    return bool(deleted)
+
+
+def finished(task_id):
+    """ Releases the slot held by `task_id`, and gives it to the next task. """
+    if ScheduledTask.objects.filter(task_id=task_id, finished_at__isnull=True).update(finished_at=timezone.now()):
+        dispatch()
+
+
+def alive_hosts():
+    """ Names of the hosts whose worker is online and sent a heartbeat within `SHIPMASTER_HOST_TIMEOUT`. """
+    return set(WorkerHost.objects.filter(
+        online=True, seen_at__gt=timezone.now() - timedelta(seconds=settings.SHIPMASTER_HOST_TIMEOUT)
+    ).values_list('name', flat=True))
+
+
+def running(alive=None):
+    """
+    Dispatched tasks still holding a slot. Tasks sent to or started on a
+    host which is no longer `alive` are presumed lost with its worker,
+    however long they ran. Tasks on a shared queue which no worker picked
+    up yet keep their slot.
+    """
+    if alive is None:
+        alive = alive_hosts()
+    return ScheduledTask.objects.filter(
+        dispatched_at__isnull=False, finished_at__isnull=True
+    ).filter(Q(host='') | Q(host__in=alive))
+
+
+def dispatch():
+    """
+    Sends waiting tasks to Celery. Within the highest waiting priority the
+    repositories take turns, the one dispatched from least recently goes
+    first, and no repository gets more than `SHIPMASTER_REPO_CONCURRENCY`
+    slots. Deployments have the highest priority and are not capped.
+
+    A task goes to the queue of its preferred host, where the images it
+    needs are cached, unless that host's worker is offline or already
+    busy with `SHIPMASTER_HOST_CONCURRENCY` tasks. Then it goes to the
+    shared queue of its task type, for any worker to pick up. Pinned
+    tasks keep waiting for their host instead, deployments among them
+    are not held back by its concurrency. Once a pinned task waited for
+    `SHIPMASTER_PIN_TIMEOUT` seconds it is unpinned and falls back like
+    any other task, rebuilding or pulling its images on another host.
+
+    Besides whenever a task is submitted or finishes, celery beat runs this
+    periodically, so that the slots of tasks lost with their host are
+    handed on.
+    """
+    from .celery import app, host_queue
+    cap = settings.SHIPMASTER_REPO_CONCURRENCY
+    host_cap = settings.SHIPMASTER_HOST_CONCURRENCY
+    uncapped = settings.SHIPMASTER_TASK_PRIORITY['shipmaster.server.tasks.deploy_app']
+    with dispatch_lock():
+        online = alive_hosts()
+        busy = dict(running(online).order_by().values_list('repo').annotate(count=Count('id')))
+        load = dict(running(online).exclude(host='').order_by().values_list('host').annotate(count=Count('id')))
+        last_turn = dict(ScheduledTask.objects.filter(dispatched_at__isnull=False)
+                         .order_by().values_list('repo').annotate(last=Max('dispatched_at')))
+        waiting = list(ScheduledTask.objects.filter(dispatched_at__isnull=True)
+                       .order_by('-priority', 'queued_at'))
+        epoch = timezone.now() - timedelta(days=365 * 100)
+
+        pin_deadline = timezone.now() - timedelta(seconds=settings.SHIPMASTER_PIN_TIMEOUT)
+        for task in waiting:
+            if task.pinned and task.queued_at < pin_deadline:
+                logger.warning("{} for {} waited {} for host {}, sending it to any host.".format(
+                    task.task, task.path, timezone.now() - task.queued_at, task.affinity))
+                task.pinned = False
+                task.save(update_fields=['pinned'])
+
+        def runnable(task):
+            if task.priority < uncapped and busy.get(task.repo, 0) >= cap:
+                return False
+            if task.pinned:
+                return task.affinity in online and (
+                    task.priority >= uncapped or load.get(task.affinity, 0) < host_cap
+                )
+            return True
+
+        while waiting:
+            candidates = [task for task in waiting if runnable(task)]
+            if not candidates:
+                break
+            priority = candidates[0].priority
+            # oldest task of the repository whose turn it is
+            task = min(
+                (task for task in candidates if task.priority == priority),
+                key=lambda task: (last_turn.get(task.repo, epoch), task.queued_at)
+            )
+            waiting.remove(task)
+            task.dispatched_at = timezone.now()
+            if task.pinned or (task.affinity in online and load.get(task.affinity, 0) < host_cap):
+                task.host = task.affinity
+                load[task.host] = load.get(task.host, 0) + 1
+            task.save(update_fields=['dispatched_at', 'host'])
+            busy[task.repo] = busy.get(task.repo, 0) + 1
+            last_turn[task.repo] = task.dispatched_at
+            # a worker must not pick the task up before its slot is committed
+            transaction.on_commit(partial(
+                app.send_task, task.task, args=(task.path,), task_id=task.task_id,
+                queue=host_queue(task.host) if task.host else task.queue, priority=task.priority
+            ))
+
+
+def stats():
+    """ Per queue: tasks waiting and running, the oldest wait and the average wait of the last hour. """
+    now = timezone.now()
+    rows = {}
+    for task, queue in ((task, route['queue']) for task, route in settings.CELERY_ROUTES.items()):
+        if task not in settings.SHIPMASTER_TASK_PRIORITY:
+            continue
+        waiting = ScheduledTask.objects.filter(task=task, dispatched_at__isnull=True)
+        recent = list(ScheduledTask.objects.filter(task=task, dispatched_at__gte=now - timedelta(hours=1)))
+        oldest = waiting.aggregate(oldest=Min('queued_at'))['oldest']
+        rows[queue] = {
+            'waiting': waiting.count(),
+            'running': running().filter(task=task).count(),
+            'oldest_wait': (now - oldest) if oldest else None,
+            'average_wait': sum((task.wait_time for task in recent), timedelta()) / len(recent) if recent else None,
+        }
+    return rows
+
+
+def load_by_host():
+    """ Per worker host: whether it is alive and the number of tasks sent to or running on it. """
+    alive = alive_hosts()
+    load = dict(running(alive).exclude(host='').order_by().values_list('host').annotate(count=Count('id')))
+    return {
+        name: (name in alive, load.get(name, 0))
+        for name in WorkerHost.objects.values_list('name', flat=True)
+    }
+
+
+def waiting_by_repository():
+    return dict(ScheduledTask.objects.filter(dispatched_at__isnull=True)
+                .order_by().values_list('repo').annotate(count=Count('id')))
+
+
+def prune(before):
+    """ Forgets tasks which finished, or were presumed lost, before `before`. """
+    ScheduledTask.objects.filter(finished_at__lt=before).delete()
+    ScheduledTask.objects.filter(finished_at__isnull=True, dispatched_at__lt=before)\
+        .exclude(pk__in=running().values('pk')).delete()
+
+
+def task_started(sender=None, task_id=None, **kwargs):
+    """
+    Handler for Celery's `task_prerun` signal, records the host running the
+    task, for builds this host becomes the repository's preferred host.
+    """
+    host = settings.SHIPMASTER_HOST
+    ScheduledTask.objects.filter(task_id=task_id).update(host=host)
+    if sender.name == 'shipmaster.server.tasks.build_app':
+        repo = ScheduledTask.objects.filter(task_id=task_id).values_list('repo', flat=True).first()
+        if repo:
+            HostAffinity.objects.update_or_create(repo=repo, defaults={'host': host})
+
+
+_shutdown = threading.Event()
+
+
+def heartbeat():
+    """ Marks this host alive until its worker shuts down, see `alive_hosts()`. """
+    while not _shutdown.is_set():
+        try:
+            WorkerHost.objects.update_or_create(name=settings.SHIPMASTER_HOST, defaults={'online': True})
+        except Exception:
+            logger.exception('Could not record the heartbeat of {}:'.format(settings.SHIPMASTER_HOST))
+        _shutdown.wait(settings.SHIPMASTER_HEARTBEAT_INTERVAL)
+
+
+def worker_ready(**kwargs):
+    """ Handler for Celery's `worker_ready` signal, this host's queue is now consumed. """
+    WorkerHost.objects.update_or_create(name=settings.SHIPMASTER_HOST, defaults={'online': True})
+    threading.Thread(target=heartbeat, name='heartbeat', daemon=True).start()
+    dispatch()
+
+
+def worker_shutdown(**kwargs):
+    """ Handler for Celery's `worker_shutdown` signal. """
+    _shutdown.set()
+    WorkerHost.objects.filter(name=settings.SHIPMASTER_HOST).update(online=False)
+
+
+def task_finished(sender=None, task_id=None, request=None, **kwargs):
+    """ Handler for Celery's `task_postrun` and `task_revoked` signals. """
+    finished(task_id or request.id)
@@ -0,0 +1,81 @@
+import time
+import logging
+import threading
+
+import requests
+
+from shipmaster.core.background import BackgroundSender
+
+logger = logging.getLogger('shipmaster')
+
+
+class GitHubStatusUpdater(BackgroundSender):
+    """
+    Publishes GitHub commit statuses from a background thread over one
+    reused HTTP session, so that state transitions never wait on GitHub.
+
+    Pending statuses are keyed by (repository, sha, context): when a newer
+    state arrives before the previous one was sent only the newest is
+    published. Server errors and connection failures are retried with
+    exponential backoff, statuses GitHub rejects are dropped, and when the
+    rate limit is exhausted publishing pauses until it resets.
+    """
+
+    API = 'https://api.github.com/repos/{account}/{repo}/statuses/{sha}'
+    RETRIES = 5
+    BACKOFF = 2  # seconds, doubled after every failed attempt
+    MAX_BACKOFF = 300
+
+    def __init__(self, token):
+        super().__init__('github-status')
+        self.token = token
+        self.session = requests.Session()
+        self.session.headers.update({
+            'Accept': 'application/vnd.github.v3+json',
+            'Authorization': 'token {}'.format(token),
+        })
+
+    def publish(self, account, repo, sha, state, target_url, description, context):
+        """ Queues a status and returns immediately. """
+        payload = {'state': state, 'target_url': target_url, 'description': description, 'context': context}
+        with self.condition:
+            self.queue((account, repo, sha, context), [payload, 0])
+
+    def send(self, key, item):
+        account, repo, sha, context = key
+        payload, attempts = item
+        try:
+            response = self.session.post(
+                self.API.format(account=account, repo=repo, sha=sha),
+                json=payload, timeout=self.TIMEOUT
+            )
+            if response.status_code in (403, 429) and response.headers.get('X-RateLimit-Remaining') == '0':
+                reset = float(response.headers.get('X-RateLimit-Reset', time.time() + 60))
+                logger.warning('GitHub rate limit exhausted, pausing status updates until {}.'.format(
+                    time.strftime('%H:%M:%S', time.localtime(reset))))
+                with self.condition:
+                    self.paused_until = reset
+                return reset  # not counted as a failed attempt
+            elif 400 <= response.status_code < 500:
+                # unknown sha, repository or permissions, retrying won't help
+                logger.error('GitHub rejected status {} for {}: {} {}'.format(
+                    context, sha, response.status_code, response.text[:200]))
+            else:
+                response.raise_for_status()
+        except requests.RequestException as exc:
+            item[1] = attempts = attempts + 1
+            if attempts < self.RETRIES:
+                return time.time() + min(self.BACKOFF * 2 ** (attempts - 1), self.MAX_BACKOFF)
+            logger.error('Giving up on GitHub status {} for {}: {}'.format(context, sha, exc))
+
+
+_updaters = {}
+_updaters_lock = threading.Lock()
+
+
+def get_status_updater(token):
+    """ One publisher per GitHub token and process. """
+    with _updaters_lock:
+        if token not in _updaters:
+            _updaters[token] = GitHubStatusUpdater(token)
+        return _updaters[token]
@@ -0,0 +1,216 @@
+import os
+import copy
+import fcntl
+import time
+import threading
+from collections import OrderedDict
+from tempfile import NamedTemporaryFile
+from urllib.parse import quote
+from ruamel import yaml
+
+
+class YamlCache:
+    """
+    Process wide LRU cache of parsed model YAML files. Entries are keyed by path
+    and validated against the file's inode, modification time and size on every
+    lookup, so changes made by other processes are picked up. Copies are handed
+    out since models modify their `dict` in place.
+
+    Files are replaced rather than rewritten, which gives every save a new
+    inode. Files modified within `RECENT` seconds are read again anyway: two
+    saves within one tick of a coarse file system clock could otherwise look
+    the same, should the second one reuse the inode freed by the first.
+    """
+
+    MAX_ENTRIES = 1024
+    RECENT = 2  # seconds
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _signature(path):
+        stat = os.stat(path)
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _store(self, path, signature, data):
+        with self.lock:
+            self.entries[path] = (signature, data)
+            self.entries.move_to_end(path)
+            while len(self.entries) > self.MAX_ENTRIES:
+                self.entries.popitem(last=False)
+
+    def load(self, path):
+        signature = self._signature(path)
+        settled = time.time() - signature[1] / 1e9 > self.RECENT
+        with self.lock:
+            entry = self.entries.get(path)
+            if settled and entry and entry[0] == signature:
+                self.entries.move_to_end(path)
+                return copy.deepcopy(entry[1])
+        with open(path, 'r') as file:
+            data = yaml.load(file)
+        self._store(path, signature, copy.deepcopy(data))
+        return data
+
+    def save(self, path, data):
+        """
+        Writes `data` to a temporary file which then replaces `path`, so that
+        readers only ever see complete files, and updates the entry for `path`.
+        """
+        file = NamedTemporaryFile('w', dir=os.path.dirname(path), prefix='.', delete=False)
+        try:
+            with file:
+                file.write(yaml.dump(data))
+            os.chmod(file.name, 0o644)
+            os.replace(file.name, path)
+        except:
+            self.invalidate(path)
+            try:
+                os.remove(file.name)
+            except FileNotFoundError:
+                pass
+            raise
+        self._store(path, self._signature(path), copy.deepcopy(data))
+
+    def invalidate(self, path):
+        with self.lock:
+            self.entries.pop(path, None)
+
+
+yaml_cache = YamlCache()
+
+
+class Journal:
+    """
+    Append-only record of the state transitions of a build or job, one
+    `<timestamp> <event>` line per transition. The whole file is read once,
+    on first use, instead of checking a marker file per event.
+
+    `legacy` maps events to the marker files written by older versions,
+    these are imported when there is no journal yet.
+    """
+
+    def __init__(self, path, legacy=None):
+        self.path = path
+        self.legacy = legacy or {}
+        self._events = None
+        self._imported = False
+
+    @property
+    def events(self):
+        """ All `(timestamp, event)` transitions in the order they happened. """
+        if self._events is None:
+            self._events = self._read()
+        return self._events
+
+    def _read(self):
+        try:
+            with open(self.path, 'r') as file:
+                lines = file.read().splitlines()
+        except FileNotFoundError:
+            return self._read_legacy()
+        events = []
+        for line in lines:
+            timestamp, _, event = line.partition(' ')
+            try:
+                events.append((float(timestamp), event))
+            except ValueError:
+                continue
+        return events
+
+    def _read_legacy(self):
+        events = []
+        for event, path in self.legacy.items():
+            try:
+                with open(path, 'r') as file:
+                    events.append((float(file.read()), event))
+            except (OSError, ValueError):
+                continue
+        self._imported = bool(events)
+        return sorted(events)
+
+    def record(self, event):
+        entry = (time.time(), event)
+        entries = [entry]
+        if self.events and self._imported:
+            # first write after an upgrade, persist the legacy markers too
+            entries = self.events + entries
+            self._imported = False
+        data = ''.join('{:.6f} {}\n'.format(*entry) for entry in entries)
+        # a single O_APPEND write, concurrent writers never interleave lines
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, data.encode())
+        finally:
+            os.close(fd)
+        self.events.append(entry)
+
+    def time(self, event):
+        """ Timestamp of the most recent `event`, `None` if it never happened. """
+        for timestamp, recorded in reversed(self.events):
+            if recorded == event:
+                return timestamp
+
+    def has(self, event):
+        return self.time(event) is not None
+
+    def elapsed(self, begin, end):
+        return self.time(end) - self.time(begin)
+
+
+def claim_next_number(counter_path, parent_dir):
+    """
+    Allocates the next number from a counter file and claims it by creating
+    the `<parent_dir>/<number>` directory, returning the number as a string.
+
+    The counter is read and updated under an exclusive `flock`, so concurrent
+    web and worker processes are serialized only for the few syscalls this
+    takes. `mkdir` is the actual claim: should the counter ever fall behind
+    (lost or restored file), numbers that are already taken are skipped.
+    """
+    fd = os.open(counter_path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        last = os.read(fd, 32).strip()
+        number = int(last) if last else 0
+        while True:
+            number += 1
+            try:
+                os.mkdir(os.path.join(parent_dir, str(number)))
+                break
+            except FileExistsError:
+                continue
+        os.ftruncate(fd, 0)
+        os.pwrite(fd, str(number).encode(), 0)
+    finally:
+        os.close(fd)  # also releases the lock
+    return str(number)
+
+
+def claim_commit(directory, sha, branch, pull_request=None):
+    """
+    Marks `sha` as built for the push to `branch`, or for `pull_request`,
+    with a marker file in `directory`. Returns the marker, to be removed
+    should creating the build fail, or `None` when the commit was already
+    claimed. Push and pull request events for the same commit arrive in
+    either order, whichever comes first is built and the other one is not.
+    Pushes of a commit to several branches are all built.
+    """
+    os.makedirs(directory, exist_ok=True)
+    if pull_request:
+        claim = os.path.join(directory, '{}.pull.{}'.format(sha, pull_request))
+        other = sha + '.push.'
+    else:
+        claim = os.path.join(directory, '{}.push.{}'.format(sha, quote(branch, safe='')))
+        other = sha + '.pull.'
+    with open(os.path.join(directory, '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if any(name.startswith(other) for name in os.listdir(directory)):
+            return None
+        try:
+            os.close(os.open(claim, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            return None
+    return claim
@@ -1,174 +1,342 @@
 import os
-import select
+import fcntl
+import shutil
 import logging
 import subprocess
-from logging import FileHandler
-from .models import Build, Deployment, Test, Infrastructure
+from django.conf import settings
+from shipmaster.core.builder import docker_client
+from shipmaster.core.config import BuildConfig
+from shipmaster.core.script import parse_dockerignore
+from . import gc, scheduler
+from .models import Shipmaster, Repository, Build, Deployment, Test, Infrastructure
+from .joblog import job_log, run
 from celery import shared_task
+from github3.exceptions import GitHubError
 
 
 logger = logging.getLogger('shipmaster')
-_LOG_HANDLER = None
 
 
-def _disable_others():
-    logging.getLogger('github3').setLevel(logging.WARNING)
-    logging.getLogger('requests').setLevel(logging.WARNING)
+def update_mirror(repo, env):
+    """
+    Creates or updates the bare mirror of `repo` which workspaces are cloned
+    from, so only new objects are ever fetched from the remote. Concurrent
+    builds of the same repository wait for each other's fetch. A blobless
+    mirror is cloned again in full once sparse checkouts are turned off.
+    """
+    with open(repo.path.mirror_lock, 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.exists(os.path.join(repo.path.mirror, 'HEAD')):
+            if repo.sparse_checkout or not is_blobless(repo.path.mirror):
+                return run(["git", "fetch", "--prune", "origin"], cwd=repo.path.mirror, env=env)
+            logger.info("Sparse checkout was turned off, cloning the whole repository.")
+        shutil.rmtree(repo.path.mirror, ignore_errors=True)
+        cmd = ["git", "clone", "--mirror"]
+        if repo.sparse_checkout:
+            # blobs are only fetched for the paths builds actually check out
+            cmd += "--filter=blob:none",
+        cmd += repo.project_git, repo.path.mirror
+        return run(cmd, env=env)
+
+
+def is_blobless(mirror):
+    """ Whether `mirror` was cloned without blobs, missing ones are then fetched on demand. """
+    result = subprocess.run(
+        ["git", "config", "--get", "remote.origin.promisor"],
+        cwd=mirror, stdout=subprocess.PIPE, universal_newlines=True
+    )
+    return result.stdout.strip() == 'true'
 
 
-def _replace_handler(handler):
-    global _LOG_HANDLER
-    root = logging.getLogger()
-    root.setLevel(logging.INFO)
-    if _LOG_HANDLER:
-        _LOG_HANDLER.close()
-        root.removeHandler(_LOG_HANDLER)
+def resolve_commit(build):
+    """ Sha of the commit to build, pull requests build GitHub's merge commit. """
+    if build.pull_request:
+        ref = "refs/pull/{}/merge".format(build.pull_request)
     else:
-        _disable_others()
-    _LOG_HANDLER = handler
-    root.addHandler(handler)
+        ref = build.sha or "refs/heads/"+build.branch
+    result = subprocess.run(
+        ["git", "rev-parse", "--verify", "-q", ref+"^{commit}"],
+        cwd=build.repo.path.mirror, stdout=subprocess.PIPE, universal_newlines=True
+    )
+    return result.stdout.strip() if result.returncode == 0 else None
+
 
+# changes to these can affect every image, sparse checkouts always include them
+PIPELINE_FILES = ('.shipmaster.yaml', '.dockerignore', 'docker-compose.yaml', 'docker-compose.yml')
 
-def run(command, cwd=None, env=None):
-    logger.info("+ {}".format(' '.join(command)))
 
-    env = {**os.environ, **(env or {})}
-    child = subprocess.Popen(
-        command,
-        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-        cwd=cwd, env=env, universal_newlines=True
+def sparse_checkout_patterns(build, sha, env):
+    """
+    Reads `.shipmaster.yaml` at `sha` straight from the mirror and returns
+    sparse checkout patterns covering the `context` of every image, the
+    config and the compose files. `None` when the whole tree is needed.
+    """
+    result = subprocess.run(
+        ["git", "show", "{}:.shipmaster.yaml".format(sha)],
+        cwd=build.repo.path.mirror, env={**os.environ, **env}, stdout=subprocess.PIPE
     )
+    if result.returncode != 0:
+        return None
+    try:
+        config = BuildConfig.from_string(result.stdout)
+    except ValueError:
+        return None  # let the full checkout report the problem
+    paths = set()
+    for image in config.image_configs.values():
+        for context in image.context:
+            path = os.path.normpath(context).strip('/')
+            if path in ('', '.') or path.startswith('..'):
+                return None
+            paths.add(path)
+    return ['/'+path for path in sorted(paths) + list(PIPELINE_FILES)]
+
+
+def configure_partial_clone(workspace):
+    """
+    Lets a workspace cloned from a blobless mirror fetch the blobs it is
+    missing from the remote, only for the paths being checked out.
+    """
+    for key, value in [('core.repositoryformatversion', '1'),
+                       ('extensions.partialClone', 'origin'),
+                       ('remote.origin.promisor', 'true'),
+                       ('remote.origin.partialclonefilter', 'blob:none')]:
+        if run(["git", "config", key, value], cwd=workspace) != 0:
+            return 1
+    return 0
+
+
+def skip_reason(repo, config, head_sha, changed):
+    """ Why building `changed` paths is pointless, `None` if some image is affected by them. """
+    if changed is None or any(path in PIPELINE_FILES for path in changed):
+        return None
+    dockerignore = repo.get_github().file_contents('.dockerignore', head_sha)
+    exclude = parse_dockerignore(dockerignore.decoded.decode('utf-8')) if dockerignore else []
+    if config.images_affected_by(changed, exclude):
+        return None
+    return "no image affected by changes to {}".format(', '.join(changed))
+
+
+# GitHub lists at most this many files when comparing two commits
+COMPARE_FILES_LIMIT = 300
+
+
+def changed_since(repo, base_sha, head_sha):
+    """
+    Paths changed from `base_sha` to `head_sha`, `None` when GitHub can't
+    list all of them or `head_sha` does not descend from `base_sha`.
+    """
+    try:
+        comparison = repo.get_github().compare_commits(base_sha, head_sha)
+    except GitHubError as exc:
+        logger.warning("Could not compare {}...{}: {}".format(base_sha, head_sha, exc))
+        return None
+    if comparison is None or comparison.status not in ('ahead', 'identical'):
+        return None
+    if len(comparison.files) >= COMPARE_FILES_LIMIT:
+        return None
+    changed = set()
+    for file in comparison.files:
+        changed.add(file['filename'])
+        if file.get('previous_filename'):
+            changed.add(file['previous_filename'])
+    return sorted(changed)
 
-    log_level = {child.stdout: logging.INFO,
-                 child.stderr: logging.ERROR}
 
-    def check_io():
-        ready_to_read = select.select([child.stdout, child.stderr], [], [], 1000)[0]
-        for io in ready_to_read:
-            line = io.readline()
-            logger.log(log_level[io], line.rstrip())
+@shared_task
+def intake_event(repo_name, branch, sha, head_sha, pull_request=None, changed=None, before=None):
+    """
+    Decides whether a GitHub push or pull request event should be built,
+    queued by the webhook view so GitHub gets its response right away.
+    `sha` is the pushed commit or the pull request's base, `head_sha` is
+    the commit being tested in both cases. `changed` are the paths touched
+    by a push on top of `before`, `None` when they are not known.
+    """
+    shipmaster = Shipmaster.from_path(settings.SHIPMASTER_DATA)
+    repo = Repository.load(shipmaster, repo_name)
+
+    yaml_contents = repo.get_github().file_contents('.shipmaster.yaml', head_sha)
+    if not yaml_contents:
+        return
+    try:
+        config = BuildConfig.from_string(yaml_contents.decoded)
+    except ValueError as exc:
+        logger.warning("Invalid .shipmaster.yaml in {} at {}: {}".format(repo_name, head_sha, exc))
+        return
 
-    while child.poll() is None:
-        check_io()
+    if not config.triggers(branch, pull_request):
+        return
+    claim = repo.claim_commit(head_sha, branch, pull_request)
+    if not claim:
+        return
 
-    return child.wait()
+    try:
+        # builds waiting for the same branch or pull request are superseded
+        repo.cancel_queued_builds(branch, pull_request)
+        build = Build.create(repo, branch, sha, pull_request, automated=True)
+    except:
+        # let a redelivery of the event try again
+        repo.release_commit(claim)
+        raise
+
+    # the previous build's images still apply when nothing in their context changed
+    previous = repo.query_builds(branch=branch, pull_request__isnull=True, result=Build.SUCCEEDED)\
+        .exclude(number=build.number).first()
+    reason = None
+    if previous and previous.sha and pull_request is None:
+        # the push only tells what changed since `before`, which need not be the previous build
+        if before != previous.sha:
+            changed = changed_since(repo, previous.sha, head_sha)
+        reason = skip_reason(repo, config, head_sha, changed)
+    if reason:
+        logger.info("Skipping build #{} of {}: {}".format(build.number, repo_name, reason))
+        build.skip(reason, previous.number)
+    else:
+        build.build()
 
 
 @shared_task
 def build_app(path):
     build = Build.from_path(path)
-    _replace_handler(FileHandler(build.path.log))
-    git_ssh_command = {"GIT_SSH_COMMAND": "ssh -F {}".format(build.shipmaster.path.ssh_config)}
+    if build.is_cancelled:
+        return
+    with job_log(build.path.log, cancelled=build.cancel_requested):
+        git_ssh_command = {"GIT_SSH_COMMAND": "ssh -F {}".format(build.shipmaster.path.ssh_config)}
 
-    build.cloning_started()
-    try:
+        build.host = settings.SHIPMASTER_HOST
+        build.cloning_started()
+        try:
 
-        cmd = ["git", "clone", "--depth=50"]
-        if not build.pull_request:
-            cmd += "--branch={}".format(build.branch),
-        cmd += build.repo.project_git,
-        cmd += build.path.workspace,
-        if run(cmd, env=git_ssh_command) != 0:
-            return build.failed()
+            if update_mirror(build.repo, git_ssh_command) != 0:
+                return build.failed()
+
+            sha = resolve_commit(build)
+            if not sha:
+                logger.error("Could not find the commit to build in the mirror.")
+                return build.failed()
+            build.capture_commit(sha)
 
-        if build.pull_request:
-            if run(["git", "fetch", "origin",
-                    "+refs/pull/{}/merge:".format(build.pull_request)],
-                    env=git_ssh_command, cwd=build.path.workspace) != 0:
+            # objects are borrowed from the mirror through alternates instead of being copied
+            if run(["git", "clone", "--shared", "--no-checkout",
+                    build.repo.path.mirror, build.path.workspace]) != 0:
                 return build.failed()
+            run(["git", "remote", "set-url", "origin", build.repo.project_git], cwd=build.path.workspace)
+
+            # blobs missing from the mirror are fetched for whatever gets checked out
+            if is_blobless(build.repo.path.mirror) and configure_partial_clone(build.path.workspace) != 0:
+                return build.failed()
+            if build.repo.sparse_checkout:
+                patterns = sparse_checkout_patterns(build, sha, git_ssh_command)
+                if patterns:
+                    logger.info("Sparse checkout of: {}".format(', '.join(patterns)))
+                    if run(["git", "sparse-checkout", "set", "--no-cone"] + patterns,
+                           cwd=build.path.workspace) != 0:
+                        return build.failed()
 
-        if build.pull_request or build.sha:
             cmd = ["git", "checkout", "-qf"]
-            if build.pull_request:
-                cmd += "FETCH_HEAD",
-            else:
-                cmd += build.sha,
+            if not build.pull_request:
+                cmd += "-B", build.branch
+            cmd += sha,
             if run(cmd, env=git_ssh_command, cwd=build.path.workspace) != 0:
                 return build.failed()
 
-    except:
-        logger.exception("Git clone process threw an exception:")
-        return build.failed()
-    finally:
-        build.cloning_finished()
+        except:
+            logger.exception("Git clone process threw an exception:")
+            return build.failed()
+        finally:
+            build.cloning_finished()
 
-    build.build_started()
-    try:
-        project = build.get_project()
-        if not project.base.exists():
-            if project.base.build() != 0:
+        if build.cancel_requested():
+            return build.failed()
+
+        build.build_started()
+        try:
+            project = build.get_project()
+            if not project.base.exists():
+                if project.base.build() != 0:
+                    return build.failed()
+            if project.app.build() != 0:
                 return build.failed()
-        if project.app.build() != 0:
+        except:
+            logger.exception("Build process threw an exception:")
             return build.failed()
-    except:
-        logger.exception("Build process threw an exception:")
-        return build.failed()
-    finally:
-        build.build_finished()
+        finally:
+            build.build_finished()
 
-    build.succeeded()
+        build.succeeded()
 
-    if build.automated:
-        Test.create(build).test()
+        if build.automated:
+            Test.create(build).test()
 
 
 @shared_task
 def test_app(path):
     test = Test.from_path(path)
-    _replace_handler(FileHandler(test.path.log))
-    project = test.get_project()
-    compose = test.get_compose(project)
-    test.started()
-    try:
-        if project.test.build() != 0:
-            return test.failed()
-        if project.test.run(compose, test.path.reports) != 0:
+    with job_log(test.path.log):
+        project = test.get_project()
+        compose = test.get_compose(project)
+        test.started()
+        try:
+            if project.test.build() != 0:
+                return test.failed()
+            if project.test.run(compose, test.path.reports) != 0:
+                return test.failed()
+        except:
+            logger.exception("Test process threw an exception:")
             return test.failed()
-    except:
-        logger.exception("Test process threw an exception:")
-        return test.failed()
-    finally:
-        test.finished()
+        finally:
+            test.finished()
 
-    test.succeeded()
+        test.succeeded()
 
-    if test.build.automated:
-        Deployment.create(test.build, 'sandbox').deploy()
+        if test.build.automated:
+            Deployment.create(test.build, 'sandbox').deploy()
 
 
 @shared_task
 def deploy_app(path):
     deployment = Deployment.from_path(path)
-    _replace_handler(FileHandler(deployment.path.log))
-    project = deployment.get_project()
-    deployment.started()
-    try:
-        if project.app.deploy(
-                deployment.shipmaster.infrastructure.compose,
-                deployment.destination) != 0:
+    with job_log(deployment.path.log):
+        project = deployment.get_project()
+        deployment.started()
+        try:
+            if project.app.deploy(
+                    deployment.shipmaster.infrastructure.compose,
+                    deployment.destination) != 0:
+                return deployment.failed()
+        except:
+            logger.exception("Deployment process threw an exception:")
             return deployment.failed()
-    except:
-        logger.exception("Deployment process threw an exception:")
-        return deployment.failed()
-    finally:
-        deployment.finished()
+        finally:
+            deployment.finished()
 
-    deployment.succeeded()
+        deployment.succeeded()
 
 
 @shared_task
 def sync_infrastructure(path):
     infra = Infrastructure.from_path(path)
     if infra.is_checkout_running: return
-    _replace_handler(FileHandler(infra.path.log, 'w'))
-    git_ssh_command = {"GIT_SSH_COMMAND": "ssh -F {}".format(infra.shipmaster.path.ssh_config)}
-    infra.checkout_started()
-    try:
-        if os.path.exists(infra.path.src):
-            run(["git", "pull"], cwd=infra.path.src, env=git_ssh_command)
-        else:
-            run(["git", "clone", infra.project_git, infra.path.src], env=git_ssh_command)
-    except:
-        logger.exception("Failed to update infrastructure sources:")
-    finally:
-        infra.checkout_finished()
+    with job_log(infra.path.log, 'w'):
+        git_ssh_command = {"GIT_SSH_COMMAND": "ssh -F {}".format(infra.shipmaster.path.ssh_config)}
+        infra.checkout_started()
+        try:
+            if os.path.exists(infra.path.src):
+                run(["git", "pull"], cwd=infra.path.src, env=git_ssh_command)
+            else:
+                run(["git", "clone", infra.project_git, infra.path.src], env=git_ssh_command)
+        except:
+            logger.exception("Failed to update infrastructure sources:")
+        finally:
+            infra.checkout_finished()
+
+
+@shared_task
+def dispatch_tasks():
+    """ Hands on the slots of tasks lost with their host, see `scheduler.dispatch()`. """
+    scheduler.dispatch()
+
+
+@shared_task
+def collect_garbage():
+    shipmaster = Shipmaster.from_path(settings.SHIPMASTER_DATA)
+    gc.collect_garbage(shipmaster, docker_client())
@@ -1,3 +1,417 @@
-from django.test import TestCase
+import os
+import time
+from datetime import timedelta
+from importlib import import_module
+from tempfile import TemporaryDirectory
+from unittest import mock
 
-# Create your tests here.
+from django.apps import apps
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from docker.errors import APIError
+
+from . import scheduler
+from .celery import app
+from .gc import RetentionPolicy, collect_images, collect_repository, prune_commit_markers
+from .index import BuildRecord, JobRecord
+from .models import Build, Deployment, Repository, Shipmaster
+from .scheduler import ScheduledTask, WorkerHost
+
+BUILD = 'shipmaster.server.tasks.build_app'
+TEST = 'shipmaster.server.tasks.test_app'
+DEPLOY = 'shipmaster.server.tasks.deploy_app'
+
+
+class SchedulerTestCase(TransactionTestCase):
+    """ Runs the scheduler against the test database, capturing the tasks it sends to Celery. """
+
+    def setUp(self):
+        self.data = TemporaryDirectory()
+        self.addCleanup(self.data.cleanup)
+        overrides = override_settings(
+            SHIPMASTER_DATA=self.data.name, SHIPMASTER_REPO_CONCURRENCY=1, SHIPMASTER_HOST_CONCURRENCY=2
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        patcher = mock.patch.object(app, 'send_task')
+        self.send_task = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.ids = 0
+
+    def submit(self, task, repo, host='', pin=False):
+        self.ids += 1
+        task_id = 'task-{}'.format(self.ids)
+        scheduler.submit(task, repo, '/{}/{}'.format(repo, self.ids), task_id, host=host, pin=pin)
+        return task_id
+
+    def host(self, name, seen=0):
+        """ A worker host whose last heartbeat was `seen` seconds ago. """
+        WorkerHost.objects.update_or_create(name=name, defaults={'online': True})
+        WorkerHost.objects.filter(name=name).update(seen_at=timezone.now() - timedelta(seconds=seen))
+
+    def started(self, task_id, host):
+        ScheduledTask.objects.filter(task_id=task_id).update(host=host)
+
+    def sent(self):
+        """ `(task id, queue name)` of the tasks sent so far. """
+        sent = []
+        for call in self.send_task.call_args_list:
+            queue = call[1]['queue']
+            sent.append((call[1]['task_id'], getattr(queue, 'name', queue)))
+        return sent
+
+    def sent_ids(self):
+        return [task_id for task_id, _ in self.sent()]
+
+
+class TestDispatch(SchedulerTestCase):
+
+    def test_repository_cap(self):
+        first = self.submit(BUILD, 'a')
+        second = self.submit(BUILD, 'a')
+        self.assertEqual(self.sent_ids(), [first])
+        scheduler.finished(first)
+        self.assertEqual(self.sent_ids(), [first, second])
+
+    def test_repositories_take_turns(self):
+        a1 = self.submit(BUILD, 'a')
+        b1 = self.submit(BUILD, 'b')
+        a2 = self.submit(BUILD, 'a')
+        a3 = self.submit(BUILD, 'a')
+        b2 = self.submit(BUILD, 'b')
+        with override_settings(SHIPMASTER_REPO_CONCURRENCY=3):
+            scheduler.dispatch()
+        # not in the order they were queued, 'b' gets its turn between those of 'a'
+        self.assertEqual(self.sent_ids(), [a1, b1, a2, b2, a3])
+
+    def test_highest_priority_first(self):
+        running = self.submit(BUILD, 'a')
+        build = self.submit(BUILD, 'a')
+        test = self.submit(TEST, 'a')
+        scheduler.finished(running)
+        self.assertEqual(self.sent_ids(), [running, test])
+        scheduler.finished(test)
+        self.assertEqual(self.sent_ids(), [running, test, build])
+
+    def test_deployments_are_not_capped(self):
+        build = self.submit(BUILD, 'a')
+        deployment = self.submit(DEPLOY, 'a')
+        self.assertEqual(self.sent_ids(), [build, deployment])
+
+    def test_preferred_host_and_fallback(self):
+        self.host('worker-1')
+        first = self.submit(BUILD, 'a', host='worker-1')
+        second = self.submit(BUILD, 'b', host='worker-1')
+        third = self.submit(BUILD, 'c', host='worker-1')
+        self.assertEqual(self.sent(), [
+            (first, 'host.worker-1'), (second, 'host.worker-1'), (third, 'builds'),
+        ])
+
+    def test_sent_once_committed(self):
+        with transaction.atomic():
+            task_id = self.submit(DEPLOY, 'a')
+            self.assertEqual(self.sent_ids(), [])
+            self.assertIsNotNone(ScheduledTask.objects.get(task_id=task_id).dispatched_at)
+        self.assertEqual(self.sent_ids(), [task_id])
+
+
+class TestPinning(SchedulerTestCase):
+
+    def waited(self, task_id, seconds):
+        ScheduledTask.objects.filter(task_id=task_id).update(queued_at=timezone.now() - timedelta(seconds=seconds))
+
+    def test_waits_for_its_host(self):
+        self.host('worker-1', seen=3600)
+        test = self.submit(TEST, 'a', host='worker-1', pin=True)
+        self.assertEqual(self.sent(), [])
+        self.host('worker-1')
+        scheduler.dispatch()
+        self.assertEqual(self.sent(), [(test, 'host.worker-1')])
+
+    def test_falls_back_once_its_host_was_dead_for_too_long(self):
+        self.host('worker-1', seen=3600)
+        test = self.submit(TEST, 'a', host='worker-1', pin=True)
+        with override_settings(SHIPMASTER_PIN_TIMEOUT=60):
+            self.waited(test, 30)
+            scheduler.dispatch()
+            self.assertEqual(self.sent(), [])
+            self.waited(test, 120)
+            scheduler.dispatch()
+        self.assertEqual(self.sent(), [(test, 'tests')])
+        self.assertFalse(ScheduledTask.objects.get(task_id=test).pinned)
+
+    def test_falls_back_once_its_host_was_busy_for_too_long(self):
+        self.host('worker-1')
+        self.submit(BUILD, 'a', host='worker-1')
+        self.submit(BUILD, 'b', host='worker-1')
+        test = self.submit(TEST, 'c', host='worker-1', pin=True)
+        self.assertEqual(len(self.sent()), 2)
+        with override_settings(SHIPMASTER_PIN_TIMEOUT=60):
+            self.waited(test, 120)
+            scheduler.dispatch()
+        self.assertEqual(self.sent()[-1], (test, 'tests'))
+
+    def test_deployments_ignore_host_concurrency(self):
+        self.host('worker-1')
+        self.submit(BUILD, 'a', host='worker-1')
+        self.submit(BUILD, 'b', host='worker-1')
+        deployment = self.submit(DEPLOY, 'c', host='worker-1', pin=True)
+        self.assertEqual(self.sent()[-1], (deployment, 'host.worker-1'))
+
+    def test_unpinned_without_host(self):
+        test = self.submit(TEST, 'a', host=None, pin=True)
+        self.assertEqual(self.sent(), [(test, 'tests')])
+
+
+class TestSlotExpiry(SchedulerTestCase):
+
+    def test_slot_held_while_host_alive(self):
+        self.host('worker-1')
+        first = self.submit(BUILD, 'a')
+        self.started(first, 'worker-1')
+        self.submit(BUILD, 'a')
+        # however long the first build runs
+        ScheduledTask.objects.filter(task_id=first).update(dispatched_at=timezone.now() - timedelta(days=1))
+        scheduler.dispatch()
+        self.assertEqual(self.sent_ids(), [first])
+
+    def test_slot_freed_when_host_dies(self):
+        self.host('worker-1')
+        first = self.submit(BUILD, 'a')
+        self.started(first, 'worker-1')
+        second = self.submit(BUILD, 'a')
+        with override_settings(SHIPMASTER_HOST_TIMEOUT=60):
+            self.host('worker-1', seen=120)
+            scheduler.dispatch()
+        self.assertEqual(self.sent_ids(), [first, second])
+
+    def test_unstarted_task_keeps_its_slot(self):
+        first = self.submit(BUILD, 'a')
+        self.submit(BUILD, 'a')
+        ScheduledTask.objects.filter(task_id=first).update(dispatched_at=timezone.now() - timedelta(days=1))
+        scheduler.dispatch()
+        self.assertEqual(self.sent_ids(), [first])
+
+    def test_prune_forgets_lost_tasks(self):
+        self.host('worker-1')
+        lost = self.submit(BUILD, 'a')
+        self.started(lost, 'worker-1')
+        running = self.submit(BUILD, 'b')
+        finished = self.submit(BUILD, 'c')
+        scheduler.finished(finished)
+        with override_settings(SHIPMASTER_HOST_TIMEOUT=60):
+            self.host('worker-1', seen=120)
+            scheduler.prune(timezone.now() + timedelta(seconds=1))
+        self.assertEqual(list(ScheduledTask.objects.values_list('task_id', flat=True)), [running])
+
+
+class TestStats(SchedulerTestCase):
+
+    def test_stats(self):
+        self.host('worker-1')
+        running = self.submit(BUILD, 'a', host='worker-1')
+        self.submit(BUILD, 'a')
+        self.submit(TEST, 'b')
+        stats = scheduler.stats()
+        self.assertEqual((stats['builds']['waiting'], stats['builds']['running']), (1, 1))
+        self.assertEqual((stats['tests']['waiting'], stats['tests']['running']), (0, 1))
+        self.assertEqual((stats['deployments']['waiting'], stats['deployments']['running']), (0, 0))
+        self.assertIsNotNone(stats['builds']['oldest_wait'])
+        self.assertIsNone(stats['tests']['oldest_wait'])
+        self.assertEqual(scheduler.load_by_host(), {'worker-1': (True, 1)})
+        self.assertEqual(scheduler.waiting_by_repository(), {'a': 1})
+        scheduler.finished(running)
+        self.assertEqual(scheduler.stats()['builds']['running'], 1)
+
+
+class TestBackfillIndex(TransactionTestCase):
+
+    def setUp(self):
+        self.data = TemporaryDirectory()
+        self.addCleanup(self.data.cleanup)
+
+    def write(self, path, content):
+        path = os.path.join(self.data.name, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as file:
+            file.write(content)
+
+    def test_indexes_yaml_files(self):
+        self.write('repos/app/builds/1/build.yaml', 'branch: master\nsha: abc\nresult: succeeded\n')
+        self.write('repos/app/builds/1/tests/1/test.yaml', 'result: failed\ncoverage: 50%\n')
+        self.write('repos/app/builds/1/deployments/1/deployment.yaml', 'result: succeeded\ndestination: prod\n')
+        # number claimed, not saved yet
+        os.makedirs(os.path.join(self.data.name, 'repos/app/builds/2'))
+        migration = import_module('shipmaster.server.migrations.0005_backfill_index')
+        with override_settings(SHIPMASTER_DATA=self.data.name):
+            migration.backfill_index(apps, None)
+        self.assertEqual(
+            list(BuildRecord.objects.values_list('repo', 'number', 'branch', 'sha', 'result')),
+            [('app', 1, 'master', 'abc', 'succeeded')]
+        )
+        self.assertEqual(
+            list(JobRecord.objects.order_by('job_type').values_list('job_type', 'result', 'coverage', 'destination')),
+            [('deployment', 'succeeded', '', 'prod'), ('test', 'failed', '50%', '')]
+        )
+
+    def test_new_installation(self):
+        migration = import_module('shipmaster.server.migrations.0005_backfill_index')
+        with override_settings(SHIPMASTER_DATA=self.data.name):
+            migration.backfill_index(apps, None)
+        self.assertFalse(BuildRecord.objects.exists())
+
+
+class TestRetention(TransactionTestCase):
+
+    def setUp(self):
+        self.data = TemporaryDirectory()
+        self.addCleanup(self.data.cleanup)
+        shipmaster = Shipmaster(self.data.name)
+        os.mkdir(shipmaster.path.repos_dir)
+        self.repo = Repository(shipmaster, 'app', git='git@github.com:acme/app.git')
+        os.makedirs(self.repo.path.builds)
+        self.repo.save()
+
+    def build(self, result=Build.SUCCEEDED, **fields):
+        build = Build.create(self.repo, 'master', **fields)
+        build.dict['result'] = result
+        build.dict['commit'] = {'hash': 'commit-{}'.format(build.number)}
+        build.save()
+        return build
+
+    def deploy(self, build, destination):
+        deployment = Deployment.create(build, destination)
+        deployment.dict['result'] = Deployment.SUCCEEDED
+        deployment.save()
+
+    def collect(self, now=None, dry_run=False, **policy):
+        policy = RetentionPolicy(**dict({'keep_last': 0, 'keep_days': 0, 'keep_deployed': False}, **policy))
+        return collect_repository(self.repo, policy, now=now, dry_run=dry_run)
+
+    def assertExist(self, *numbers):
+        self.assertEqual(sorted(int(number) for number in os.listdir(self.repo.path.builds)), sorted(numbers))
+        self.assertEqual(sorted(self.repo.query_builds().values_list('number', flat=True)), sorted(numbers))
+
+    def test_keep_last(self):
+        for _ in range(5):
+            self.build()
+        report, image_keys = self.collect(keep_last=2)
+        self.assertEqual((report.kept, report.removed), ([5, 4], [3, 2, 1]))
+        self.assertEqual(image_keys, {('commit-1', '1'), ('commit-2', '2'), ('commit-3', '3')})
+        self.assertExist(4, 5)
+
+    def test_keep_days(self):
+        for _ in range(3):
+            self.build()
+        self.assertEqual(self.collect(keep_days=1)[0].removed, [])
+        report, _ = self.collect(keep_days=1, now=time.time() + 2 * 86400)
+        # the newest build is always kept
+        self.assertEqual((report.kept, report.removed), ([3], [2, 1]))
+
+    def test_protected_builds(self):
+        deployed = self.build()
+        self.build()
+        running = self.build(Build.BUILDING)
+        reused = self.build()
+        self.build(Build.SKIPPED, skipped={'reason': 'no changes', 'previous': reused.number})
+        report, _ = self.collect(keep_deployed=True, dry_run=True)
+        self.assertEqual(report.removed, [2, 1])  # nothing deployed yet
+        self.deploy(deployed, 'production')
+        report, _ = self.collect(keep_deployed=True)
+        self.assertEqual(report.removed, [2])
+        self.assertEqual(report.protected, {int(deployed.number), int(running.number), int(reused.number), 5})
+        self.assertFalse(JobRecord.objects.filter(build=2).exists())
+
+    def test_dry_run(self):
+        self.build()
+        self.build()
+        report, _ = self.collect(dry_run=True)
+        self.assertEqual(report.removed, [1])
+        self.assertExist(1, 2)
+
+    def test_repository_overrides_defaults(self):
+        self.repo.dict['retention'] = {'keep_last': 3}
+        with override_settings(SHIPMASTER_RETENTION={'keep_last': 50, 'keep_days': 30, 'keep_deployed': True}):
+            self.assertEqual(RetentionPolicy.for_repository(self.repo), RetentionPolicy(3, 30, True))
+
+    def test_prune_commit_markers(self):
+        os.mkdir(self.repo.path.commits)
+        old, new = (os.path.join(self.repo.path.commits, name) for name in ('abc.push.master', 'def.pull.1'))
+        for marker in (old, new):
+            open(marker, 'w').close()
+        os.utime(old, (time.time() - 8 * 86400,) * 2)
+        prune_commit_markers(self.repo, time.time() - 7 * 86400)
+        self.assertEqual(os.listdir(self.repo.path.commits), ['def.pull.1'])
+
+
+class FakeImage:
+
+    def __init__(self, name, build, created, size=100, parent=None):
+        self.id = self.short_id = name
+        self.labels = {'git-hash': 'commit-{}'.format(build), 'shipmaster-build': str(build)}
+        self.attrs = {'Created': created, 'Size': size}
+        self.parent = parent
+
+
+class FakeDocker:
+    """ The part of a docker client `collect_images()` uses. """
+
+    def __init__(self, images, containers=()):
+        self.images = self
+        self.containers = self
+        self.all_images = {image.id: image for image in images}
+        self.all_containers = [mock.Mock(attrs={'Image': image, 'Created': created}) for image, created in containers]
+        self.removed = []
+
+    def list(self, filters=None, all=False):
+        if filters is not None:
+            return list(self.all_images.values())
+        return self.all_containers
+
+    def remove(self, image_id):
+        if any(image.parent == image_id for image in self.all_images.values()):
+            raise APIError('image has dependent child images')
+        del self.all_images[image_id]
+        self.removed.append(image_id)
+
+
+class TestCollectImages(TestCase):
+
+    def key(self, build):
+        return 'commit-{}'.format(build), str(build)
+
+    def test_removed_builds_first_then_least_recently_used(self):
+        client = FakeDocker([
+            FakeImage('a', 1, '2016-01-01T00:00:00'),
+            FakeImage('b', 2, '2016-01-02T00:00:00'),
+            FakeImage('c', 3, '2016-01-03T00:00:00'),
+            FakeImage('d', 4, '2016-01-04T00:00:00'),
+        ], containers=[('a', '2016-02-01T00:00:00.123456789Z')])
+        freed = collect_images(client, {self.key(4)}, budget=200)
+        # 'a' was used most recently, by a container
+        self.assertEqual(client.removed, ['d', 'b'])
+        self.assertEqual(freed, 200)
+
+    def test_protected_images_are_kept(self):
+        client = FakeDocker([FakeImage('a', 1, '2016-01-01T00:00:00'), FakeImage('b', 2, '2016-01-02T00:00:00')])
+        collect_images(client, {self.key(1)}, protected_keys={self.key(1), self.key(2)}, budget=0)
+        self.assertEqual(client.removed, [])
+
+    def test_no_budget_only_removes_removed_builds(self):
+        client = FakeDocker([FakeImage('a', 1, '2016-01-01T00:00:00'), FakeImage('b', 2, '2016-01-02T00:00:00')])
+        collect_images(client, {self.key(2)})
+        self.assertEqual(client.removed, ['b'])
+
+    def test_parents_removed_after_their_children(self):
+        client = FakeDocker([
+            FakeImage('base', 1, '2016-01-01T00:00:00'),
+            FakeImage('app', 1, '2016-01-02T00:00:00', parent='base'),
+        ])
+        self.assertEqual(collect_images(client, {self.key(1)}), 200)
+        self.assertEqual(client.removed, ['app', 'base'])
+
+    def test_dry_run(self):
+        client = FakeDocker([FakeImage('a', 1, '2016-01-01T00:00:00')])
+        self.assertEqual(collect_images(client, {self.key(1)}, dry_run=True), 100)
+        self.assertEqual(client.removed, [])
@@ -19,6 +19,7 @@ urlpatterns = [
     url(r"^repository/(?P<repo>[\w\.\-]+)/$", login_required(views.RepositoryView.as_view()), name="repository"),
     url(r"^repository/(?P<repo>[\w\.\-]+)/start-build$", login_required(views.StartBuild.as_view()), name="build.start"),
     url(r"^repository/(?P<repo>[\w\.\-]+)/build/(?P<build>\d+)/$", login_required(views.BuildView.as_view()), name="build"),
+    url(r"^repository/(?P<repo>[\w\.\-]+)/build/(?P<build>\d+)/cancel$", login_required(views.CancelBuild.as_view()), name="build.cancel"),
     url(r"^repository/(?P<repo>[\w\.\-]+)/build/(?P<build>\d+)/start-test$", login_required(views.StartTest.as_view()), name="test.start"),
     url(r"^repository/(?P<repo>[\w\.\-]+)/build/(?P<build>\d+)/test/(?P<test>\d+)/$", login_required(views.TestView.as_view()), name="test"),
     url(r"^repository/(?P<repo>[\w\.\-]+)/build/(?P<build>\d+)/test/(?P<test>\d+)/reports/(?P<report>.+)?$", login_required(views.TestReports.as_view()), name="test.reports"),
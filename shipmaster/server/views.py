@@ -12,6 +12,13 @@ from .models import Repository, Build, Test, Deployment
 from .forms import RepositoryForm
 
 
+def get_cursor(request, name='before'):
+    try:
+        return int(request.GET[name])
+    except (KeyError, ValueError):
+        return None
+
+
 class Dashboard(TemplateView):
     template_name = "shipmaster/dashboard.html"
 
@@ -27,6 +34,8 @@ class ProjectRepositoryView(TemplateView):
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data()
+        context['before'] = get_cursor(self.request)
+        context['builds'] = self.request.current_repo.latest_builds(context['before'])
         return context
 
 
@@ -80,11 +89,24 @@ class StartBuild(View):
             return HttpResponseRedirect(reverse('build', args=[repo.name, build.number]))
 
 
+class CancelBuild(View):
+
+    def get(self, request, *args, **kwargs):
+        build = request.current_build
+        build.cancel()
+        return HttpResponseRedirect(reverse('build', args=[build.repo.name, build.number]))
+
+
 class BuildView(TemplateView):
     template_name = "shipmaster/build.html"
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data()
+        build = self.request.current_build
+        context['tests_before'] = get_cursor(self.request, 'tests_before')
+        context['tests'] = build.latest_tests(context['tests_before'])
+        context['deployments_before'] = get_cursor(self.request, 'deployments_before')
+        context['deployments'] = build.latest_deployments(context['deployments_before'])
         return context
 
 
@@ -1,6 +1,6 @@
 from .testcases import DockerClientTestCase
 
-from shipmaster.core.builder import Builder
+from shipmaster.core.builder import Builder, MissingParentImage
 from shipmaster.core.config import BuildConfig
 
 
@@ -23,6 +23,27 @@ class ImageBuildTests(DockerClientTestCase):
         testing = self.get_test_plugin(builder)
         self.assertEqual(testing.builds, ['build'])
 
+    def test_matrix_build(self):
+        build_config = BuildConfig.from_kwargs(
+            '', name='test-project', images={
+                'build': {
+                    'from': 'busybox:latest',
+                    'build': 'echo "$GREETING" > greeting',
+                    'parallel': 2,
+                    'matrix': {
+                        'environment': [{'GREETING': 'hello'}, {'GREETING': 'hi'}]
+                    }
+                }
+            }
+        )
+
+        builder = Builder(build_config)
+        for step in builder.image_builders:
+            step.execute()
+
+        testing = self.get_test_plugin(builder)
+        self.assertEqual(sorted(testing.builds), ['build-1', 'build-2'])
+
     def _test_common(self):
         build_config = BuildConfig.from_kwargs(
             '', name='test-project',
@@ -60,6 +81,48 @@ class ImageBuildTests(DockerClientTestCase):
         self.assertEquals(testing.builds, ['app', 'test'])
 
 
+class StageReuseTests(DockerClientTestCase):
+
+    def test_parent_stage_is_reused(self):
+        build_config = BuildConfig.from_kwargs(
+            '', name='test-project', stages=['build', 'test'], images={
+                'app': {
+                    'stage': 'build',
+                    'from': 'busybox:latest',
+                    'build': 'echo "hello world" > hello_world',
+                },
+                'test': {
+                    'from': 'app',
+                    'run': 'cat hello_world',
+                }
+            }
+        )
+
+        builder = Builder(build_config)
+        plan = builder.plan('test', rerun_all=True)
+        self.assertEqual(
+            [(b.config.name, modes) for b, modes in plan],
+            [('app', ['build']), ('test', ['build', 'run'])]
+        )
+        for image_builder, modes in plan:
+            image_builder.execute(modes)
+
+        plan = builder.plan('test')
+        self.assertEqual([(b.config.name, modes) for b, modes in plan], [('test', ['run'])])
+
+    def test_missing_parent_stage(self):
+        build_config = BuildConfig.from_kwargs(
+            '', name='test-project-missing', stages=['build', 'test'], images={
+                'app': {'stage': 'build', 'from': 'busybox:latest', 'build': 'true'},
+                'test': {'from': 'app', 'run': 'true'}
+            }
+        )
+        builder = Builder(build_config)
+        with self.assertRaises(MissingParentImage):
+            builder.plan('test')
+        self.assertEqual(builder.plan('test', run_all=True)[0][1], ['build'])
+
+
 class ImageBuildRunStartTests(DockerClientTestCase):
 
     def x_test_simple_workflow(self):
@@ -0,0 +1,45 @@
+import time
+import unittest
+
+from shipmaster.core.background import BackgroundSender
+
+
+class Recorder(BackgroundSender):
+
+    def __init__(self, failures=0):
+        super().__init__('recorder')
+        self.sent = []
+        self.failures = failures
+
+    def send(self, key, item):
+        if self.failures:
+            self.failures -= 1
+            return time.time()
+        self.sent.append((key, item))
+
+
+class TestBackgroundSender(unittest.TestCase):
+
+    def test_newer_item_replaces_pending(self):
+        sender = Recorder()
+        with sender.condition:
+            sender.queue('status', 'pending', due_at=time.time() + 60)
+            sender.queue('status', 'success')
+        self.assertTrue(sender.flush(5))
+        self.assertEqual(sender.sent, [('status', 'success')])
+
+    def test_retry(self):
+        sender = Recorder(failures=2)
+        with sender.condition:
+            sender.queue('status', 'success')
+        self.assertTrue(sender.flush(5))
+        self.assertEqual(sender.sent, [('status', 'success')])
+
+    def test_flush_timeout(self):
+        sender = Recorder()
+        with sender.condition:
+            sender.paused_until = time.time() + 60
+            sender.queue('status', 'success')
+        self.assertFalse(sender.flush(0.1))
+        with sender.condition:
+            sender.pending.clear()  # nothing left for the flush at exit
@@ -0,0 +1,129 @@
+import os
+import unittest
+from unittest import mock
+from tempfile import TemporaryDirectory
+
+from shipmaster.cli.cli import parse_args
+from shipmaster.core.builder import Builder, MatrixBuilder, MatrixFailed
+from shipmaster.core.config import BuildConfig
+from shipmaster.core.plugins import PluginManager
+
+
+def matrix_config():
+    return BuildConfig.from_kwargs(
+        '/src', name='test-project', stages=['test'], images={
+            'test': {
+                'from': 'python:3.5',
+                'run': 'pytest',
+                'matrix': {'environment': [{'DJANGO': '1.10'}, {'DJANGO': '1.11'}]},
+            }
+        }
+    )
+
+
+class BuilderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # plugins loaded by other tests, e.g. through the CLI, don't apply
+        patcher = mock.patch.object(PluginManager, 'plugin_classes', [])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class TestMatrixBuilder(BuilderTestCase):
+
+    def test_cell_failing_outside_its_steps_fails_the_matrix(self):
+        builder = Builder(matrix_config(), client=mock.Mock())
+        matrix = builder.image_builder('test')
+        self.assertIsInstance(matrix, MatrixBuilder)
+        # e.g. a plugin raising while notified of the cell's first event
+        matrix.cells[0].execute = mock.Mock(side_effect=RuntimeError('plugin failed'))
+        matrix.cells[1].execute = mock.Mock()
+        matrix.execute(['run'])
+        self.assertIsInstance(matrix.exception, MatrixFailed)
+        self.assertEqual(list(matrix.failures), ['test-1'])
+        self.assertEqual(str(matrix.failures['test-1']), 'plugin failed')
+
+
+def app_config(workspace):
+    return BuildConfig.from_kwargs(
+        workspace, name='test-project', stages=['build', 'test'], images={
+            'app': {'stage': 'build', 'from': 'python:3.5', 'context': ['src'], 'build': 'pip install -e .',
+                    'volumes': ['/tmp/cache:/cache']},
+            'test': {'from': 'app', 'build': 'pip install pytest', 'run': 'pytest'},
+        }
+    )
+
+
+class TestEditable(BuilderTestCase):
+
+    def builder(self, *argv):
+        return Builder(app_config('/src'), parse_args(['run', 'test'] + list(argv)), client=mock.Mock())
+
+    def test_workspace_mounted_over_app_path(self):
+        builder = self.builder('--editable')
+        self.assertTrue(builder.editable)
+        for image in ('app', 'test'):
+            self.assertEqual(builder.image_builder(image).volumes[-1], '/src:/app')
+        self.assertEqual(builder.image_builder('app').volumes[0], '/tmp/cache:/cache')
+        # the configuration is shared, it must not pick the mount up
+        self.assertEqual(builder.config.image_configs['app'].volumes, ['/tmp/cache:/cache'])
+
+    def test_not_editable_by_default(self):
+        builder = self.builder()
+        self.assertFalse(builder.editable)
+        self.assertEqual(builder.image_builder('app').volumes, ['/tmp/cache:/cache'])
+
+    def test_editable_images_are_not_reused_for_uploaded_ones(self):
+        self.assertNotEqual(
+            self.builder('--editable').image_builder('test').cache_key,
+            self.builder().image_builder('test').cache_key
+        )
+
+
+class TestCacheKey(BuilderTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.workspace = TemporaryDirectory()
+        self.addCleanup(self.workspace.cleanup)
+        self.write('src/setup.py', 'setup()')
+        self.write('src/app/__init__.py', '')
+
+    def write(self, path, content):
+        path = os.path.join(self.workspace.name, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as file:
+            file.write(content)
+
+    def keys(self, editable=False):
+        args = mock.Mock(editable=editable)
+        builder = Builder(app_config(self.workspace.name), args, client=mock.Mock())
+        return builder.image_builder('app').cache_key, builder.image_builder('test').cache_key
+
+    def test_stable(self):
+        self.assertEqual(self.keys(), self.keys())
+
+    def test_context_contents_change_the_key_of_dependents(self):
+        app, test = self.keys()
+        self.write('src/app/__init__.py', 'VERSION = 2')
+        changed_app, changed_test = self.keys()
+        self.assertNotEqual(app, changed_app)
+        self.assertNotEqual(test, changed_test)
+
+    def test_new_files_change_the_key(self):
+        app, _ = self.keys()
+        self.write('src/app/models.py', '')
+        self.assertNotEqual(self.keys()[0], app)
+
+    def test_files_outside_the_context_or_ignored_do_not(self):
+        app, _ = self.keys()
+        self.write('README', 'changed')
+        self.write('.dockerignore', 'src/*.pyc')
+        self.write('src/setup.pyc', 'bytecode')
+        self.assertEqual(self.keys()[0], app)
+
+    def test_editable_images_ignore_contents(self):
+        app, _ = self.keys(editable=True)
+        self.write('src/app/__init__.py', 'VERSION = 2')
+        self.assertEqual(self.keys(editable=True)[0], app)
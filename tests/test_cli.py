@@ -1,14 +1,118 @@
+import io
+import os
+import sys
+import json
+import time
+import socket
 import unittest
+import threading
+from unittest import mock
+from tempfile import TemporaryDirectory
 from shipmaster.cli import main
 from shipmaster.cli.cli import argument_parser
+from shipmaster.cli.daemon import Daemon, forward
 
 
 class TestCLI(unittest.TestCase):
 
     def test_cli(self):
-        with self.assertRaises(SystemExit):
+        # never forward the test runner's argv to a daemon running on this machine
+        with mock.patch.dict(os.environ, {'SHIPMASTER_NO_DAEMON': '1'}), self.assertRaises(SystemExit):
             main()
 
     def test_graph(self):
         parser = argument_parser()
         parser.parse_args(['graph'])
+
+
+class TestDaemon(unittest.TestCase):
+
+    def test_forward(self):
+
+        def execute(argv):
+            print(' '.join(argv))
+            if argv[0] == 'fail':
+                sys.exit('failed')
+
+        with TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'daemon.sock')
+            self.assertIsNone(forward(['run', 'build'], path))
+            daemon = Daemon(path, execute)
+            thread = threading.Thread(target=daemon.serve_forever)
+            thread.start()
+            # the daemon swaps sys.stdout of this very process while it runs a command
+            output = io.StringIO()
+            try:
+                self.assertEqual(forward(['run', 'build'], path, output), 0)
+                self.assertEqual(forward(['fail'], path, output), 1)
+                self.assertIsNone(forward(['watch', 'build'], path, output))
+                self.assertEqual(output.getvalue(), 'run build\nfail\nfailed\n')
+            finally:
+                daemon.shutdown()
+                daemon.server_close()
+                thread.join()
+
+    def test_disconnect_cancels_command(self):
+        cancelled = threading.Event()
+
+        def execute(argv):
+            if argv[0] == 'hang':
+                try:
+                    print('started')
+                    while True:
+                        time.sleep(0.01)
+                except KeyboardInterrupt:
+                    cancelled.set()
+                    raise
+            print('done')
+
+        with TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'daemon.sock')
+            daemon = Daemon(path, execute)
+            thread = threading.Thread(target=daemon.serve_forever)
+            thread.start()
+            try:
+                client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                client.connect(path)
+                with client, client.makefile('rwb') as stream:
+                    stream.write(json.dumps({'argv': ['hang'], 'cwd': tmp, 'environ': {}}).encode()+b'\n')
+                    stream.flush()
+                    self.assertEqual(json.loads(stream.readline().decode()), {'output': 'started'})
+                self.assertTrue(cancelled.wait(5))
+                # the daemon is free for the next command
+                output = io.StringIO()
+                self.assertEqual(forward(['run'], path, output), 0)
+                self.assertEqual(output.getvalue(), 'done\n')
+            finally:
+                daemon.shutdown()
+                daemon.server_close()
+                thread.join()
+
+    def test_disconnect_leaves_daemon_state_intact(self):
+
+        def execute(argv):
+            print(os.environ.get('CLIENT'))
+
+        environ, stdout = dict(os.environ), sys.stdout
+        with TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'daemon.sock')
+            daemon = Daemon(path, execute)
+            thread = threading.Thread(target=daemon.serve_forever)
+            thread.start()
+            try:
+                # clients hanging up at any point while their command runs or the daemon restores itself
+                for _ in range(50):
+                    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                    client.connect(path)
+                    with client, client.makefile('rwb') as stream:
+                        stream.write(json.dumps({'argv': ['run'], 'cwd': tmp, 'environ': {'CLIENT': '1'}}).encode()+b'\n')
+                        stream.flush()
+                output = io.StringIO()
+                self.assertEqual(forward(['run'], path, output), 0)
+                self.assertEqual(output.getvalue(), 'None\n')
+            finally:
+                daemon.shutdown()
+                daemon.server_close()
+                thread.join()
+        self.assertEqual(dict(os.environ), environ)
+        self.assertIs(sys.stdout, stdout)
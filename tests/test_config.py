@@ -0,0 +1,254 @@
+import os
+import unittest
+from tempfile import TemporaryDirectory
+
+from shipmaster.core.config import BuildConfig, ConfigCache
+from shipmaster.core.script import parse_dockerignore
+
+CONFIG = b"""
+name: test-project
+stages: [build, test]
+images:
+  app:
+    stage: build
+    from: busybox:latest
+    build: echo "hello world" > hello_world
+  test:
+    from: app
+    run: cat hello_world
+"""
+
+
+class TestConfigCache(unittest.TestCase):
+
+    def test_load_is_cached_in_memory_and_on_disk(self):
+        with TemporaryDirectory() as cache_dir:
+            cache = ConfigCache(cache_dir)
+            first = cache.load(CONFIG)
+            self.assertEqual(first['name'], 'test-project')
+            digest = cache.digest(CONFIG)
+            self.assertIn(digest, cache.memory)
+            self.assertTrue(os.path.exists(os.path.join(cache_dir, 'config', digest+'.json')))
+
+            cache.clear()
+            cache.compile = None  # a parse would now fail, disk must be used
+            self.assertEqual(cache.load(CONFIG), first)
+
+    def test_load_returns_fresh_copies(self):
+        cache = ConfigCache()
+        cache.load(CONFIG)['images'].clear()
+        self.assertIn('app', cache.load(CONFIG)['images'])
+
+    def test_invalid_config_is_not_cached(self):
+        cache = ConfigCache()
+        bad = CONFIG.replace(b'stage: build', b'stage: deploy')
+        with self.assertRaises(ValueError):
+            cache.load(bad)
+        self.assertEqual(len(cache.memory), 0)
+
+    def test_errors_are_value_errors(self):
+        cache = ConfigCache()
+        invalid = (
+            b'a: [',  # syntax
+            b'stages: [build]',  # no name
+            b'- name',  # not a mapping
+            b'name: x\nimages: [app]',
+            b'name: x\nstages: 5\nimages: {app: {from: a}}',
+        )
+        for src in invalid:
+            with self.subTest(src=src), self.assertRaises(ValueError):
+                cache.load(src)
+
+    def test_digest_depends_on_format(self):
+        class NewCache(ConfigCache):
+            FORMAT = ConfigCache.FORMAT+b'.1'
+        self.assertNotEqual(NewCache.digest(CONFIG), ConfigCache.digest(CONFIG))
+
+    def test_from_workspace(self):
+        with TemporaryDirectory() as workspace:
+            self.assertIsNone(BuildConfig.from_workspace(workspace))
+            with open(os.path.join(workspace, '.shipmaster.yaml'), 'wb') as file:
+                file.write(CONFIG)
+            config = BuildConfig.from_workspace(workspace)
+            self.assertEqual(config.workspace, workspace)
+            self.assertEqual(config.image_configs['test'].from_image, 'app')
+
+
+class TestImageGraph(unittest.TestCase):
+
+    def config(self, **images):
+        return BuildConfig.from_kwargs(
+            None, name='test-project', stages=['build', 'test', 'deploy'], images=images
+        )
+
+    def test_index(self):
+        graph = self.config(
+            base={'stage': 'build', 'from': 'busybox:latest'},
+            app={'stage': 'build', 'from': 'base'},
+            test={'from': 'app'},
+            docs={'stage': 'test', 'from': 'base'},
+            production={'stage': 'deploy', 'from': 'app'},
+        ).graph
+        self.assertEqual(graph.images('build'), ('base', 'app'))
+        self.assertEqual(graph.images('test'), ('test', 'docs'))
+        self.assertIsNone(graph.parent('base'))
+        self.assertEqual(graph.parent('production'), 'app')
+        self.assertEqual(graph.ancestors('production'), ('base', 'app'))
+        self.assertEqual(graph.order, ('base', 'app', 'docs', 'test', 'production'))
+        self.assertEqual(graph.affected('app'), ('app', 'test', 'production'))
+        self.assertEqual(graph.dependents('base'), ('app', 'docs', 'test', 'production'))
+        self.assertEqual(graph.cycle, ())
+
+    def test_check_cycle(self):
+        config = self.config(
+            a={'stage': 'build', 'from': 'b'},
+            b={'stage': 'build', 'from': 'a'},
+        )
+        self.assertEqual(config.graph.cycle, ('a', 'b'))
+        with self.assertRaisesRegex(ValueError, 'cycle'):
+            config.check()
+
+    def test_check_missing_parent(self):
+        with self.assertRaisesRegex(ValueError, "missing the 'from'"):
+            self.config(app={'stage': 'build'}).check()
+
+    def test_check_parent_in_later_stage(self):
+        config = self.config(
+            app={'stage': 'build', 'from': 'test'},
+            test={'from': 'busybox:latest'},
+        )
+        with self.assertRaisesRegex(ValueError, 'later stage'):
+            config.check()
+
+
+class TestImageMatrix(unittest.TestCase):
+
+    def test_cells(self):
+        config = BuildConfig.from_kwargs(
+            None, name='test-project', stages=['test'], images={
+                'test': {
+                    'from': 'python:3.5',
+                    'environment': {'CI': '1'},
+                    'matrix': {
+                        'from': ['python:3.5', 'python:3.6'],
+                        'environment': [{'DJANGO': '1.10'}, {'DJANGO': '1.11'}],
+                    }
+                }
+            }
+        )
+        config.check()
+        cells = config.image_configs['test'].cells()
+        self.assertEqual([c.name for c in cells], ['test-1', 'test-2', 'test-3', 'test-4'])
+        self.assertEqual(cells[3].from_image, 'python:3.6')
+        self.assertEqual(cells[3].environment, {'CI': '1', 'DJANGO': '1.11'})
+        self.assertFalse(any(c.matrix for c in cells))
+
+    def test_no_matrix(self):
+        config = BuildConfig.from_kwargs(
+            None, name='test-project', images={'build': {'from': 'busybox:latest'}}
+        )
+        image = config.image_configs['build']
+        self.assertEqual(image.cells(), [image])
+
+    def test_matrix_parent_not_allowed(self):
+        config = BuildConfig.from_kwargs(
+            None, name='test-project', stages=['build', 'test'], images={
+                'app': {'stage': 'build', 'from': 'busybox:latest',
+                        'matrix': {'environment': [{'A': '1'}, {'A': '2'}]}},
+                'test': {'from': 'app'},
+            }
+        )
+        with self.assertRaisesRegex(ValueError, 'build matrix'):
+            config.check()
+
+
+class TestTriggers(unittest.TestCase):
+
+    def config(self, src):
+        return BuildConfig.from_string(b"name: test-project\n" + src)
+
+    def test_defaults(self):
+        config = self.config(b"")
+        self.assertTrue(config.triggers('master'))
+        self.assertFalse(config.triggers('develop'))
+        self.assertFalse(config.triggers('master', pull_request=1))
+
+    def test_build_section(self):
+        config = self.config(b"build: {branches: [develop], pull_requests: true}\n")
+        self.assertTrue(config.triggers('develop'))
+        self.assertFalse(config.triggers('master'))
+        self.assertTrue(config.triggers('develop', pull_request=1))
+
+    def test_top_level_keys(self):
+        config = self.config(b"branches: [develop]\npull_requests: true\n")
+        self.assertTrue(config.triggers('develop'))
+        self.assertTrue(config.triggers('master', pull_request=1))
+
+    def test_build_section_takes_precedence(self):
+        config = self.config(b"branches: [develop]\npull_requests: true\nbuild: {branches: [master], pull_requests: false}\n")
+        self.assertTrue(config.triggers('master'))
+        self.assertFalse(config.triggers('develop'))
+        self.assertFalse(config.triggers('master', pull_request=1))
+
+
+class TestMatrixShapes(unittest.TestCase):
+
+    def check(self, matrix):
+        BuildConfig.from_kwargs(
+            None, name='test-project', images={'build': {'from': 'busybox:latest', 'matrix': matrix}}
+        ).check()
+
+    def test_environment_must_be_a_list_of_mappings(self):
+        with self.assertRaisesRegex(ValueError, "'environment' of image 'build'"):
+            self.check({'environment': {'A': '1'}})
+        with self.assertRaisesRegex(ValueError, "'environment' of image 'build'"):
+            self.check({'environment': ['A=1']})
+
+    def test_from_must_be_a_name_or_list_of_names(self):
+        self.check({'from': 'busybox:1'})
+        self.check({'from': ['busybox:1', 'busybox:2']})
+        with self.assertRaisesRegex(ValueError, "'from' of image 'build'"):
+            self.check({'from': {'busybox': 1}})
+
+    def test_matrix_must_be_a_mapping(self):
+        with self.assertRaisesRegex(ValueError, "must be a mapping"):
+            self.check(['busybox:1'])
+
+    def test_from_string_is_one_image(self):
+        config = BuildConfig.from_kwargs(
+            None, name='test-project', images={
+                'app': {'stage': 'build', 'from': 'busybox:latest'},
+                'build': {'from': 'busybox:latest', 'matrix': {'from': 'app'}},
+            }
+        )
+        # not checked character by character
+        with self.assertRaisesRegex(ValueError, "'app' is built by shipmaster"):
+            config.check()
+
+
+class TestImagesAffectedBy(unittest.TestCase):
+
+    def setUp(self):
+        self.config = BuildConfig.from_kwargs(
+            None, name='test-project', stages=['build', 'test'], images={
+                'base': {'stage': 'build', 'from': 'busybox:latest', 'context': 'requirements/base.pip'},
+                'app': {'stage': 'build', 'from': 'base', 'context': ['src', 'setup.py']},
+                'test': {'from': 'app', 'context': 'tests'},
+            }
+        )
+
+    def test_affected(self):
+        affected = self.config.images_affected_by
+        self.assertEqual(affected(['README.rst']), ())
+        self.assertEqual(affected(['tests/test_app.py']), ('test',))
+        self.assertEqual(affected(['src/app.py', 'tests/test_app.py']), ('app', 'test'))
+        self.assertEqual(affected(['requirements/base.pip']), ('base', 'app', 'test'))
+        self.assertEqual(affected(['srcs/app.py']), ())
+
+    def test_excluded(self):
+        self.assertEqual(self.config.images_affected_by(['src/app.pyc'], ['*.pyc']), ())
+
+    def test_dockerignore(self):
+        exclude = parse_dockerignore('*.pyc\n\n  docs/*  \n')
+        self.assertEqual(exclude, ['*.pyc', 'docs/*'])
+        self.assertEqual(self.config.images_affected_by(['src/app.pyc', 'docs/index.rst'], exclude), ())
@@ -0,0 +1,149 @@
+import os
+import sys
+import logging
+import time
+import threading
+import unittest
+from tempfile import TemporaryDirectory
+
+from shipmaster.server.joblog import OutputReader, job_log, run, logger
+from shipmaster.server.storage import Journal
+
+
+class TestOutputReader(unittest.TestCase):
+
+    def test_lines_split_across_chunks(self):
+        reader = OutputReader()
+        self.assertEqual(reader.feed(b'first li'), [])
+        self.assertEqual(reader.feed(b'ne\nsecond\nthi'), ['first line', 'second'])
+        self.assertEqual(reader.feed(b'rd\n'), ['third'])
+        self.assertEqual(reader.close(), [])
+
+    def test_progress_keeps_final_state(self):
+        reader = OutputReader()
+        self.assertEqual(reader.feed(b'Receiving:  10%\rReceiving:  50%\r'), [])
+        self.assertEqual(reader.feed(b'Receiving: 100%, done.\r\n'), ['Receiving: 100%, done.'])
+
+    def test_overlong_line_is_flushed(self):
+        reader = OutputReader()
+        self.assertEqual(reader.feed(b'x' * OutputReader.MAX_LINE), [])
+        lines = reader.feed(b'yy')
+        self.assertEqual(lines, ['x' * OutputReader.MAX_LINE + 'yy'])
+        self.assertEqual(reader.feed(b'z\n'), ['z'])
+
+    def test_close_returns_unterminated_tail(self):
+        reader = OutputReader()
+        self.assertEqual(reader.feed(b'done\nno newline'), ['done'])
+        self.assertEqual(reader.close(), ['no newline'])
+        self.assertEqual(reader.close(), [])
+
+    def test_invalid_utf8_is_replaced(self):
+        reader = OutputReader()
+        self.assertEqual(reader.feed(b'caf\xe9\n'), ['caf\ufffd'])
+
+
+class TestJobLog(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def read_log(self, name):
+        with open(os.path.join(self.tmp.name, name)) as log:
+            return log.read()
+
+    def test_concurrent_jobs_keep_their_own_logs(self):
+        both_logging = threading.Barrier(2)
+
+        def job(name):
+            with job_log(os.path.join(self.tmp.name, name), 'w'):
+                both_logging.wait()
+                for i in range(100):
+                    logger.info('{} {}'.format(name, i))
+                run([sys.executable, '-c', "print('{} output')".format(name)], timeout=30)
+
+        threads = [threading.Thread(target=job, args=(name,)) for name in ('first', 'second')]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for name, other in (('first', 'second'), ('second', 'first')):
+            log = self.read_log(name)
+            self.assertEqual([' {} {}\n'.format(name, i) in log for i in range(100)], [True] * 100)
+            self.assertIn(' {} output\n'.format(name), log)
+            self.assertNotIn(other, log)
+
+    def test_logging_outside_of_jobs_is_dropped(self):
+        with job_log(os.path.join(self.tmp.name, 'job'), 'w'):
+            logger.info('inside')
+        logger.info('outside')
+        self.assertIn(' inside\n', self.read_log('job'))
+        self.assertNotIn('outside', self.read_log('job'))
+
+
+class TestRun(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.log = os.path.join(self.tmp.name, 'job.log')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def read_log(self):
+        with open(self.log) as log:
+            return log.read()
+
+    def python(self, code):
+        return [sys.executable, '-c', code]
+
+    def test_output_and_exit_status(self):
+        with job_log(self.log, 'w'):
+            status = run(self.python(
+                "import sys; print('out'); sys.stdout.flush(); print('err', file=sys.stderr); sys.exit(3)"
+            ), timeout=30)
+        self.assertEqual(status, 3)
+        log = self.read_log()
+        self.assertIn(' out\n', log)
+        self.assertIn(' err\n', log)
+
+    def test_stderr_logged_as_warning(self):
+        with self.assertLogs(logger, logging.INFO) as logs:
+            run(self.python(
+                "import sys; print('out'); sys.stdout.flush(); print('err', file=sys.stderr)"
+            ), timeout=30)
+        levels = {record.getMessage()[9:]: record.levelno for record in logs.records}
+        self.assertEqual(levels['out'], logging.INFO)
+        self.assertEqual(levels['err'], logging.WARNING)
+
+    def test_timeout_kills_command(self):
+        started = time.monotonic()
+        with job_log(self.log, 'w'):
+            status = run(self.python("import time; time.sleep(30)"), timeout=1)
+        self.assertLess(time.monotonic() - started, 10)
+        self.assertNotEqual(status, 0)
+        self.assertIn('Timed out after 1 seconds, killing', self.read_log())
+
+    def test_cancellation_kills_command(self):
+        started = time.monotonic()
+        with job_log(self.log, 'w', cancelled=lambda: time.monotonic() - started > 1):
+            status = run(self.python("import time; time.sleep(30)"), timeout=30)
+        self.assertLess(time.monotonic() - started, 10)
+        self.assertNotEqual(status, 0)
+        self.assertIn('Cancelled, killing', self.read_log())
+
+    def test_cancel_recorded_in_journal_kills_command(self):
+        # how a running build is cancelled, see Build.cancel() and Build.cancel_requested()
+        path = os.path.join(self.tmp.name, 'journal')
+        timer = threading.Timer(1, lambda: Journal(path).record('cancel'))
+        timer.start()
+        started = time.monotonic()
+        try:
+            with job_log(self.log, 'w', cancelled=lambda: Journal(path).has('cancel')):
+                status = run(self.python("import time; time.sleep(30)"), timeout=30)
+        finally:
+            timer.cancel()
+        self.assertLess(time.monotonic() - started, 10)
+        self.assertNotEqual(status, 0)
+        self.assertIn('Cancelled, killing', self.read_log())
@@ -0,0 +1,71 @@
+import time
+import unittest
+from unittest import mock
+
+import requests
+
+from shipmaster.plugins.slack.slack import SlackConf, SlackNotifier, get_notifier
+
+
+def conf(window=60):
+    return SlackConf(None, {'api': 'https://hooks.slack.com/services/x', 'window': window})
+
+
+class TestSlackNotifier(unittest.TestCase):
+
+    def setUp(self):
+        self.notifier = SlackNotifier()
+        self.notifier.session = mock.Mock()
+        self.post = self.notifier.session.post
+
+    def posted(self):
+        return [call[1]['json']['text'] for call in self.post.call_args_list]
+
+    def test_notifications_within_window_are_batched(self):
+        self.notifier.notify(conf(), 'app #1', 'build done')
+        self.notifier.notify(conf(), 'app #1', 'tests failed')
+        self.assertTrue(self.notifier.flush(5))
+        self.assertEqual(self.posted(), ["2 updates:\n• app #1: build done\n• app #1: tests failed"])
+
+    def test_single_notification(self):
+        self.notifier.notify(conf(window=0), 'app #1', 'build done')
+        self.assertTrue(self.notifier.flush(5))
+        self.assertEqual(self.posted(), ['build done'])
+
+    def test_failures_are_retried_without_blocking(self):
+        self.post.side_effect = requests.ConnectionError('refused')
+        batch = [[('app #1', 'build done')], 0]
+        started = time.time()
+        retry_at = self.notifier.send(conf().api, batch)
+        self.assertLess(time.time() - started, 1)
+        self.assertGreater(retry_at, started)
+        self.assertEqual(batch[1], 1)
+
+    def test_gives_up_after_retries(self):
+        self.post.side_effect = requests.ConnectionError('refused')
+        batch = [[('app #1', 'build done')], SlackNotifier.RETRIES - 1]
+        with self.assertLogs('shipmaster', 'ERROR'):
+            self.assertIsNone(self.notifier.send(conf().api, batch))
+
+    def test_failed_batch_joins_newer_one(self):
+        self.post.side_effect = requests.ConnectionError('refused')
+        with self.notifier.condition:
+            self.notifier.paused_until = time.time() + 60
+        self.notifier.notify(conf(), 'app #2', 'build done')
+        self.assertIsNone(self.notifier.send(conf().api, [[('app #1', 'build done')], 0]))
+        self.assertEqual(self.notifier.pending[conf().api][1][0], [('app #1', 'build done'), ('app #2', 'build done')])
+        with self.notifier.condition:
+            self.notifier.pending.clear()  # nothing left for the flush at exit
+
+    def test_retried_until_sent(self):
+        self.post.side_effect = [requests.ConnectionError('refused'), mock.Mock()]
+        self.notifier.BACKOFF = 0
+        self.notifier.notify(conf(window=0), 'app #1', 'build done')
+        self.assertTrue(self.notifier.flush(5))
+        self.assertEqual(self.posted(), ['build done', 'build done'])
+
+
+class TestGetNotifier(unittest.TestCase):
+
+    def test_created_once_on_first_use(self):
+        self.assertIs(get_notifier(), get_notifier())
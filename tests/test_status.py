@@ -0,0 +1,74 @@
+import time
+import unittest
+from unittest import mock
+
+import requests
+
+from shipmaster.server.status import GitHubStatusUpdater
+
+
+def response(status_code, headers=None):
+    reply = requests.Response()
+    reply.status_code = status_code
+    reply.headers.update(headers or {})
+    reply._content = b''
+    return reply
+
+
+class TestGitHubStatusUpdater(unittest.TestCase):
+
+    def setUp(self):
+        self.updater = GitHubStatusUpdater('token')
+        self.updater.session = mock.Mock()
+        self.post = self.updater.session.post
+        self.key = ('account', 'repo', 'abc', 'shipmaster/build')
+
+    def send(self, item):
+        return self.updater.send(self.key, item)
+
+    def test_sent_once(self):
+        self.post.return_value = response(201)
+        self.assertIsNone(self.send([{'state': 'success'}, 0]))
+        self.assertEqual(self.post.call_args[0][0], 'https://api.github.com/repos/account/repo/statuses/abc')
+        self.assertEqual(self.post.call_args[1]['json'], {'state': 'success'})
+
+    def test_server_errors_are_retried_with_backoff(self):
+        self.post.return_value = response(502)
+        item = [{'state': 'success'}, 0]
+        retries = []
+        for _ in range(GitHubStatusUpdater.RETRIES - 1):
+            started = time.time()
+            retries.append(round(self.send(item) - started))
+        self.assertEqual(retries, [2, 4, 8, 16])
+        with self.assertLogs('shipmaster', 'ERROR'):
+            self.assertIsNone(self.send(item))
+
+    def test_connection_errors_are_retried(self):
+        self.post.side_effect = requests.ConnectionError('refused')
+        self.assertIsNotNone(self.send([{'state': 'success'}, 0]))
+
+    def test_rejected_statuses_are_dropped(self):
+        self.post.return_value = response(422)
+        with self.assertLogs('shipmaster', 'ERROR'):
+            self.assertIsNone(self.send([{'state': 'success'}, 0]))
+
+    def test_rate_limit_pauses_publishing(self):
+        reset = time.time() + 600
+        self.post.return_value = response(403, {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': str(reset)})
+        item = [{'state': 'success'}, 0]
+        with self.assertLogs('shipmaster', 'WARNING'):
+            self.assertEqual(self.send(item), reset)
+        self.assertEqual(self.updater.paused_until, reset)
+        self.assertEqual(item[1], 0)  # not a failed attempt
+
+    def test_newest_state_wins(self):
+        self.post.return_value = response(201)
+        with self.updater.condition:
+            self.updater.paused_until = time.time() + 60
+        self.updater.publish('account', 'repo', 'abc', 'pending', 'http://build', 'building', 'shipmaster/build')
+        self.updater.publish('account', 'repo', 'abc', 'success', 'http://build', 'built', 'shipmaster/build')
+        with self.updater.condition:
+            self.updater.paused_until = 0
+            self.updater.condition.notify()
+        self.assertTrue(self.updater.flush(5))
+        self.assertEqual([call[1]['json']['state'] for call in self.post.call_args_list], ['success'])
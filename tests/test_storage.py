@@ -0,0 +1,191 @@
+import os
+import unittest
+from multiprocessing import Pool
+from tempfile import TemporaryDirectory
+from ruamel import yaml
+
+from shipmaster.server.storage import Journal, YamlCache, claim_next_number, claim_commit
+
+
+class TestYamlCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'build.yaml')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def settle(self):
+        """ Makes the file look older than `YamlCache.RECENT`. """
+        past = os.stat(self.path).st_mtime - YamlCache.RECENT - 1
+        os.utime(self.path, (past, past))
+
+    def test_load_returns_copies(self):
+        cache = YamlCache()
+        cache.save(self.path, {'result': 'pending'})
+        self.settle()
+        cache.load(self.path)['result'] = 'changed'
+        self.assertEqual(cache.load(self.path), {'result': 'pending'})
+
+    def test_same_size_rewrite_by_other_process(self):
+        reader, writer = YamlCache(), YamlCache()
+        writer.save(self.path, {'result': 'pending'})
+        self.settle()
+        self.assertEqual(reader.load(self.path), {'result': 'pending'})
+        mtime = os.stat(self.path).st_mtime_ns
+        writer.save(self.path, {'result': 'success'})
+        # same size and, on a coarse clock, the same modification time
+        os.utime(self.path, ns=(mtime, mtime))
+        self.assertEqual(reader.load(self.path), {'result': 'success'})
+
+    def test_recent_files_are_read_again(self):
+        reader = YamlCache()
+        reader.save(self.path, {'result': 'pending'})
+        signature = reader.entries[self.path][0]
+        with open(self.path, 'w') as file:
+            file.write(yaml.dump({'result': 'failure'}))
+        # an in place rewrite nothing about the file reveals
+        os.utime(self.path, ns=(signature[1], signature[1]))
+        self.assertEqual(reader._signature(self.path), signature)
+        self.assertEqual(reader.load(self.path), {'result': 'failure'})
+
+    def test_save_leaves_no_temporary_files(self):
+        cache = YamlCache()
+        cache.save(self.path, {'result': 'pending'})
+        cache.save(self.path, {'result': 'success'})
+        self.assertEqual(os.listdir(self.tmp.name), ['build.yaml'])
+
+
+def claim(directory):
+    return claim_next_number(os.path.join(directory, 'last_build_number'), os.path.join(directory, 'builds'))
+
+
+class TestClaimNextNumber(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.counter = os.path.join(self.tmp.name, 'last_build_number')
+        self.builds = os.path.join(self.tmp.name, 'builds')
+        os.mkdir(self.builds)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_first_number_without_counter(self):
+        self.assertEqual(claim(self.tmp.name), '1')
+        self.assertEqual(claim(self.tmp.name), '2')
+        self.assertTrue(os.path.isdir(os.path.join(self.builds, '2')))
+        with open(self.counter) as counter:
+            self.assertEqual(counter.read(), '2')
+
+    def test_skips_taken_numbers(self):
+        # the counter fell behind, e.g. it was restored from a backup
+        with open(self.counter, 'w') as counter:
+            counter.write('10')
+        for number in ('11', '12'):
+            os.mkdir(os.path.join(self.builds, number))
+        self.assertEqual(claim(self.tmp.name), '13')
+
+    def test_counter_is_rewritten_whole(self):
+        with open(self.counter, 'w') as counter:
+            counter.write('7   \n')
+        self.assertEqual(claim(self.tmp.name), '8')
+        with open(self.counter) as counter:
+            self.assertEqual(counter.read(), '8')
+
+    def test_concurrent_claims_are_unique(self):
+        with Pool(4) as pool:
+            numbers = pool.map(claim, [self.tmp.name] * 40)
+        self.assertEqual(sorted(numbers, key=int), [str(n) for n in range(1, 41)])
+
+
+class TestClaimCommit(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.commits = os.path.join(self.tmp.name, 'commits')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_claimed_once(self):
+        claim = claim_commit(self.commits, 'abc', 'master')
+        self.assertTrue(os.path.exists(claim))
+        self.assertIsNone(claim_commit(self.commits, 'abc', 'master'))
+
+    def test_push_first(self):
+        self.assertTrue(claim_commit(self.commits, 'abc', 'feature/x'))
+        self.assertIsNone(claim_commit(self.commits, 'abc', 'master', pull_request=7))
+
+    def test_pull_request_first(self):
+        self.assertTrue(claim_commit(self.commits, 'abc', 'master', pull_request=7))
+        self.assertIsNone(claim_commit(self.commits, 'abc', 'feature/x'))
+
+    def test_other_branches_and_commits(self):
+        self.assertTrue(claim_commit(self.commits, 'abc', 'master'))
+        self.assertTrue(claim_commit(self.commits, 'abc', 'release'))
+        self.assertTrue(claim_commit(self.commits, 'abd', 'master', pull_request=7))
+
+    def test_released_claim_can_be_taken_again(self):
+        os.remove(claim_commit(self.commits, 'abc', 'master', pull_request=7))
+        self.assertTrue(claim_commit(self.commits, 'abc', 'feature/x'))
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'build.journal')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def marker(self, name, timestamp):
+        path = os.path.join(self.tmp.name, name)
+        with open(path, 'w') as file:
+            file.write(str(timestamp))
+        return path
+
+    def test_record_and_read_back(self):
+        journal = Journal(self.path)
+        self.assertEqual(journal.events, [])
+        journal.record('clone.begin')
+        journal.record('clone.end')
+        journal.record('clone.begin')
+        reread = Journal(self.path)
+        self.assertEqual([event for _, event in reread.events], ['clone.begin', 'clone.end', 'clone.begin'])
+        self.assertEqual(reread.time('clone.begin'), reread.events[2][0])
+        self.assertTrue(reread.has('clone.end'))
+        self.assertFalse(reread.has('build.begin'))
+        self.assertIsNone(reread.time('build.begin'))
+
+    def test_elapsed(self):
+        with open(self.path, 'w') as file:
+            file.write('100.000000 build.begin\n142.500000 build.end\n')
+        self.assertEqual(Journal(self.path).elapsed('build.begin', 'build.end'), 42.5)
+
+    def test_malformed_lines_are_skipped(self):
+        with open(self.path, 'w') as file:
+            file.write('100.0 begin\ngarbage\n\n101.0 end\n102.0')
+        self.assertEqual(Journal(self.path).events, [(100.0, 'begin'), (101.0, 'end'), (102.0, '')])
+
+    def test_legacy_markers_are_imported_on_first_write(self):
+        legacy = {
+            'build.end': self.marker('build.end', 200.0),
+            'build.begin': self.marker('build.begin', 100.0),
+            'clone.begin': os.path.join(self.tmp.name, 'missing'),
+            'clone.end': self.marker('clone.end', 'not a number'),
+        }
+        journal = Journal(self.path, legacy)
+        self.assertEqual(journal.events, [(100.0, 'build.begin'), (200.0, 'build.end')])
+        self.assertFalse(os.path.exists(self.path))
+        journal.record('result.success')
+        journal.record('result.success')
+        events = [event for _, event in Journal(self.path).events]
+        self.assertEqual(events, ['build.begin', 'build.end', 'result.success', 'result.success'])
+
+    def test_legacy_markers_are_ignored_once_there_is_a_journal(self):
+        Journal(self.path).record('build.begin')
+        journal = Journal(self.path, {'clone.begin': self.marker('clone.begin', 50.0)})
+        self.assertEqual([event for _, event in journal.events], ['build.begin'])
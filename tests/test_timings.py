@@ -0,0 +1,38 @@
+import unittest
+from tempfile import TemporaryDirectory
+
+from shipmaster.core.config import BuildConfig
+from shipmaster.core.timings import TimingStore, critical_path
+from shipmaster.plugins.graph.graph import format_seconds
+
+
+class TestTimings(unittest.TestCase):
+
+    def test_history_is_trimmed(self):
+        with TemporaryDirectory() as cache_dir:
+            store = TimingStore('test-project', cache_dir)
+            for seconds in range(TimingStore.HISTORY + 5):
+                store.record('app', seconds)
+            history = TimingStore('test-project', cache_dir).load()['app']
+            self.assertEqual(len(history), TimingStore.HISTORY)
+            self.assertEqual(history[-1], TimingStore.HISTORY + 4)
+
+    def test_critical_path(self):
+        config = BuildConfig.from_kwargs(
+            None, name='test-project', stages=['build', 'test'], images={
+                'base': {'stage': 'build', 'from': 'busybox:latest'},
+                'app': {'stage': 'build', 'from': 'base'},
+                'test': {'from': 'app'},
+                'lint': {'stage': 'test', 'from': 'base'},
+            }
+        )
+        durations = {'base': 60, 'app': 30, 'test': 20, 'lint': 45}
+        self.assertEqual(critical_path(config.graph, durations), (('base', 'app', 'test'), 110))
+        durations['lint'] = 100
+        self.assertEqual(critical_path(config.graph, durations), (('base', 'lint'), 160))
+
+    def test_format_seconds(self):
+        self.assertEqual(format_seconds(12.34), '12.3s')
+        self.assertEqual(format_seconds(59.96), '1m00s')
+        self.assertEqual(format_seconds(119.6), '2m00s')
+        self.assertEqual(format_seconds(150), '2m30s')